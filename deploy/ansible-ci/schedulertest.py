@@ -2,8 +2,10 @@
 
 import random
 import string
+import sys
 
 from shakenfist.client import apiclient
+from shakenfist.client import schedulersim
 
 
 def randomName():
@@ -13,7 +15,23 @@ def randomName():
     return ''.join(letters)
 
 
+def offline():
+    # Replay a generated trace against a simulated cluster, no cloud required
+    cluster = schedulersim.SimulatedCluster(100)
+    report = schedulersim.simulate(
+        cluster, schedulersim.generate_trace(5000, seed=42))
+    print(report)
+
+    if report['overcommitted_nodes'] or report['failed_preflight']:
+        print('Scheduler overcommitted nodes or failed preflight')
+        sys.exit(1)
+
+
 def main():
+    if '--offline' in sys.argv:
+        offline()
+        return
+
     c = apiclient.Client(base_url='http://localhost:13000', verbose=True)
 
     # Return to a clean state
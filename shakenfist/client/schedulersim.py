@@ -0,0 +1,412 @@
+# Copyright 2020 Michael Still
+
+# Drive the scheduler against a synthetic cluster. The scheduler talks to a
+# fake db backend instead of etcd, so this runs offline and in CI. A trace of
+# instance create and delete requests is replayed through the same placement
+# path as the API server and the preflight check on the chosen node, and the
+# results are summarized as latency percentiles, packing efficiency, preflight
+# redirect rate and imbalance.
+
+import argparse
+import contextlib
+import json
+import logging
+import random
+import sys
+import time
+
+import numpy
+
+from shakenfist.config import SFConfig
+from shakenfist import db
+from shakenfist import exceptions
+from shakenfist import scheduler
+
+
+GIGABYTE = 1024 * 1024 * 1024
+
+
+class SimulatedInstance(object):
+    def __init__(self, request):
+        self.db_entry = {
+            'uuid': request['uuid'],
+            'cpus': request['cpus'],
+            'memory': request['memory'],
+            'block_devices': {
+                'devices': [{'size': request['disk'], 'base': image}
+                            for image in request['images']] or
+                [{'size': request['disk']}]
+            },
+        }
+
+    def unique_label(self):
+        return ('instance', self.db_entry['uuid'])
+
+
+class SimulatedCluster(object):
+    """A cluster of identical nodes, exposed through a fake db backend.
+
+    Metrics only include running instances and are only published when
+    publish_metrics() is called, so a scheduler sees the same lag it would
+    against a real cluster. Reservations are held and released just as the
+    real db does. Changes reach the scheduler's cluster state and locality
+    index the way the etcd watches would deliver them.
+    """
+
+    def __init__(self, node_count, cpus=16, memory=64 * 1024, disk=2000):
+        self.nodes = ['node%d' % i for i in range(node_count)]
+        self.network_node = self.nodes[0]
+        self.cpus = cpus
+        self.memory = memory
+        self.disk = disk
+
+        # node -> {instance uuid: request}, running and placed instances
+        self.running = {node: {} for node in self.nodes}
+        self.pending = {node: {} for node in self.nodes}
+        self.events = 0
+
+        self.state = scheduler.ClusterState()
+        self.locality = scheduler.LocalityIndex()
+        self.publish_metrics()
+
+    # Faked methods from the db module
+    def get_nodes(self):
+        return [{'fqdn': node, 'ip': '10.0.%d.%d' % (i // 250, i % 250 + 1)}
+                for i, node in enumerate(self.nodes)]
+
+    def get_network_node(self):
+        return {'fqdn': self.network_node}
+
+    def add_reservation(self, node, uuid, cpus, memory, disk, hugepages=None,
+                        token=None):
+        r = {
+            'instance_uuid': uuid,
+            'cpus': cpus,
+            'memory': memory,
+            'disk': disk,
+            'token': token,
+            'expires': time.time() + 3600,
+        }
+        r.update(hugepages or {})
+        self.state.reservation_changed(
+            '/sf/reservation/%s/%s' % (node, uuid), r)
+
+    def release_reservation(self, node, uuid):
+        self.state.reservation_changed(
+            '/sf/reservation/%s/%s' % (node, uuid), None)
+
+    def add_event(self, object_type, object_uuid, operation, phase, duration,
+                  message):
+        self.events += 1
+
+    @contextlib.contextmanager
+    def installed(self, **config_overrides):
+        """Point the scheduler at this cluster instead of etcd."""
+        # The simulated state is kept current directly, and must not be
+        # reloaded from etcd however long a simulation runs
+        config_overrides.setdefault('SCHEDULER_INDEX_RELOAD_INTERVAL',
+                                    365 * 24 * 3600)
+        replaced = {
+            (db, 'get_nodes'): self.get_nodes,
+            (db, 'get_network_node'): self.get_network_node,
+            (db, 'add_reservation'): self.add_reservation,
+            (db, 'release_reservation'): self.release_reservation,
+            (db, 'add_event'): self.add_event,
+            (scheduler, 'config'): SFConfig(**config_overrides),
+            (scheduler, 'CLUSTER_STATE'): self.state,
+            (scheduler, 'LOCALITY_INDEX'): self.locality,
+        }
+        original = {}
+        for (module, name), value in replaced.items():
+            original[(module, name)] = getattr(module, name)
+            setattr(module, name, value)
+
+        try:
+            yield self
+        finally:
+            for (module, name), value in original.items():
+                setattr(module, name, value)
+
+    # Cluster state changes
+    def _used(self, node, instances):
+        cpus = sum(r['cpus'] for r in instances[node].values())
+        memory = sum(r['memory'] for r in instances[node].values())
+        disk = sum(r['disk'] for r in instances[node].values())
+        return cpus, memory, disk
+
+    def publish_metrics(self):
+        """Publish metrics for running instances, as each node's resource
+        daemon would. This also releases the reservations of instances
+        which are now running."""
+        for node in self.nodes:
+            cpus, memory, disk = self._used(node, self.running)
+            self.state.metrics_changed('/sf/metrics/%s/' % node, {
+                'fqdn': node,
+                'metrics': {
+                    'cpu_max': self.cpus,
+                    'cpu_max_per_instance': self.cpus,
+                    'cpu_total_instance_vcpus': cpus,
+                    'cpu_load_5': cpus * 0.1,
+                    'memory_available': self.memory - memory,
+                    'memory_max': self.memory,
+                    'memory_total_instance_actual': memory,
+                    'disk_free': (self.disk - disk) * GIGABYTE,
+                }
+            })
+            for uuid in self.running[node]:
+                self.release_reservation(node, uuid)
+
+    def place(self, node, request):
+        self.pending[node][request['uuid']] = request
+        self.locality.instance_changed(
+            request['uuid'], {'node': node, 'state': 'initial'})
+        for i, network_uuid in enumerate(request['networks']):
+            self.locality.interface_changed(
+                '%s-iface%d' % (request['uuid'], i),
+                {'instance_uuid': request['uuid'],
+                 'network_uuid': network_uuid,
+                 'state': 'initial'})
+
+    def move(self, old_node, new_node, request):
+        del self.pending[old_node][request['uuid']]
+        self.place(new_node, request)
+
+    def start(self, node, request):
+        del self.pending[node][request['uuid']]
+        self.running[node][request['uuid']] = request
+        for image in request['images']:
+            self.locality.image_changed('/sf/image/%s/%s' % (image, node),
+                                        {'url': image})
+
+    def delete(self, node, uuid):
+        self.pending[node].pop(uuid, None)
+        self.running[node].pop(uuid, None)
+        self.release_reservation(node, uuid)
+        self.locality.instance_changed(uuid, None)
+
+    def committed(self):
+        """Resources used on each node, including instances not yet running,
+        as three arrays of cpus, memory and disk."""
+        used = numpy.zeros((3, len(self.nodes)))
+        for i, node in enumerate(self.nodes):
+            for instances in (self.running, self.pending):
+                used[:, i] += self._used(node, instances)
+        return used
+
+
+def generate_trace(count, networks=10, images=5, delete_ratio=0.2, seed=None):
+    """Generate a trace of instance requests.
+
+    Each entry is either a create with the resources the instance requests,
+    or a delete of an instance created earlier in the trace.
+    """
+    rand = random.Random(seed)
+    network_uuids = ['network%d' % i for i in range(networks)]
+    image_urls = ['http://images/image%d' % i for i in range(images)]
+
+    trace = []
+    live = []
+    for i in range(count):
+        if live and rand.random() < delete_ratio:
+            uuid = live.pop(rand.randrange(len(live)))
+            trace.append({'op': 'delete', 'uuid': uuid})
+            continue
+
+        uuid = 'instance%d' % i
+        live.append(uuid)
+        trace.append({
+            'op': 'create',
+            'uuid': uuid,
+            'cpus': rand.choice([1, 1, 2, 2, 4, 8]),
+            'memory': rand.choice([512, 1024, 2048, 4096, 8192]),
+            'disk': rand.choice([8, 20, 50]),
+            'networks': rand.sample(network_uuids, min(len(network_uuids),
+                                                       rand.choice([0, 1, 1, 2]))),
+            'images': rand.sample(image_urls, min(len(image_urls), 1)),
+        })
+    return trace
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_trace(trace, path):
+    with open(path, 'w') as f:
+        for entry in trace:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return {}
+    values = numpy.array(latencies) * 1000
+    return {'p50_ms': float(numpy.percentile(values, 50)),
+            'p90_ms': float(numpy.percentile(values, 90)),
+            'p99_ms': float(numpy.percentile(values, 99)),
+            'max_ms': float(values.max())}
+
+
+def simulate(cluster, trace, metrics_interval=10, start_delay=5,
+             **config_overrides):
+    """Replay trace against cluster and return a report.
+
+    The nodes publish metrics every metrics_interval requests, and the API
+    server keeps one scheduler which follows the cluster state. Instances start
+    start_delay requests after they were placed, after a preflight check on
+    their node with a fresh scheduler, just as the queue workers do.
+    """
+    report = {
+        'requests': 0,
+        'placed': 0,
+        'rejected': 0,
+        'redirected': 0,
+        'failed_preflight': 0,
+        'deleted': 0,
+    }
+    latencies = []
+    placements = {}
+    starting = []
+
+    def preflight(request):
+        node = placements[request['uuid']]
+        instance = SimulatedInstance(request)
+        s = scheduler.Scheduler()
+        try:
+            s.place_instance(instance, [], candidates=[node])
+            return node
+        except exceptions.LowResourceException:
+            pass
+
+        try:
+            candidates = s.place_instance(
+                instance, [], candidates=[n for n in cluster.nodes
+                                          if n != node])
+        except exceptions.LowResourceException:
+            return None
+
+        report['redirected'] += 1
+        s.reserve(instance, candidates[0])
+        cluster.release_reservation(node, request['uuid'])
+        cluster.move(node, candidates[0], request)
+        placements[request['uuid']] = candidates[0]
+        return candidates[0]
+
+    def start_due(step, force=False):
+        while starting and (force or starting[0][0] <= step):
+            _, request = starting.pop(0)
+            if request['uuid'] not in placements:
+                continue
+            node = preflight(request)
+            if node:
+                cluster.start(node, request)
+            else:
+                report['failed_preflight'] += 1
+                cluster.delete(placements.pop(request['uuid']),
+                               request['uuid'])
+
+    with cluster.installed(**config_overrides):
+        api = scheduler.Scheduler()
+
+        for step, request in enumerate(trace):
+            start_due(step)
+            if step and step % metrics_interval == 0:
+                cluster.publish_metrics()
+
+            report['requests'] += 1
+            if request['op'] == 'delete':
+                if request['uuid'] in placements:
+                    cluster.delete(placements.pop(request['uuid']),
+                                   request['uuid'])
+                    report['deleted'] += 1
+                continue
+
+            instance = SimulatedInstance(request)
+            networks = [{'network_uuid': n} for n in request['networks']]
+            start_time = time.time()
+            try:
+                node = api.place_instance(instance, networks)[0]
+            except exceptions.LowResourceException:
+                report['rejected'] += 1
+                continue
+            finally:
+                latencies.append(time.time() - start_time)
+
+            api.reserve(instance, node)
+            cluster.place(node, request)
+            placements[request['uuid']] = node
+            starting.append((step + start_delay, request))
+            report['placed'] += 1
+
+        start_due(len(trace), force=True)
+        cluster.publish_metrics()
+
+    report['latency'] = _percentiles(latencies)
+    report['redirect_rate'] = (report['redirected'] / report['placed']
+                               if report['placed'] else 0.0)
+    report['events'] = cluster.events
+
+    # Packing efficiency is how full the nodes in use are, imbalance is the
+    # coefficient of variation of memory use across all nodes
+    cpus, memory, disk = cluster.committed()
+    in_use = memory > 0
+    report['nodes_in_use'] = int(in_use.sum())
+    report['packing_efficiency'] = (
+        float(memory[in_use].sum() / (cluster.memory * in_use.sum()))
+        if in_use.any() else 0.0)
+    utilization = memory / cluster.memory
+    report['imbalance'] = (float(utilization.std() / utilization.mean())
+                           if utilization.mean() else 0.0)
+    report['overcommitted_nodes'] = int((memory > cluster.memory).sum())
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate scheduling against a synthetic cluster')
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--node-cpus', type=int, default=16)
+    parser.add_argument('--node-memory', type=int, default=64 * 1024,
+                        help='memory per node in MB')
+    parser.add_argument('--node-disk', type=int, default=2000,
+                        help='disk per node in GB')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='length of a generated trace')
+    parser.add_argument('--networks', type=int, default=10)
+    parser.add_argument('--images', type=int, default=5)
+    parser.add_argument('--delete-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--trace', help='replay this trace instead of '
+                                        'generating one')
+    parser.add_argument('--record', help='write the trace to this file')
+    parser.add_argument('--metrics-interval', type=int, default=10)
+    parser.add_argument('--start-delay', type=int, default=5)
+    parser.add_argument('--strategy', choices=['spread', 'pack'],
+                        default='spread')
+    args = parser.parse_args()
+
+    # Every placement logs, which would swamp syslog for a large trace
+    logging.disable(logging.INFO)
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = generate_trace(args.requests, networks=args.networks,
+                               images=args.images,
+                               delete_ratio=args.delete_ratio, seed=args.seed)
+    if args.record:
+        save_trace(trace, args.record)
+
+    random.seed(args.seed)
+    cluster = SimulatedCluster(args.nodes, cpus=args.node_cpus,
+                               memory=args.node_memory, disk=args.node_disk)
+    report = simulate(cluster, trace, metrics_interval=args.metrics_interval,
+                      start_delay=args.start_delay,
+                      SCHEDULER_STRATEGY=args.strategy)
+    json.dump(report, sys.stdout, indent=4, sort_keys=True)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -59,6 +59,28 @@ class SFConfig(SFConfigBase):
                     'access from untrusted '
                     'clients!',
     )
+    INSTANCE_METRICS_INTERVAL: int = Field(
+        15,
+        description='How often, in seconds, per-instance metrics are '
+                    'collected for Prometheus',
+    )
+    INSTANCE_METRICS_MAX: int = Field(
+        500,
+        description='The most instances per node to export metrics for. The '
+                    'busiest instances by CPU time are exported. Zero '
+                    'disables per-instance metrics.',
+    )
+    METRICS_PUBLISH_CHANGE: float = Field(
+        0.05,
+        description='Node metrics are published to etcd when a metric the '
+                    'scheduler uses changes by more than this fraction, or '
+                    'when the instances running on the node change',
+    )
+    METRICS_PUBLISH_HEARTBEAT: int = Field(
+        60,
+        description='How often, in seconds, node metrics are published to '
+                    'etcd even if they have not changed',
+    )
     AUTH_SECRET_SEED: SecretStr = Field(
         'foo', description='A random string to seed auth secrets with'
     )
@@ -75,6 +97,17 @@ class SFConfig(SFConfigBase):
     SCHEDULER_CACHE_TIMEOUT: int = Field(
         5, description='how long the scheduler should cache things for'
     )
+    SCHEDULER_INDEX_RELOAD_INTERVAL: int = Field(
+        300,
+        description='how often the cluster state a scheduler keeps current '
+                    'from etcd watches is reloaded in full, in case a watch '
+                    'has silently stopped delivering changes',
+    )
+    SCHEDULER_RESERVATION_TIMEOUT: int = Field(
+        900,
+        description='how long resources are held for a placed instance which '
+                    'has not yet been seen running on its node',
+    )
     CPU_OVERCOMMIT_RATIO: float = Field(
         16, description='how many vCPUS per real CPU'
     )
@@ -87,6 +120,79 @@ class SFConfig(SFConfigBase):
     RAM_SYSTEM_RESERVATION: float = Field(
         5.0, description='how much RAM is reserved for the OS'
     )
+    SCHEDULER_DEBUG: bool = Field(
+        False,
+        description='include the full list of surviving candidates for each '
+                    'stage in scheduling decision records',
+    )
+    SCHEDULER_STRATEGY: str = Field(
+        'spread',
+        description='either spread, to prefer the least loaded nodes, or '
+                    'pack, to prefer the most loaded nodes which still fit',
+    )
+    SCHEDULER_WEIGHT_FREE_RAM: float = Field(
+        1.0, description='scheduler weight for free RAM on a node'
+    )
+    SCHEDULER_WEIGHT_FREE_CPU: float = Field(
+        1.0, description='scheduler weight for the free vCPU ratio of a node'
+    )
+    SCHEDULER_WEIGHT_LOAD: float = Field(
+        1.0, description='scheduler weight for the load average of a node'
+    )
+    SCHEDULER_WEIGHT_NETWORK_LOCALITY: float = Field(
+        0.5,
+        description='scheduler weight for a node already having the requested '
+                    'networks'
+    )
+    SCHEDULER_WEIGHT_IMAGE_LOCALITY: float = Field(
+        0.5,
+        description='scheduler weight for a node already having the requested '
+                    'images'
+    )
+    SCHEDULER_WEIGHT_NUMA_FIT: float = Field(
+        5.0,
+        description='scheduler weight for a node where the instance fits '
+                    'within a single NUMA cell'
+    )
+
+    # Queue Options
+    QUEUE_WORKERS: int = Field(
+        0,
+        description='how many persistent worker processes handle the queue '
+                    'for this node, zero means half of the present CPUs. '
+                    'This is also the most workitems of any one class which '
+                    'may run at once.',
+    )
+    QUEUE_WORKER_MAX_TASKS: int = Field(
+        100,
+        description='how many workitems a queue worker handles before it is '
+                    'replaced by a fresh process',
+    )
+    QUEUE_METRICS_PORT: int = Field(
+        13002,
+        description='where the queues daemon exposes its worker metrics. Do '
+                    'not allow access from untrusted clients!',
+    )
+    QUEUE_PRESSURE_LOAD: float = Field(
+        1.0,
+        description='load average per CPU above which fewer instance starts '
+                    'and deletes are run at once',
+    )
+    QUEUE_PRESSURE_IOWAIT: float = Field(
+        20.0,
+        description='percentage of CPU time waiting on I/O above which fewer '
+                    'image fetches and instance starts are run at once',
+    )
+    QUEUE_PRESSURE_DISK_QUEUE: float = Field(
+        4.0,
+        description='average number of disk I/Os in flight above which fewer '
+                    'image fetches and instance starts are run at once',
+    )
+    QUEUE_PRESSURE_LATENCY: float = Field(
+        3.0,
+        description='how many times slower than usual workitems of a class '
+                    'must become before fewer of them are run at once',
+    )
 
     # Network Options
     FLOATING_NETWORK: str = Field(
@@ -163,6 +269,11 @@ class SFConfig(SFConfigBase):
     LOG_METHOD_TRACE: int = Field(
         0, description='Add method name and module line number to log messages'
     )
+    TRACE_PATH: str = Field(
+        '',
+        description='File to append trace spans to, in OpenTelemetry JSON '
+                    'format. Tracing is disabled if this is empty.',
+    )
 
     class Config:
         env_prefix = 'SHAKENFIST_'
@@ -18,7 +18,7 @@ LOG, _ = logutil.setup(__name__)
 class Monitor(daemon.Daemon):
     def _update_power_states(self):
         libvirt = util.get_libvirt()
-        conn = libvirt.open(None)
+        conn = util.get_libvirt_connection()
         try:
             seen = []
 
@@ -32,7 +32,7 @@ class Monitor(daemon.Daemon):
                 instance_uuid = domain.name().split(':')[1]
                 log_ctx = LOG.withInstance(instance_uuid)
 
-                instance = db.get_instance(instance_uuid)
+                instance = db.get_instance_state(instance_uuid)
                 if not instance:
                     # Instance is SF but not in database. Kill to reduce load.
                     log_ctx.warning('Destroying unknown instance')
@@ -85,7 +85,7 @@ class Monitor(daemon.Daemon):
                 if domain_name not in seen:
                     instance_uuid = domain_name.split(':')[1]
                     log_ctx = LOG.withInstance(instance_uuid)
-                    instance = db.get_instance(instance_uuid)
+                    instance = db.get_instance_state(instance_uuid)
 
                     if not instance:
                         # Instance is SF but not in database. Kill because unknown.
@@ -6,6 +6,7 @@ from shakenfist import db
 from shakenfist import exceptions
 from shakenfist import logutil
 from shakenfist import net
+from shakenfist import tracing
 from shakenfist.tasks import (DeployNetworkTask,
                               NetworkTask,
                               RemoveDHCPNetworkTask,
@@ -115,46 +116,53 @@ class Monitor(daemon.Daemon):
                 raise exceptions.UnknownTaskException(
                     'Network workitem was not decoded: %s' % workitem)
 
-            n = net.from_db(workitem.network_uuid())
-            if not n:
-                log_ctx.withNetwork(workitem.network_uuid()).warning(
-                    'Received work item for non-existent network')
-                return
-
-            # NOTE(mikal): there's really nothing stopping us from processing a bunch
-            # of these jobs in parallel with a pool of workers, but I am not sure its
-            # worth the complexity right now. Are we really going to be changing
-            # networks that much?
-            if isinstance(workitem, DeployNetworkTask):
-                try:
-                    n.create()
-                    n.ensure_mesh()
-                    db.add_event('network', workitem.network_uuid(),
-                                 'network node', 'deploy', None, None)
-                except exceptions.DeadNetwork as e:
-                    log_ctx.withField('exception', e).warning(
-                        'DeployNetworkTask on dead network')
-
-            elif isinstance(workitem, UpdateDHCPNetworkTask):
-                try:
-                    n.create()
-                    n.ensure_mesh()
-                    n.update_dhcp()
-                    db.add_event('network', workitem.network_uuid(),
-                                 'network node', 'update dhcp', None, None)
-                except exceptions.DeadNetwork as e:
-                    log_ctx.withField('exception', e).warning(
-                        'UpdateDHCPNetworkTask on dead network')
-
-            elif isinstance(workitem, RemoveDHCPNetworkTask):
-                n.remove_dhcp()
-                db.add_event('network', workitem.network_uuid(),
-                             'network node', 'remove dhcp', None, None)
+            with tracing.Span('network workitem',
+                              {'network': workitem.network_uuid(),
+                               'task': workitem.name()},
+                              parent=workitem.trace()):
+                self._process_network_workitem(log_ctx, workitem)
 
         finally:
             if jobname:
                 db.resolve('networknode', jobname)
 
+    def _process_network_workitem(self, log_ctx, workitem):
+        n = net.from_db(workitem.network_uuid())
+        if not n:
+            log_ctx.withNetwork(workitem.network_uuid()).warning(
+                'Received work item for non-existent network')
+            return
+
+        # NOTE(mikal): there's really nothing stopping us from processing a bunch
+        # of these jobs in parallel with a pool of workers, but I am not sure its
+        # worth the complexity right now. Are we really going to be changing
+        # networks that much?
+        if isinstance(workitem, DeployNetworkTask):
+            try:
+                n.create()
+                n.ensure_mesh()
+                db.add_event('network', workitem.network_uuid(),
+                             'network node', 'deploy', None, None)
+            except exceptions.DeadNetwork as e:
+                log_ctx.withField('exception', e).warning(
+                    'DeployNetworkTask on dead network')
+
+        elif isinstance(workitem, UpdateDHCPNetworkTask):
+            try:
+                n.create()
+                n.ensure_mesh()
+                n.update_dhcp()
+                db.add_event('network', workitem.network_uuid(),
+                             'network node', 'update dhcp', None, None)
+            except exceptions.DeadNetwork as e:
+                log_ctx.withField('exception', e).warning(
+                    'UpdateDHCPNetworkTask on dead network')
+
+        elif isinstance(workitem, RemoveDHCPNetworkTask):
+            n.remove_dhcp()
+            db.add_event('network', workitem.network_uuid(),
+                         'network node', 'remove dhcp', None, None)
+
     def run(self):
         LOG.info('Starting')
         last_management = 0
@@ -1,8 +1,13 @@
-import copy
 import multiprocessing
+import multiprocessing.connection
+import os
+from prometheus_client import Gauge
+from prometheus_client import start_http_server
+import psutil
 import re
 import requests
 import setproctitle
+import threading
 import time
 
 from shakenfist.config import config
@@ -13,6 +18,7 @@ from shakenfist.images import Image
 from shakenfist import logutil
 from shakenfist import net
 from shakenfist import scheduler
+from shakenfist import tracing
 from shakenfist import util
 from shakenfist import virt
 from shakenfist.tasks import (QueueTask,
@@ -27,8 +33,31 @@ from shakenfist.tasks import (QueueTask,
 
 LOG, _ = logutil.setup(__name__)
 
+# Queue workers set this to tell the pool about progress as it happens, as
+# NOTIFY(kind, detail). For example, workitems waiting on an image can run as
+# soon as it has been fetched.
+NOTIFY = None
+
+
+def _notify(kind, detail):
+    if NOTIFY:
+        NOTIFY(kind, detail)
+
 
 def handle(jobname, workitem):
+    # The workitem is traced as part of the operation which queued it, for
+    # example the API request which created an instance
+    tasks = [t for t in workitem.get('tasks', []) if isinstance(t, QueueTask)]
+    parent = tasks[0].trace() if tasks else None
+
+    with tracing.Span('workitem', {'workitem': jobname,
+                                   'node': config.NODE_NAME,
+                                   'tasks': ', '.join(t.name() for t in tasks)},
+                      parent=parent):
+        _handle(jobname, workitem)
+
+
+def _handle(jobname, workitem):
     log = LOG.withField('workitem', jobname)
     log.info('Processing workitem')
 
@@ -37,8 +66,15 @@ def handle(jobname, workitem):
 
     instance_uuid = None
     task = None
+    tasks = workitem.get('tasks', [])
+
+    # Images for an instance which is started by this workitem are fetched
+    # as part of the start, alongside the rest of its preparation
+    deferred_fetches = []
+    starts_instance = any(isinstance(t, StartInstanceTask) for t in tasks)
+
     try:
-        for task in workitem.get('tasks', []):
+        for task in tasks:
             if not QueueTask.__subclasscheck__(type(task)):
                 raise exceptions.UnknownTaskException(
                     'Task was not decoded: %s' % task)
@@ -67,19 +103,34 @@ def handle(jobname, workitem):
                              'dequeued', None, 'Work item %s' % jobname)
 
             if isinstance(task, FetchImageTask):
-                image_fetch(task.url(), instance_uuid)
+                if starts_instance and instance_uuid:
+                    deferred_fetches.append(task.url())
+                else:
+                    image_fetch(task.url(), instance_uuid)
 
             elif isinstance(task, PreflightInstanceTask):
-                redirect_to = instance_preflight(instance_uuid, task.network())
+                redirect_to, reservation = instance_preflight(
+                    instance_uuid, task.network(), placement=task.placement(),
+                    reservation=task.reservation())
                 if redirect_to:
                     log_i.info('Redirecting instance start to %s'
                                % redirect_to)
                     db.place_instance(instance_uuid, redirect_to)
+
+                    # The next node can then confirm our reservation there,
+                    # rather than scheduling the instance again
+                    workitem['tasks'] = [
+                        PreflightInstanceTask(
+                            instance_uuid, task.network(),
+                            placement=redirect_to, reservation=reservation)
+                        if t is task else t
+                        for t in workitem['tasks']]
                     db.enqueue(redirect_to, workitem)
                     return
 
             elif isinstance(task, StartInstanceTask):
-                instance_start(instance_uuid, task.network())
+                instance_start(instance_uuid, task.network(),
+                               image_urls=deferred_fetches)
                 db.update_instance_state(instance_uuid, 'created')
                 db.enqueue('%s-metrics' % config.NODE_NAME, {})
 
@@ -129,14 +180,20 @@ def handle(jobname, workitem):
 
 
 def image_fetch(url, instance_uuid):
+    try:
+        _image_fetch(url, instance_uuid)
+    finally:
+        _notify('fetched', url)
+
+
+def _image_fetch(url, instance_uuid):
     instance = None
     if instance_uuid:
         instance = virt.from_db(instance_uuid)
 
     try:
-        # TODO(andy): Wait up to 15 mins for another queue process to download
-        # the required image. This will be changed to queue on a
-        # "waiting_image_fetch" queue but this works now.
+        # The worker pool doesn't send a workitem here while another is
+        # fetching the same image, so this lock is rarely contended
         with db.get_lock('image', config.NODE_NAME, Image.calc_unique_ref(url),
                          timeout=15*60, op='Image fetch') as lock:
             img = Image.from_url(url)
@@ -161,15 +218,32 @@ def image_fetch(url, instance_uuid):
             'Failed to fetch image %s' % url)
 
 
-def instance_preflight(instance_uuid, network):
+def instance_preflight(instance_uuid, network, placement=None,
+                       reservation=None):
+    """Check this node can start an instance placed on it.
+
+    Returns (None, None) if it can. Otherwise the instance is moved to another
+    node, and that node and the token of the reservation there are returned.
+    """
     db.update_instance_state(instance_uuid, 'preflight')
 
     s = scheduler.Scheduler()
     instance = virt.from_db(instance_uuid)
 
+    # If the reservation made when this instance was scheduled here still
+    # stands, and this node still has room for it, there is no need to
+    # schedule it again
+    if (reservation and placement == config.NODE_NAME and
+            s.confirm_reservation(instance, config.NODE_NAME, reservation)):
+        db.add_event('instance', instance_uuid, 'schedule', 'confirmed',
+                     None, 'reservation still held')
+        _notify('preflight', 'confirmed')
+        return None, None
+
     try:
         s.place_instance(instance, network, candidates=[config.NODE_NAME])
-        return None
+        _notify('preflight', 'placed')
+        return None, None
 
     except exceptions.LowResourceException as e:
         db.add_event('instance', instance_uuid,
@@ -185,66 +259,96 @@ def instance_preflight(instance_uuid, network):
             candidates = [instance.db_entry.get('requested_placement')]
         else:
             candidates = []
-            for node in s.metrics.keys():
+            for node in s.nodes:
                 if node != config.NODE_NAME:
                     candidates.append(node)
 
         candidates = s.place_instance(instance, network,
                                       candidates=candidates)
-        return candidates[0]
+
+        # Move our reservation to the node we're redirecting to
+        token = s.reserve(instance, candidates[0])
+        db.release_reservation(config.NODE_NAME, instance_uuid)
+        _notify('preflight', 'redirected')
+        return candidates[0], token
 
     except exceptions.LowResourceException as e:
         db.add_event('instance', instance_uuid,
                      'schedule', 'failed', None,
                      'insufficient resources: ' + str(e))
+        _notify('preflight', 'failed')
+
         # This raise implies delete above
         raise exceptions.AbortInstanceStartException(
             'Unable to find suitable node')
 
 
-def instance_start(instance_uuid, network):
-    log = LOG.withField('instance', instance_uuid)
+def _ensure_networks(instance, network):
+    instance_uuid = instance.db_entry['uuid']
+
+    # Collect the networks
+    nets = {}
+    for netdesc in network:
+        if netdesc['network_uuid'] not in nets:
+            n = net.from_db(netdesc['network_uuid'])
+            if not n:
+                raise exceptions.AbortInstanceStartException('missing network')
 
+            nets[netdesc['network_uuid']] = n
+
+    # Record that the networks are used here before creating them, so that
+    # a concurrent delete of another instance won't remove them
+    db.add_network_users(instance_uuid, nets.keys())
+
+    # Create the networks
+    with util.RecordedOperation('ensure networks exist', instance):
+        for network_uuid in nets:
+            n = nets[network_uuid]
+            try:
+                n.create()
+                n.ensure_mesh()
+                n.update_dhcp()
+            except exceptions.DeadNetwork as e:
+                LOG.withInstance(instance_uuid).withField('network', n).warning(
+                    'Instance tried to use dead network')
+                raise exceptions.AbortInstanceStartException(
+                    'tried to use dead network: %s' % e)
+
+
+def instance_start(instance_uuid, network, image_urls=None):
+    """Start an instance, overlapping the steps which don't depend on each other.
+
+    Image fetches, network setup, console port allocation and the config
+    drive all proceed at once. Disks are created once their images and the
+    config drive are ready, and the domain once everything else is.
+    """
     with db.get_lock(
             'instance', None, instance_uuid, ttl=900, timeout=120,
             op='Instance start') as lock:
         instance = virt.from_db(instance_uuid)
+        db.update_instance_state(instance_uuid, 'creating')
+
+        graph = util.DependencyGraph()
+        fetches = []
+        for url in image_urls or []:
+            fetches.append('fetch %s' % url)
+            graph.add(fetches[-1], image_fetch, url, instance_uuid)
+        graph.add('networks', _ensure_networks, instance, network)
+        graph.add('ports', instance.allocate_instance_ports)
+        graph.add('config drive', instance.create_config_drive)
+        graph.add('disks', instance.create_disks, lock=lock,
+                  after=fetches + ['config drive'])
+        graph.add('domain', instance.create_domain,
+                  after=['networks', 'ports', 'disks'])
 
-        # Collect the networks
-        nets = {}
-        for netdesc in network:
-            if netdesc['network_uuid'] not in nets:
-                n = net.from_db(netdesc['network_uuid'])
-                if not n:
-                    db.enqueue_instance_error(instance_uuid, 'missing network')
-                    return
-
-                nets[netdesc['network_uuid']] = n
-
-        # Create the networks
-        with util.RecordedOperation('ensure networks exist', instance):
-            for network_uuid in nets:
-                n = nets[network_uuid]
-                try:
-                    n.create()
-                    n.ensure_mesh()
-                    n.update_dhcp()
-                except exceptions.DeadNetwork as e:
-                    log.withField('network', n).warning(
-                        'Instance tried to use dead network')
-                    db.enqueue_instance_error(
-                        instance_uuid, 'tried to use dead network: %s' % e)
-                    return
-
-        # Allocate console and VDI ports
-        instance.allocate_instance_ports()
-
-        # Now we can start the instance
         libvirt = util.get_libvirt()
         try:
-            with util.RecordedOperation('instance creation',
-                                        instance):
-                instance.create(lock=lock)
+            with util.RecordedOperation('instance creation', instance):
+                graph.run()
+
+        except exceptions.AbortInstanceStartException as e:
+            db.enqueue_instance_error(instance_uuid, str(e))
+            return
 
         except libvirt.libvirtError as e:
             code = e.get_error_code()
@@ -270,24 +374,18 @@ def instance_delete(instance_uuid):
             if not iface['network_uuid'] in instance_networks:
                 instance_networks.append(iface['network_uuid'])
 
-        # Create list of networks used by all other instances
-        host_networks = []
-        for inst in list(db.get_instances(only_node=config.NODE_NAME)):
-            if not inst['uuid'] == instance_uuid:
-                for iface in db.get_instance_interfaces(inst['uuid']):
-                    if not iface['network_uuid'] in host_networks:
-                        host_networks.append(iface['network_uuid'])
-
         instance_from_db_virt = virt.from_db(instance_uuid)
         if instance_from_db_virt:
             instance_from_db_virt.delete()
 
+        db.remove_network_users(instance_uuid, instance_networks)
+
         # Check each network used by the deleted instance
         for network in instance_networks:
             n = net.from_db(network)
             if n:
                 # If network used by another instance, only update
-                if network in host_networks:
+                if db.is_network_used(network):
                     with util.RecordedOperation('deallocate ip address',
                                                 instance_from_db_virt):
                         n.update_dhcp()
@@ -297,36 +395,469 @@ def instance_delete(instance_uuid):
                         n.delete()
 
 
+def _worker_main(conn, max_tasks):
+    """Handle workitems sent by the pool until told to stop or recycled.
+
+    Each result is sent back as ('done', jobname, duration, retiring), where
+    retiring means this worker will exit rather than accept another workitem.
+    Progress within a workitem is sent as (kind, detail) as it happens.
+    """
+    global NOTIFY
+
+    setproctitle.setproctitle('%s-worker' % daemon.process_name('queues'))
+
+    # Pay for the libvirt import and connection once per worker, not once
+    # per workitem
+    util.get_libvirt_connection()
+
+    # Fetches run in threads during an instance start
+    send_lock = threading.Lock()
+
+    def send(msg):
+        with send_lock:
+            conn.send(msg)
+
+    NOTIFY = lambda kind, detail: send((kind, detail))  # noqa: E731
+
+    handled = 0
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        if not msg:
+            return
+
+        jobname, workitem = msg
+        start = time.time()
+        handle(jobname, workitem)
+        handled += 1
+
+        retiring = handled >= max_tasks
+        send(('done', jobname, time.time() - start, retiring))
+        if retiring:
+            return
+        setproctitle.setproctitle(
+            '%s-worker' % daemon.process_name('queues'))
+
+
+# Which measures of host pressure slow down each class of workitem. Fetches
+# are mostly disk and network bound, starts also convert images and boot
+# qemu, and deletes are cheap.
+TASK_CLASS_SIGNALS = {
+    'fetch': ['iowait', 'disk_queue'],
+    'start': ['load', 'iowait', 'disk_queue'],
+    'delete': ['load'],
+}
+
+
+def task_class(workitem):
+    """Classify a workitem by the most expensive task it contains."""
+    tasks = workitem.get('tasks', [])
+    for task in tasks:
+        if isinstance(task, (PreflightInstanceTask, StartInstanceTask)):
+            return 'start'
+    for task in tasks:
+        if isinstance(task, FetchImageTask):
+            return 'fetch'
+    return 'delete'
+
+
+def _disk_weighted_io_time():
+    """Return the total I/O time of physical disks, weighted by queue depth.
+
+    The result is in milliseconds. Partitions and virtual devices such as
+    device mapper and loop devices are skipped, so that I/O is not counted
+    more than once.
+    """
+    total = 0
+    try:
+        with open('/proc/diskstats') as f:
+            for line in f:
+                fields = line.split()
+                if (len(fields) > 13 and
+                        os.path.exists('/sys/block/%s/device' % fields[2])):
+                    total += int(fields[13])
+    except OSError:
+        pass
+    return total
+
+
+class HostPressure(object):
+    """Measures how busy this node is between calls to sample()."""
+
+    def __init__(self):
+        self.cpus = psutil.cpu_count() or 1
+        self.last_time = time.time()
+        self.last_disk = _disk_weighted_io_time()
+
+        # The first call has nothing to compare to, so prime it here
+        psutil.cpu_times_percent()
+
+    def sample(self):
+        now = time.time()
+        disk = _disk_weighted_io_time()
+        elapsed_ms = max((now - self.last_time) * 1000, 1)
+
+        pressure = {
+            'load': psutil.getloadavg()[0] / self.cpus,
+            'iowait': getattr(psutil.cpu_times_percent(), 'iowait', 0.0),
+            'disk_queue': (disk - self.last_disk) / elapsed_ms,
+        }
+
+        self.last_time = now
+        self.last_disk = disk
+        return pressure
+
+
+class ConcurrencyLimit(object):
+    """An adaptive limit on how many workitems of one class run at once.
+
+    The limit halves whenever the host is under a kind of pressure which
+    affects this class, or when workitems take much longer than they have
+    been. Otherwise it grows by one each time it was reached.
+    """
+
+    def __init__(self, name, maximum):
+        self.name = name
+        self.maximum = maximum
+        self.limit = max(1, maximum // 4)
+        self.running = 0
+        self.saturated = False
+        self.latency = None
+        self.baseline = None
+
+    def has_capacity(self):
+        return self.running < self.limit
+
+    def started(self):
+        self.running += 1
+        if self.running >= self.limit:
+            self.saturated = True
+
+    def finished(self, duration=None):
+        self.running -= 1
+        if duration is None:
+            return
+
+        if self.latency is None:
+            self.latency = duration
+            self.baseline = duration
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * duration
+
+            # Let the baseline drift up, so that one unusually quick period
+            # doesn't make every later one look slow
+            self.baseline = min(self.latency, self.baseline * 1.05)
+
+    def adjust(self, pressure):
+        """Adjust the limit, returning the reasons it was reduced."""
+        reasons = []
+        for signal in TASK_CLASS_SIGNALS[self.name]:
+            if pressure[signal] > config.get('QUEUE_PRESSURE_' + signal.upper()):
+                reasons.append(signal)
+        if (self.latency and self.baseline and
+                self.latency > self.baseline * config.get('QUEUE_PRESSURE_LATENCY')):
+            reasons.append('latency')
+
+        if reasons:
+            limit = max(1, self.limit // 2)
+        elif self.saturated:
+            limit = min(self.maximum, self.limit + 1)
+        else:
+            limit = self.limit
+
+        if limit != self.limit:
+            LOG.withFields({
+                'task_class': self.name,
+                'limit': limit,
+                'previous': self.limit,
+                'reasons': ','.join(reasons),
+            }).info('Changed queue concurrency limit')
+            self.limit = limit
+
+        self.saturated = self.running >= self.limit
+        return reasons
+
+
+def _image_urls(workitem):
+    return {task.url() for task in workitem.get('tasks', [])
+            if isinstance(task, FetchImageTask)}
+
+
+class FetchCoordinator(object):
+    """Tracks which images are being fetched, and by which workitem.
+
+    A workitem which needs an image another workitem is already fetching
+    waits without a worker until that fetch is done, and then finds the
+    image already downloaded and transcoded.
+    """
+
+    def __init__(self):
+        self.fetching = {}
+
+    def blocked(self, workitem):
+        return bool(_image_urls(workitem) & set(self.fetching))
+
+    def claim(self, jobname, workitem):
+        for url in _image_urls(workitem):
+            self.fetching[url] = jobname
+
+    def fetched(self, url):
+        self.fetching.pop(url, None)
+
+    def finished(self, jobname):
+        for url, owner in list(self.fetching.items()):
+            if owner == jobname:
+                del self.fetching[url]
+
+
+class Worker(object):
+    """A persistent queue worker process, fed workitems over a pipe."""
+
+    def __init__(self, slot, max_tasks):
+        self.slot = slot
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main, args=(child_conn, max_tasks),
+            name='%s-worker' % daemon.process_name('queues'))
+        self.process.start()
+        child_conn.close()
+
+        self.started = time.time()
+        self.jobname = None
+        self.task_class = None
+        self.busy_since = None
+        self.busy_time = 0.0
+        self.tasks = 0
+        self.retiring = False
+        self.progress = []
+
+    def available(self):
+        return (not self.jobname and not self.retiring and
+                self.process.is_alive())
+
+    def dispatch(self, jobname, workitem, task_class):
+        self.conn.send((jobname, workitem))
+        self.jobname = jobname
+        self.task_class = task_class
+        self.busy_since = time.time()
+
+    def collect(self):
+        """Return how long a finished workitem took, if there is one.
+
+        Progress reported by the worker is added to self.progress.
+        """
+        while self.jobname:
+            try:
+                if not self.conn.poll():
+                    return None
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                # The worker died, which reap() will notice
+                return None
+
+            if msg[0] != 'done':
+                self.progress.append(msg)
+                continue
+
+            _, _, duration, self.retiring = msg
+            self.tasks += 1
+            self.busy_time += duration
+            self.jobname = None
+            self.busy_since = None
+            return duration
+        return None
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        self.conn.close()
+
+
+class WorkerPool(object):
+    """A fixed number of persistent worker processes.
+
+    Workers are replaced when they exit, either because they have handled
+    max_tasks workitems or because they died. How many workers may handle
+    each class of workitem at once is limited separately.
+    """
+
+    def __init__(self, size, max_tasks):
+        self.max_tasks = max_tasks
+        self.workers = [Worker(slot, max_tasks) for slot in range(size)]
+        self.limits = {name: ConcurrencyLimit(name, size)
+                       for name in TASK_CLASS_SIGNALS}
+        self.pressure = {}
+        self.fetches = FetchCoordinator()
+        self.preflights = {outcome: 0 for outcome in
+                           ['confirmed', 'placed', 'redirected', 'failed']}
+        self.recycled = 0
+        self.crashed = 0
+
+    def reap(self):
+        for w in self.workers:
+            cls = w.task_class
+            jobname = w.jobname
+            duration = w.collect()
+
+            for kind, detail in w.progress:
+                if kind == 'fetched':
+                    self.fetches.fetched(detail)
+                elif kind == 'preflight':
+                    self.preflights[detail] += 1
+            w.progress = []
+
+            if duration is not None:
+                self.limits[cls].finished(duration)
+                self.fetches.finished(jobname)
+            if w.process.is_alive():
+                continue
+
+            if w.jobname:
+                # The workitem stays in processing, and is retried when the
+                # queues are restarted
+                LOG.withField('workitem', w.jobname).error(
+                    'Queue worker died while handling workitem')
+                self.limits[cls].finished()
+                self.fetches.finished(w.jobname)
+                self.crashed += 1
+            else:
+                self.recycled += 1
+
+            w.process.join(1)
+            w.conn.close()
+            self.workers[w.slot] = Worker(w.slot, self.max_tasks)
+
+    def idle_worker(self):
+        for w in self.workers:
+            if w.available():
+                return w
+        return None
+
+    def can_dispatch(self, workitem):
+        return (not self.fetches.blocked(workitem) and
+                self.limits[task_class(workitem)].has_capacity() and
+                self.idle_worker() is not None)
+
+    def dispatch(self, jobname, workitem):
+        cls = task_class(workitem)
+        self.idle_worker().dispatch(jobname, workitem, cls)
+        self.limits[cls].started()
+        self.fetches.claim(jobname, workitem)
+
+    def adjust(self, pressure):
+        self.pressure = pressure
+        for limit in self.limits.values():
+            limit.adjust(pressure)
+
+    def wait(self, timeout):
+        """Wait until a busy worker finishes, or timeout seconds pass."""
+        busy = [w.conn for w in self.workers if w.jobname]
+        if busy:
+            multiprocessing.connection.wait(busy, timeout)
+        else:
+            time.sleep(timeout)
+
+    def metrics(self):
+        now = time.time()
+        metrics = {
+            'queue_workers': len(self.workers),
+            'queue_workers_busy': len([w for w in self.workers if w.jobname]),
+            'queue_workers_recycled': self.recycled,
+            'queue_workers_crashed': self.crashed,
+            'queue_image_fetches': len(self.fetches.fetching),
+        }
+        for outcome, count in self.preflights.items():
+            metrics['queue_preflight_%s' % outcome] = count
+        for w in self.workers:
+            prefix = 'queue_worker%d_' % w.slot
+            metrics.update({
+                prefix + 'tasks': w.tasks,
+                prefix + 'age': now - w.started,
+                prefix + 'busy_seconds': now - w.busy_since if w.busy_since else 0,
+                prefix + 'utilisation': w.busy_time / max(now - w.started, 1),
+            })
+        for name, limit in self.limits.items():
+            metrics.update({
+                'queue_%s_limit' % name: limit.limit,
+                'queue_%s_running' % name: limit.running,
+                'queue_%s_latency' % name: limit.latency or 0,
+            })
+        for signal, value in self.pressure.items():
+            metrics['queue_pressure_%s' % signal] = value
+        return metrics
+
+    def close(self):
+        for w in self.workers:
+            w.stop()
+
+
 class Monitor(daemon.Daemon):
+    def __init__(self, id):
+        super(Monitor, self).__init__(id)
+        start_http_server(config.get('QUEUE_METRICS_PORT'))
+
     def run(self):
-        workers = []
         LOG.info('Starting Queues')
 
-        libvirt = util.get_libvirt()
-        conn = libvirt.open(None)
-        present_cpus, _, _ = conn.getCPUMap()
+        size = config.get('QUEUE_WORKERS')
+        if not size:
+            conn = util.get_libvirt_connection()
+            present_cpus, _, _ = conn.getCPUMap()
+            size = max(1, (present_cpus + 1) // 2)
+
+        pool = WorkerPool(size, config.get('QUEUE_WORKER_MAX_TASKS'))
+        pressure = HostPressure()
+        last_adjust = time.time()
+        last_health = 0
+        gauges = {}
+
+        # Workitems which have been dequeued, but whose class is at its
+        # concurrency limit or which need an image that is being fetched.
+        # Apart from those waiting on a fetch, there are never more of these
+        # than workers, so that the rest of the queue stays in etcd.
+        pending = []
 
         while True:
             try:
-                for w in copy.copy(workers):
-                    if not w.is_alive():
-                        w.join(1)
-                        workers.remove(w)
-
-                if len(workers) < present_cpus / 2:
+                pool.reap()
+
+                if time.time() - last_adjust > 10:
+                    pool.adjust(pressure.sample())
+                    last_adjust = time.time()
+
+                if time.time() - last_health > 5:
+                    metrics = pool.metrics()
+                    metrics['queue_pending'] = len(pending)
+                    metrics['queue_waiting_on_fetch'] = len(
+                        [w for _, w in pending if pool.fetches.blocked(w)])
+                    for metric in metrics:
+                        if metric not in gauges:
+                            gauges[metric] = Gauge(metric, '')
+                        gauges[metric].set(metrics[metric])
+                    last_health = time.time()
+
+                jobname = None
+                runnable = [w for _, w in pending
+                            if not pool.fetches.blocked(w)]
+                if len(runnable) < len(pool.workers):
                     jobname, workitem = db.dequeue(config.NODE_NAME)
-                else:
-                    workitem = None
-
-                if not workitem:
-                    time.sleep(0.2)
-                    continue
-
-                p = multiprocessing.Process(
-                    target=handle, args=(jobname, workitem,),
-                    name='%s-worker' % daemon.process_name('queues'))
-                p.start()
-                workers.append(p)
+                    if workitem:
+                        pending.append((jobname, workitem))
+
+                dispatched = False
+                for jobname_pending, workitem_pending in list(pending):
+                    if pool.can_dispatch(workitem_pending):
+                        pool.dispatch(jobname_pending, workitem_pending)
+                        pending.remove((jobname_pending, workitem_pending))
+                        dispatched = True
+
+                if not jobname and not dispatched:
+                    pool.wait(0.2)
 
             except Exception as e:
                 util.ignore_exception(daemon.process_name('queues'), e)
@@ -3,22 +3,77 @@ import psutil
 import time
 
 from prometheus_client import Gauge
+from prometheus_client import REGISTRY
 from prometheus_client import start_http_server
 
 from shakenfist.daemons import daemon
 from shakenfist.config import config
 from shakenfist import db
 from shakenfist import logutil
+from shakenfist import scheduler
 from shakenfist import util
 
 
 LOG, _ = logutil.setup(__name__)
 
 
+def _get_domain_stats(libvirt, conn):
+    """Returns statistics for each running domain, fetched in one call.
+
+    Memory is in KB and CPU time is in nanoseconds, as libvirt reports them.
+    """
+    stats = (libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+             libvirt.VIR_DOMAIN_STATS_BALLOON |
+             libvirt.VIR_DOMAIN_STATS_VCPU |
+             libvirt.VIR_DOMAIN_STATS_BLOCK |
+             libvirt.VIR_DOMAIN_STATS_INTERFACE)
+
+    domains = {}
+    for domain, record in conn.getAllDomainStats(
+            stats, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+        domain_stats = {
+            'cpu_time': record.get('cpu.time', 0),
+            'cpu_steal_time': 0,
+            'vcpus': record.get('vcpu.current', 0),
+            'memory_max': record.get('balloon.maximum', 0),
+            'memory_actual': record.get('balloon.current', 0),
+            'memory_rss': record.get('balloon.rss', 0),
+            'disk_read_bytes': 0,
+            'disk_write_bytes': 0,
+            'disk_read_ops': 0,
+            'disk_write_ops': 0,
+            'network_read_bytes': 0,
+            'network_write_bytes': 0,
+        }
+
+        # Time vCPUs spent runnable but waiting for a host CPU
+        for i in range(record.get('vcpu.maximum', 0)):
+            domain_stats['cpu_steal_time'] += record.get(
+                'vcpu.%d.delay' % i, 0)
+        for i in range(record.get('block.count', 0)):
+            domain_stats['disk_read_bytes'] += record.get(
+                'block.%d.rd.bytes' % i, 0)
+            domain_stats['disk_write_bytes'] += record.get(
+                'block.%d.wr.bytes' % i, 0)
+            domain_stats['disk_read_ops'] += record.get(
+                'block.%d.rd.reqs' % i, 0)
+            domain_stats['disk_write_ops'] += record.get(
+                'block.%d.wr.reqs' % i, 0)
+        for i in range(record.get('net.count', 0)):
+            domain_stats['network_read_bytes'] += record.get(
+                'net.%d.rx.bytes' % i, 0)
+            domain_stats['network_write_bytes'] += record.get(
+                'net.%d.tx.bytes' % i, 0)
+
+        domains[domain.name()] = domain_stats
+    return domains
+
+
 def _get_stats():
+    """Returns node metrics, and the uuids of instances running here."""
     libvirt = util.get_libvirt()
     retval = {}
-    conn = libvirt.open(None)
+    conn = util.get_libvirt_connection()
 
     # CPU info
     present_cpus, _, available_cpus = conn.getCPUMap()
@@ -29,6 +84,24 @@ def _get_stats():
 
     retval['cpu_max_per_instance'] = conn.getMaxVcpus(None)
 
+    # NUMA cells, so that the scheduler can fit an instance into one cell. CPUs
+    # which dedicated instances are pinned to are not available to others.
+    pinned_cpus = util.get_pinned_cpus(conn)
+    cells = util.get_numa_topology(conn)
+    retval['cpu_pinned'] = len(pinned_cpus)
+    retval['numa_cells'] = len(cells)
+    for i, cell_id in enumerate(sorted(cells)):
+        cell = cells[cell_id]
+        retval.update({
+            'numa_cell%d_cpu_max' % i: len(cell['cpus']),
+            'numa_cell%d_cpu_available' % i: len(set(cell['cpus']) - pinned_cpus),
+            'numa_cell%d_memory_max' % i: cell['memory_max'],
+            'numa_cell%d_memory_available' % i: cell['memory_available'],
+        })
+        for name, size_kb in util.HUGEPAGE_SIZES.items():
+            retval['numa_cell%d_hugepages_%s_free' % (i, name.lower())] = \
+                cell['hugepages'].get(size_kb, {}).get('free', 0)
+
     # This is disabled as data we don't currently use
     # for i in range(present_cpus):
     #    per_cpu_stats = conn.getCPUStats(i)
@@ -60,6 +133,16 @@ def _get_stats():
         'memory_available_libvirt': memory_status['free'] // 1024,
     })
 
+    # Hugepages are allocated up front and can't be overcommitted, so they are
+    # reported separately from other memory, in MB
+    hugepages = util.get_hugepages('/sys/kernel/mm/hugepages')
+    for name, size_kb in util.HUGEPAGE_SIZES.items():
+        pages = hugepages.get(size_kb, {})
+        retval.update({
+            'memory_hugepages_%s_total' % name.lower(): pages.get('total', 0),
+            'memory_hugepages_%s_free' % name.lower(): pages.get('free', 0),
+        })
+
     # Kernel Shared Memory (KSM) information
     ksm_details = {}
     for ent in os.listdir('/sys/kernel/mm/ksm'):
@@ -92,24 +175,24 @@ def _get_stats():
     total_instance_actual_memory = 0
     total_instance_vcpus = 0
     total_instance_cpu_time = 0
+    running_instance_uuids = []
 
-    for guest in conn.listAllDomains():
-        try:
-            active = guest.isActive() == 1
-            if active:
-                _, maxmem, mem, cpus, cpu_time = guest.info()
-
-        except libvirt.libvirtError as e:
-            LOG.debug('During resource calc ignored libvirt error: %s' % e)
-            active = False
-
-        if active:
-            total_instances += 1
-            total_active_instances += 1
-            total_instance_max_memory += maxmem
-            total_instance_actual_memory += mem
-            total_instance_vcpus += cpus
-            total_instance_cpu_time += cpu_time
+    try:
+        domains = _get_domain_stats(libvirt, conn)
+    except libvirt.libvirtError as e:
+        LOG.debug('During resource calc ignored libvirt error: %s' % e)
+        domains = {}
+
+    for name, domain_stats in domains.items():
+        total_instances += 1
+        total_active_instances += 1
+        total_instance_max_memory += domain_stats['memory_max']
+        total_instance_actual_memory += domain_stats['memory_actual']
+        total_instance_vcpus += domain_stats['vcpus']
+        total_instance_cpu_time += domain_stats['cpu_time']
+
+        if name.startswith('sf:'):
+            running_instance_uuids.append(name[3:])
 
     # Queue health statistics
     node_queue_processing, node_queue_waiting = db.get_queue_length(
@@ -135,7 +218,142 @@ def _get_stats():
             'network_queue_waiting': network_queue_waiting,
         })
 
-    return retval
+    return retval, running_instance_uuids
+
+
+class InstanceMetrics(object):
+    """Per-instance gauges, labelled with the instance uuid and namespace.
+
+    To bound the number of label sets Prometheus has to store, only the
+    INSTANCE_METRICS_MAX busiest instances by CPU time are exported, and the
+    label sets of instances which are no longer exported are removed.
+    """
+
+    # Statistic name, gauge name, description
+    METRICS = [
+        ('cpu_time', 'instance_cpu_time_ns', 'CPU time used'),
+        ('cpu_steal_time', 'instance_cpu_steal_time_ns',
+         'Time vCPUs waited for a host CPU'),
+        ('vcpus', 'instance_vcpus', 'Number of vCPUs'),
+        ('memory_actual', 'instance_memory_balloon_kb',
+         'Memory currently assigned by the balloon'),
+        ('memory_max', 'instance_memory_max_kb', 'Maximum memory'),
+        ('memory_rss', 'instance_memory_rss_kb',
+         'Host memory used by the instance'),
+        ('disk_read_bytes', 'instance_disk_read_bytes', 'Bytes read'),
+        ('disk_write_bytes', 'instance_disk_write_bytes', 'Bytes written'),
+        ('disk_read_ops', 'instance_disk_read_ops', 'Read requests'),
+        ('disk_write_ops', 'instance_disk_write_ops', 'Write requests'),
+        ('network_read_bytes', 'instance_network_read_bytes',
+         'Bytes received'),
+        ('network_write_bytes', 'instance_network_write_bytes',
+         'Bytes sent'),
+    ]
+
+    def __init__(self, registry=REGISTRY):
+        self.gauges = {}
+        for stat, name, description in self.METRICS:
+            self.gauges[stat] = Gauge(name, description,
+                                      ['instance', 'namespace'],
+                                      registry=registry)
+
+        # Label sets currently exported, by instance uuid
+        self.exported = {}
+
+    def _namespace(self, instance_uuid):
+        if instance_uuid in self.exported:
+            return self.exported[instance_uuid][1]
+
+        i = db.get_instance(instance_uuid)
+        if not i:
+            return None
+        return i.get('namespace') or ''
+
+    def update(self, domains):
+        instances = {}
+        for name, domain_stats in domains.items():
+            if name.startswith('sf:'):
+                instances[name[3:]] = domain_stats
+
+        busiest = sorted(instances, key=lambda u: instances[u]['cpu_time'],
+                         reverse=True)[:config.get('INSTANCE_METRICS_MAX')]
+
+        exported = {}
+        for instance_uuid in busiest:
+            namespace = self._namespace(instance_uuid)
+            if namespace is None:
+                continue
+
+            labels = (instance_uuid, namespace)
+            for stat, gauge in self.gauges.items():
+                gauge.labels(*labels).set(instances[instance_uuid][stat])
+            exported[instance_uuid] = labels
+
+        for instance_uuid, labels in self.exported.items():
+            if instance_uuid not in exported:
+                for gauge in self.gauges.values():
+                    gauge.remove(*labels)
+        self.exported = exported
+
+
+class MetricsPublisher(object):
+    """Publishes the node metrics the scheduler uses to etcd.
+
+    Metrics are only published when the instances running here change, when
+    one of them changes by more than METRICS_PUBLISH_CHANGE, or when they
+    haven't been published for METRICS_PUBLISH_HEARTBEAT seconds. Everything
+    else is only exported to Prometheus.
+    """
+
+    def __init__(self):
+        self.published = None
+        self.published_instances = None
+        self.published_at = 0
+
+    @staticmethod
+    def scheduling_metrics(stats):
+        metrics = {}
+        for metric in scheduler.METRIC_COLUMNS + ['numa_cells',
+                                                  'instances_total']:
+            if metric in stats:
+                metrics[metric] = stats[metric]
+        for i in range(stats.get('numa_cells', 0)):
+            for column in scheduler.NUMA_COLUMNS:
+                metric = 'numa_cell%d_%s' % (i, column)
+                if metric in stats:
+                    metrics[metric] = stats[metric]
+        return metrics
+
+    def _changed(self, metrics):
+        if metrics.keys() != self.published.keys():
+            return True
+
+        threshold = config.get('METRICS_PUBLISH_CHANGE')
+        for metric, value in metrics.items():
+            old = self.published[metric]
+            if value == old:
+                continue
+            if not old or abs(value - old) / abs(old) > threshold:
+                return True
+        return False
+
+    def publish(self, stats, running_instance_uuids):
+        """Publish if needed. Returns True if the metrics were published."""
+        metrics = self.scheduling_metrics(stats)
+        instances = set(running_instance_uuids)
+
+        if (self.published is not None and
+                instances == self.published_instances and
+                (time.time() - self.published_at <
+                 config.get('METRICS_PUBLISH_HEARTBEAT')) and
+                not self._changed(metrics)):
+            return False
+
+        db.update_metrics_bulk(metrics)
+        self.published = metrics
+        self.published_instances = instances
+        self.published_at = time.time()
+        return True
 
 
 class Monitor(daemon.Daemon):
@@ -150,17 +368,26 @@ class Monitor(daemon.Daemon):
                   }
 
         last_metrics = 0
+        publisher = MetricsPublisher()
+        instance_metrics = InstanceMetrics()
+        last_instance_metrics = 0
 
         def update_metrics():
             global last_metrics
 
-            stats = _get_stats()
+            stats, running_instance_uuids = _get_stats()
             for metric in stats:
                 if metric not in gauges:
                     gauges[metric] = Gauge(metric, '')
                 gauges[metric].set(stats[metric])
 
-            db.update_metrics_bulk(stats)
+            publisher.publish(stats, running_instance_uuids)
+
+            # Now that the metrics include these instances, the scheduler
+            # no longer needs to account for them separately. A change in
+            # the running instances always publishes the metrics, so the
+            # published metrics include them even if we didn't publish now.
+            db.release_reservations(config.NODE_NAME, running_instance_uuids)
             gauges['updated_at'].set_to_current_time()
 
         while True:
@@ -179,5 +406,12 @@ class Monitor(daemon.Daemon):
                     update_metrics()
                     last_metrics = time.time()
 
+                timer = time.time() - last_instance_metrics
+                if (config.get('INSTANCE_METRICS_MAX') and
+                        timer > config.get('INSTANCE_METRICS_INTERVAL')):
+                    last_instance_metrics = time.time()
+                    instance_metrics.update(_get_domain_stats(
+                        util.get_libvirt(), util.get_libvirt_connection()))
+
             except Exception as e:
                 util.ignore_exception('resource statistics', e)
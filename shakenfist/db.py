@@ -1,16 +1,18 @@
 # Copyright 2020 Michael Still
 
 import copy
-import random
 import socket
 import time
 import uuid
+import zlib
 
 from shakenfist.config import config
 from shakenfist import etcd
 from shakenfist import exceptions
+from shakenfist import idmanager
 from shakenfist import ipmanager
 from shakenfist import logutil
+from shakenfist import portmanager
 from shakenfist import util
 from shakenfist.tasks import DeleteInstanceTask, ErrorInstanceTask
 
@@ -93,7 +95,15 @@ def get_network(network_uuid):
 
 
 def get_networks(all=False, namespace=None):
-    for n in etcd.get_all('network', None):
+    if namespace and namespace != 'system':
+        networks = (get_network(network_uuid) for network_uuid in
+                    _get_namespace_index('network', namespace))
+    else:
+        networks = etcd.get_all('network', None)
+
+    for n in networks:
+        if not n:
+            continue
         if n['uuid'] == 'floating':
             continue
         if not all:
@@ -105,6 +115,97 @@ def get_networks(all=False, namespace=None):
         yield n
 
 
+# Instances and networks are also indexed by namespace, so that listing the
+# objects in one namespace does not require reading every object in the
+# cluster. Entries are /sf/namespaceindex/<type>/<namespace>/<uuid>. The
+# system namespace can see everything and therefore isn't indexed.
+NAMESPACE_INDEX_BUILT = False
+
+
+def _namespace_index_subtype(objecttype, namespace):
+    return '%s/%s' % (objecttype, namespace)
+
+
+def _add_to_namespace_index(objecttype, namespace, object_uuid):
+    if not namespace:
+        return
+    etcd.put('namespaceindex', _namespace_index_subtype(objecttype, namespace),
+             object_uuid, {'uuid': object_uuid})
+
+
+def _remove_from_namespace_index(objecttype, namespace, object_uuid):
+    if not namespace:
+        return
+    etcd.delete('namespaceindex',
+                _namespace_index_subtype(objecttype, namespace), object_uuid)
+
+
+def _build_namespace_index():
+    """Index objects created before the index existed. This only happens once
+    per cluster, but we check once per process."""
+    global NAMESPACE_INDEX_BUILT
+    if NAMESPACE_INDEX_BUILT:
+        return
+
+    if not etcd.get('namespaceindex', None, 'version'):
+        for i in etcd.get_all('instance', None):
+            _add_to_namespace_index('instance', i.get('namespace'), i['uuid'])
+        for n in etcd.get_all('network', None):
+            if n['uuid'] != 'floating':
+                _add_to_namespace_index('network', n.get('namespace'),
+                                        n['uuid'])
+        etcd.put('namespaceindex', None, 'version', {'version': 1})
+
+    NAMESPACE_INDEX_BUILT = True
+
+
+def _get_namespace_index(objecttype, namespace):
+    _build_namespace_index()
+    index = etcd.get_all_dict(
+        'namespaceindex', _namespace_index_subtype(objecttype, namespace))
+    return sorted(key.split('/')[-1] for key in index)
+
+
+VXLAN_ID_FIRST = 1
+VXLAN_ID_LAST = 2 ** 24 - 1
+
+
+def _get_vxid_pool():
+    d, revision = etcd.get_with_revision('allocator', None, 'vxlan')
+    if d:
+        return idmanager.from_db(d), revision
+
+    # Seed the pool from the per-id keys written by older releases
+    pool = idmanager.IdPool(VXLAN_ID_FIRST, VXLAN_ID_LAST)
+    pool.reserve_existing(
+        [int(key.split('/')[-1]) for key in etcd.get_all_dict('vxlan')])
+    return pool, revision
+
+
+def _allocate_vxid(network_uuid):
+    while True:
+        pool, revision = _get_vxid_pool()
+        vxid = pool.get_free_id()
+        if vxid is None:
+            raise exceptions.IdAllocationException('No free VXLAN ids')
+
+        if etcd.compare_and_swap(
+                'allocator', None, 'vxlan', revision, pool.save(),
+                also_put=[('vxlan', None, vxid,
+                           {'network_uuid': network_uuid})]):
+            return vxid
+
+
+def _release_vxid(vxid):
+    while True:
+        pool, revision = _get_vxid_pool()
+        pool.release(vxid)
+        if etcd.compare_and_swap(
+                'allocator', None, 'vxlan', revision, pool.save(),
+                also_delete=[('vxlan', None, vxid)]):
+            return
+
+
 def allocate_network(netblock, provide_dhcp=True, provide_nat=False, name=None,
                      namespace=None):
 
@@ -112,9 +213,7 @@ def allocate_network(netblock, provide_dhcp=True, provide_nat=False, name=None,
     ipm = ipmanager.NetBlock(netblock)
     etcd.put('ipmanager', None, net_id, ipm.save())
 
-    vxid = 1
-    while not etcd.create('vxlan', None, vxid, {'network_uuid': net_id}):
-        vxid += 1
+    vxid = _allocate_vxid(net_id)
 
     d = {
         'uuid': net_id,
@@ -129,6 +228,7 @@ def allocate_network(netblock, provide_dhcp=True, provide_nat=False, name=None,
         'state_updated': time.time()
     }
     etcd.put('network', None, net_id, d)
+    _add_to_namespace_index('network', namespace, net_id)
     return d
 
 
@@ -139,7 +239,7 @@ def update_network_state(network_uuid, state):
     etcd.put('network', None, network_uuid, n)
 
     if state == 'deleted':
-        etcd.delete('vxlan', None, n['vxid'])
+        _release_vxid(n['vxid'])
         etcd.delete('ipmanager', None, n['uuid'])
 
 
@@ -151,6 +251,10 @@ def get_stale_networks(delay):
 
 
 def hard_delete_network(network_uuid):
+    n = get_network(network_uuid)
+    if n:
+        _remove_from_namespace_index('network', n.get('namespace'),
+                                     network_uuid)
     etcd.delete('network', None, network_uuid)
     etcd.delete_all('event/network', network_uuid)
     delete_metadata('network', network_uuid)
@@ -191,10 +295,25 @@ def persist_floating_gateway(network_uuid, gateway):
     etcd.put('network', None, network_uuid, n)
 
 
-def get_instance(instance_uuid):
-    i = etcd.get('instance', None, instance_uuid)
-    if not i:
-        return None
+# Fields which change often during an instance's life are kept in a small
+# record of their own, so that updating them does not rewrite the instance's
+# specification (which includes things like user data) into etcd history.
+INSTANCE_STATE_FIELDS = [
+    'node',
+    'state',
+    'state_updated',
+    'power_state',
+    'power_state_previous',
+    'power_state_updated',
+    'placement_attempts',
+    'error_message',
+    'enforced_deletes',
+]
+
+
+def _compose_instance(i, state):
+    if state:
+        i.update(state)
 
     if 'video' not in i:
         i['video'] = {'model': 'cirrus', 'memory': 16384}
@@ -203,8 +322,49 @@ def get_instance(instance_uuid):
     return i
 
 
+def _split_instance_state(i):
+    return {k: i[k] for k in INSTANCE_STATE_FIELDS if k in i}
+
+
+def get_instance(instance_uuid):
+    i = etcd.get('instance', None, instance_uuid)
+    if not i:
+        return None
+    return _compose_instance(i, etcd.get('instancestate', None, instance_uuid))
+
+
+def get_instance_state(instance_uuid):
+    """Fetch only the frequently changing fields of an instance."""
+    state = etcd.get('instancestate', None, instance_uuid)
+    if state:
+        return state
+
+    # Instances created by older releases have no separate state record
+    i = etcd.get('instance', None, instance_uuid)
+    if not i:
+        return None
+    return _split_instance_state(i)
+
+
+def _persist_instance_state(instance_uuid, state):
+    etcd.put('instancestate', None, instance_uuid, state)
+
+
 def get_instances(only_node=None, all=False, namespace=None):
-    for i in etcd.get_all('instance', None):
+    if namespace and namespace != 'system':
+        instances = (get_instance(instance_uuid) for instance_uuid in
+                     _get_namespace_index('instance', namespace))
+    else:
+        states = {}
+        for key, state in etcd.get_all_dict('instancestate').items():
+            states[key.split('/')[-1]] = state
+
+        instances = (_compose_instance(i, states.get(i['uuid']))
+                     for i in etcd.get_all('instance', None))
+
+    for i in instances:
+        if not i:
+            continue
         if only_node and i['node'] != only_node:
             continue
         if not all:
@@ -214,31 +374,34 @@ def get_instances(only_node=None, all=False, namespace=None):
             if namespace not in [i['namespace'], 'system']:
                 continue
 
-        if 'video' not in i:
-            i['video'] = {'model': 'cirrus', 'memory': 16384}
-        if 'error_message' not in i:
-            i['error_message'] = None
-
         yield i
 
 
+def _update_instance(instance_uuid, changes):
+    """Update fields of an instance without losing concurrent updates to
+    other fields, as steps of an instance start run at the same time."""
+    while True:
+        i, revision = etcd.get_with_revision('instance', None, instance_uuid)
+        if not i:
+            # The instance was deleted while it was starting
+            return
+        i.update(changes)
+        if etcd.compare_and_swap('instance', None, instance_uuid, revision, i):
+            return
+
+
 def persist_block_devices(instance_uuid, block_devices):
-    i = get_instance(instance_uuid)
-    i['block_devices'] = block_devices
-    etcd.put('instance', None, instance_uuid, i)
+    _update_instance(instance_uuid, {'block_devices': block_devices})
 
 
 def persist_console_ports(instance_uuid, console_port, vdi_port):
-    # TODO(andy): When Instance class is modified to model Image class this
-    # repetitive write will be moved to a single persist() function.
-    i = get_instance(instance_uuid)
-    i['console_port'] = console_port
-    i['vdi_port'] = vdi_port
-    etcd.put('instance', None, instance_uuid, i)
+    _update_instance(instance_uuid, {'console_port': console_port,
+                                     'vdi_port': vdi_port})
 
 
 def create_instance(instance_uuid, name, cpus, memory_mb, disk_spec, ssh_key,
-                    user_data, namespace, video, requested_placement):
+                    user_data, namespace, video, requested_placement,
+                    cpu_policy=None, hugepages=None):
     d = {
         'uuid': instance_uuid,
         'name': name,
@@ -246,112 +409,214 @@ def create_instance(instance_uuid, name, cpus, memory_mb, disk_spec, ssh_key,
         'memory': memory_mb,
         'disk_spec': disk_spec,
         'ssh_key': ssh_key,
-        'node': config.NODE_NAME,
         'console_port': 0,
         'vdi_port': 0,
         'user_data': user_data,
         'block_devices': None,
-        'state': 'initial',
-        'state_updated': time.time(),
         'namespace': namespace,
-        'power_state': 'initial',
         'video': video,
         'node_history': [],
-        'error_message': None,
         'requested_placement': None,
+        'cpu_policy': cpu_policy or 'shared',
+        'hugepages': hugepages,
+    }
+    state = {
+        'node': config.NODE_NAME,
+        'state': 'initial',
+        'state_updated': time.time(),
+        'power_state': 'initial',
+        'error_message': None,
         'placement_attempts': 0,
     }
     etcd.put('instance', None, instance_uuid, d)
-    return d
+    _persist_instance_state(instance_uuid, state)
+    _add_to_namespace_index('instance', namespace, instance_uuid)
+    return _compose_instance(copy.copy(d), state)
 
 
 def place_instance(instance_uuid, node):
-    i = get_instance(instance_uuid)
+    s = get_instance_state(instance_uuid)
 
     # We don't write unchanged things to the database
-    if i.get('node') == node:
+    if s.get('node') == node:
         return
 
-    i['node'] = node
-    i['placement_attempts'] = i.get('placement_attempts', 0) + 1
-    etcd.put('instance', None, instance_uuid, i)
+    s['node'] = node
+    s['placement_attempts'] = s.get('placement_attempts', 0) + 1
+    _persist_instance_state(instance_uuid, s)
 
 
 def instance_enforced_deletes_increment(instance_uuid):
-    i = get_instance(instance_uuid)
-    i['enforced_deletes'] = i.get('enforced_deletes', 0) + 1
-    etcd.put('instance', None, instance_uuid, i)
+    s = get_instance_state(instance_uuid)
+    s['enforced_deletes'] = s.get('enforced_deletes', 0) + 1
+    _persist_instance_state(instance_uuid, s)
 
 
 def update_instance_state(instance_uuid, state):
-    i = get_instance(instance_uuid)
-    if not i:
+    s = get_instance_state(instance_uuid)
+    if not s:
         LOG.withField('instance_uuid', instance_uuid).error(
             'update_instance_state() Instance does not exist')
         return
 
     # We don't write unchanged things to the database
-    if i.get('state') == state:
+    if s.get('state') == state:
         return
 
-    orig_state = i.get('state', 'unknown')
-    i['state'] = state
-    i['state_updated'] = time.time()
-    etcd.put('instance', None, instance_uuid, i)
+    orig_state = s.get('state', 'unknown')
+    s['state'] = state
+    s['state_updated'] = time.time()
+    _persist_instance_state(instance_uuid, s)
+
+    # An instance which will never run shouldn't hold resources
+    if state in ['deleted', 'error'] and s.get('node'):
+        release_reservation(s['node'], instance_uuid)
 
     add_event('instance', instance_uuid, 'state changed',
               '%s -> %s' % (orig_state, state), None, None)
 
 
 def update_instance_power_state(instance_uuid, state):
-    i = get_instance(instance_uuid)
+    s = get_instance_state(instance_uuid)
 
     # We don't write unchanged things to the database
-    if i.get('power_state') == state:
+    if s.get('power_state') == state:
         return
 
     # If we are in transition, and its new, then we might
     # not want to update just yet
-    state_age = time.time() - i.get('power_state_updated', 0)
-    if (i.get('power_state', '').startswith('transition-to-') and
-            i.get('power_state_previous') == state and state_age < 70):
+    state_age = time.time() - s.get('power_state_updated', 0)
+    if (s.get('power_state', '').startswith('transition-to-') and
+            s.get('power_state_previous') == state and state_age < 70):
         return
 
-    i['power_state_previous'] = i.get('power_state', 'unknown')
-    i['power_state'] = state
-    i['power_state_updated'] = time.time()
-    etcd.put('instance', None, instance_uuid, i)
+    s['power_state_previous'] = s.get('power_state', 'unknown')
+    s['power_state'] = state
+    s['power_state_updated'] = time.time()
+    _persist_instance_state(instance_uuid, s)
 
 
 def update_instance_error_message(instance_uuid, error_message):
-    i = get_instance(instance_uuid)
-    i['error_message'] = error_message
-    etcd.put('instance', None, instance_uuid, i)
+    s = get_instance_state(instance_uuid)
+    s['error_message'] = error_message
+    _persist_instance_state(instance_uuid, s)
 
     add_event('instance', instance_uuid, 'error message',
               error_message, None, None)
 
 
 def hard_delete_instance(instance_uuid):
+    i = get_instance(instance_uuid)
+    if i:
+        _remove_from_namespace_index('instance', i.get('namespace'),
+                                     instance_uuid)
+        if i.get('node'):
+            _remove_from_network_users_index(i['node'], instance_uuid)
     etcd.delete('instance', None, instance_uuid)
+    etcd.delete('instancestate', None, instance_uuid)
     etcd.delete_all('event/instance', instance_uuid)
     delete_metadata('instance', instance_uuid)
 
 
 def get_stale_instances(delay):
-    for i in etcd.get_all('instance', None):
+    for i in get_instances(all=True):
         if i['state'] in ['deleted', 'error']:
             if time.time() - i['state_updated'] > delay:
                 yield i
 
 
+# MAC addresses are allocated from 02:00:00:00:00:00 to 02:00:00:ff:ff:ff.
+# That space is split into blocks, each of which is a separate pool record
+# so that no one record grows too large. Each node prefers a different
+# block so that API servers on different nodes rarely contend.
+MAC_PREFIX = '02:00:00:'
+MAC_BLOCK_SIZE = 4096
+MAC_BLOCK_COUNT = 2 ** 24 // MAC_BLOCK_SIZE
+MAC_BLOCK = None
+
+
+def _macaddr_to_id(macaddr):
+    if not macaddr.startswith(MAC_PREFIX):
+        return None
+    return int(macaddr[len(MAC_PREFIX):].replace(':', ''), 16)
+
+
+def _id_to_macaddr(id):
+    return '%s%02x:%02x:%02x' % (MAC_PREFIX, (id >> 16) & 0xff,
+                                 (id >> 8) & 0xff, id & 0xff)
+
+
+def _get_mac_pool(block):
+    d, revision = etcd.get_with_revision('allocator', 'macaddress', block)
+    if d:
+        return idmanager.from_db(d), revision
+
+    # Seed the pool from randomly allocated addresses from older releases.
+    # A block is exactly those addresses sharing the first three hex digits.
+    first = block * MAC_BLOCK_SIZE
+    pool = idmanager.IdPool(first, first + MAC_BLOCK_SIZE - 1)
+    prefix = _id_to_macaddr(first)[:len(MAC_PREFIX) + 4]
+    pool.reserve_existing(
+        [_macaddr_to_id(key.split('/')[-1])
+         for key in etcd.get_all_dict('macaddress', prefix=prefix)])
+    return pool, revision
+
+
+def allocate_macaddresses(interface_uuids):
+    """Allocate a MAC address for each interface in one transaction."""
+    global MAC_BLOCK
+
+    if MAC_BLOCK is None:
+        MAC_BLOCK = zlib.crc32(config.NODE_NAME.encode()) % MAC_BLOCK_COUNT
+
+    for attempt in range(MAC_BLOCK_COUNT):
+        block = (MAC_BLOCK + attempt) % MAC_BLOCK_COUNT
+
+        while True:
+            pool, revision = _get_mac_pool(block)
+            ids = pool.get_free_ids(len(interface_uuids))
+            if len(ids) < len(interface_uuids):
+                # This block is full, move on to the next one
+                break
+
+            macaddrs = [_id_to_macaddr(id) for id in ids]
+            if etcd.compare_and_swap(
+                    'allocator', 'macaddress', block, revision, pool.save(),
+                    also_put=[('macaddress', None, macaddr,
+                               {'interface_uuid': interface_uuid})
+                              for macaddr, interface_uuid
+                              in zip(macaddrs, interface_uuids)]):
+                MAC_BLOCK = block
+                return macaddrs
+
+    raise exceptions.IdAllocationException('No free MAC addresses')
+
+
+def _release_macaddress(macaddr, interface_uuid):
+    # Addresses supplied by the user were never allocated, and must not be
+    # freed for the allocator to hand out while they may still be in use
+    allocation = etcd.get('macaddress', None, macaddr)
+    if not allocation or allocation.get('interface_uuid') != interface_uuid:
+        return
+
+    id = _macaddr_to_id(macaddr)
+    if id is None:
+        etcd.delete('macaddress', None, macaddr)
+        return
+
+    block = id // MAC_BLOCK_SIZE
+    while True:
+        pool, revision = _get_mac_pool(block)
+        pool.release(id)
+        if etcd.compare_and_swap(
+                'allocator', 'macaddress', block, revision, pool.save(),
+                also_delete=[('macaddress', None, macaddr)]):
+            return
+
+
 def create_network_interface(interface_uuid, netdesc, instance_uuid, order):
     if 'macaddress' not in netdesc or not netdesc['macaddress']:
-        possible_mac = util.random_macaddr()
-        mac_iface = {'interface_uuid': interface_uuid}
-        while not etcd.create('macaddress', None, possible_mac, mac_iface):
-            possible_mac = util.random_macaddr()
-        netdesc['macaddress'] = possible_mac
+        netdesc['macaddress'] = allocate_macaddresses([interface_uuid])[0]
 
     etcd.put('networkinterface', None, interface_uuid,
              {
@@ -388,6 +653,13 @@ def get_instance_interfaces(instance_uuid):
             yield ni
 
 
+def get_all_network_interfaces():
+    for ni in etcd.get_all('networkinterface', None):
+        if ni['state'] == 'deleted':
+            continue
+        yield ni
+
+
 def get_network_interfaces(network_uuid):
     for ni in etcd.get_all('networkinterface', None):
         if ni['state'] == 'deleted':
@@ -396,6 +668,63 @@ def get_network_interfaces(network_uuid):
             yield ni
 
 
+# Which instances on a node use each network, so that deleting an instance can
+# tell whether the network is still needed on that node without reading every
+# interface in the cluster. Entries are
+# /sf/networkusers/<node>/<network>/<instance>, and are written by the node
+# itself as instances start and are deleted.
+NETWORK_USERS_INDEX_BUILT = False
+
+
+def _build_network_users_index():
+    """Index the instances on this node which started before the index
+    existed. This only happens once per node, but we check once per process."""
+    global NETWORK_USERS_INDEX_BUILT
+    if NETWORK_USERS_INDEX_BUILT:
+        return
+
+    if not etcd.get('networkusers', config.NODE_NAME, 'version'):
+        for i in get_instances(only_node=config.NODE_NAME):
+            for iface in get_instance_interfaces(i['uuid']):
+                etcd.put('networkusers',
+                         '%s/%s' % (config.NODE_NAME, iface['network_uuid']),
+                         i['uuid'], {'uuid': i['uuid']})
+        etcd.put('networkusers', config.NODE_NAME, 'version', {'version': 1})
+
+    NETWORK_USERS_INDEX_BUILT = True
+
+
+def add_network_users(instance_uuid, network_uuids):
+    _build_network_users_index()
+    for network_uuid in set(network_uuids):
+        etcd.put('networkusers', '%s/%s' % (config.NODE_NAME, network_uuid),
+                 instance_uuid, {'uuid': instance_uuid})
+
+
+def remove_network_users(instance_uuid, network_uuids):
+    _build_network_users_index()
+    for network_uuid in set(network_uuids):
+        etcd.delete('networkusers', '%s/%s' % (config.NODE_NAME, network_uuid),
+                    instance_uuid)
+
+
+def _remove_from_network_users_index(node, instance_uuid):
+    """Remove any entries for an instance from a node's index, for example
+    because a failed start left them behind."""
+    for key in etcd.get_all_dict('networkusers', node):
+        network_uuid, user = key.split('/')[-2:]
+        if user == instance_uuid:
+            etcd.delete('networkusers', '%s/%s' % (node, network_uuid),
+                        instance_uuid)
+
+
+def is_network_used(network_uuid):
+    """Is the network used by any instance on this node?"""
+    _build_network_users_index()
+    return len(etcd.get_all_dict(
+        'networkusers', '%s/%s' % (config.NODE_NAME, network_uuid))) > 0
+
+
 def get_interface(interface_uuid):
     return etcd.get('networkinterface', None, interface_uuid)
 
@@ -407,7 +736,7 @@ def update_network_interface_state(interface_uuid, state):
     etcd.put('networkinterface', None, interface_uuid, ni)
 
     if state == 'deleted':
-        etcd.delete('macaddress', None, ni['macaddr'])
+        _release_macaddress(ni['macaddr'], interface_uuid)
 
 
 def add_floating_to_interface(interface_uuid, addr):
@@ -488,37 +817,133 @@ def get_metrics(fqdn):
     return d.get('metrics', {})
 
 
-def allocate_console_port(instance_uuid):
+def get_all_metrics():
+    """Return the metrics of every node, keyed by node."""
+    metrics = {}
+    for key, d in etcd.get_all_dict('metrics').items():
+        metrics[key.rstrip('/').split('/')[-1]] = d.get('metrics', {})
+    return metrics
+
+
+# Resources for instances which have been placed on a node but are not yet
+# running there. Node metrics don't include these instances until they boot,
+# so the scheduler subtracts them itself. Reservations are released when the
+# node reports the instance as running, or when they expire.
+def add_reservation(node, instance_uuid, cpus, memory, disk, hugepages=None,
+                    token=None):
+    """Reserve resources on node. hugepages maps hugepages_<size> to MB.
+
+    token identifies this particular reservation, so that the node can later
+    tell whether it still holds.
+    """
+    r = {
+        'instance_uuid': instance_uuid,
+        'cpus': cpus,
+        'memory': memory,
+        'disk': disk,
+        'token': token,
+        'expires': (time.time() +
+                    config.get('SCHEDULER_RESERVATION_TIMEOUT')),
+    }
+    r.update(hugepages or {})
+    etcd.put('reservation', node, instance_uuid, r)
+
+
+def get_reservations():
+    """Return unexpired reservations, keyed by node and instance uuid."""
+    reservations = {}
+    now = time.time()
+    for key, r in etcd.get_all_dict('reservation').items():
+        if r['expires'] < now:
+            continue
+        node = key.split('/')[-2]
+        reservations.setdefault(node, {})[r['instance_uuid']] = r
+    return reservations
+
+
+def release_reservation(node, instance_uuid):
+    etcd.delete('reservation', node, instance_uuid)
+
+
+def release_reservations(node, running_instance_uuids):
+    """Release reservations which node metrics now account for."""
+    now = time.time()
+    for r in etcd.get_all('reservation', node):
+        if r['instance_uuid'] in running_instance_uuids or r['expires'] < now:
+            release_reservation(node, r['instance_uuid'])
+
+
+CONSOLE_PORT_FIRST = 30000
+CONSOLE_PORT_LAST = 50000
+
+
+def _get_console_ports(node):
+    d, revision = etcd.get_with_revision('consoleports', None, node)
+    if d:
+        return portmanager.from_db(d), revision
+
+    # Seed the bitmap from the per-port keys used by older releases
+    pb = portmanager.PortBlock(CONSOLE_PORT_FIRST, CONSOLE_PORT_LAST)
+    for value in etcd.get_all('console', node):
+        pb.reserve(value['port'])
+    return pb, revision
+
+
+def allocate_console_ports(instance_uuid, count=2):
+    """Allocate count ports on this node, by default console and VDI."""
     node = config.NODE_NAME
-    consumed = {value['port'] for value in etcd.get_all('console', node)}
+    log_ctx = LOG.withField('instance', instance_uuid)
+
     while True:
-        port = random.randint(30000, 50000)
-        # avoid hitting etcd if it's probably in use
-        if port in consumed:
-            continue
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        pb, revision = _get_console_ports(node)
+        ports = []
+        unusable = []
+        sockets = []
+
         try:
-            # We hold this port open until it's in etcd to prevent
-            # anyone else needing to hit etcd to find out they can't
-            # use it as well as to verify we can use it
-            s.bind(('0.0.0.0', port))
-            allocatedPort = etcd.create(
-                'console', node, port,
-                {
-                    'instance_uuid': instance_uuid,
-                    'port': port,
-                })
-            if allocatedPort:
-                return port
-        except socket.error as e:
-            LOG.withField('instance', instance_uuid).info(
-                "Exception during port allocation: %s" % e)
+            while len(ports) < count:
+                port = pb.get_free_port()
+                if not port:
+                    raise exceptions.PortAllocationException(
+                        'No free console ports on %s' % node)
+
+                # We hold the port open until it is recorded in etcd to
+                # verify that nothing outside of Shaken Fist is using it
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sockets.append(s)
+                try:
+                    s.bind(('0.0.0.0', port))
+                    ports.append(port)
+                except socket.error as e:
+                    log_ctx.info('Exception during port allocation: %s' % e)
+                    unusable.append(port)
+
+            # Ports we could not bind are only skipped for this allocation,
+            # we don't want to leak them forever
+            for port in unusable:
+                pb.release(port)
+
+            if etcd.compare_and_swap('consoleports', None, node, revision,
+                                     pb.save()):
+                return ports
+
+            log_ctx.info('Console port allocation raced, retrying')
         finally:
-            s.close()
+            for s in sockets:
+                s.close()
 
 
-def free_console_port(port):
-    etcd.delete('console', config.NODE_NAME, port)
+def free_console_ports(ports):
+    node = config.NODE_NAME
+    while True:
+        pb, revision = _get_console_ports(node)
+        for port in ports:
+            pb.release(port)
+
+        if etcd.compare_and_swap(
+                'consoleports', None, node, revision, pb.save(),
+                also_delete=[('console', node, port) for port in ports]):
+            return
 
 
 def list_namespaces():
@@ -5,11 +5,13 @@ import time
 
 from etcd3gw.client import Etcd3Client
 from etcd3gw.lock import Lock
+from etcd3gw.utils import _encode
 
 from shakenfist.config import config
 from shakenfist import db
 from shakenfist import exceptions
 from shakenfist import logutil
+from shakenfist import tracing
 from shakenfist import util
 from shakenfist.tasks import QueueTask
 
@@ -24,6 +26,25 @@ LOG, _ = logutil.setup(__name__)
 
 LOCK_PREFIX = '/sflocks'
 
+CLIENT = None
+CLIENT_PID = None
+
+
+def get_client():
+    """Return the etcd client for this process.
+
+    Reusing one client keeps its HTTP session, and the etcd API version it
+    discovered, warm between calls. A forked child must not share its
+    parent's session, so it makes a client of its own.
+    """
+    global CLIENT
+    global CLIENT_PID
+
+    if not CLIENT or CLIENT_PID != os.getpid():
+        CLIENT = Etcd3Client()
+        CLIENT_PID = os.getpid()
+    return CLIENT
+
 
 class ActualLock(Lock):
     def __init__(self, objecttype, subtype, name, ttl=120,
@@ -52,7 +73,7 @@ class ActualLock(Lock):
         self.key = LOCK_PREFIX + self.path
 
     def get_holder(self):
-        value = Etcd3Client().get(self.key, metadata=True)
+        value = get_client().get(self.key, metadata=True)
         if value is None or len(value) == 0:
             return None, NotImplementedError
 
@@ -63,6 +84,11 @@ class ActualLock(Lock):
         return d['node'], d['pid']
 
     def __enter__(self):
+        with tracing.Span('acquire lock', {'lock': self.path,
+                                           'operation': str(self.operation)}):
+            return self._acquire()
+
+    def _acquire(self):
         start_time = time.time()
         slow_warned = False
         threshold = int(config.get('SLOW_LOCK_THRESHOLD'))
@@ -124,7 +150,7 @@ def get_lock(objecttype, subtype, name, ttl=60, timeout=10, log_ctx=LOG,
     acquired on entry and released on exit. Note that the lock acquire process
     will have no timeout.
     """
-    return ActualLock(objecttype, subtype, name, ttl=ttl, client=Etcd3Client(),
+    return ActualLock(objecttype, subtype, name, ttl=ttl, client=get_client(),
                       log_ctx=log_ctx, timeout=timeout, op=op)
 
 
@@ -143,7 +169,7 @@ def clear_stale_locks():
     # Remove all locks held by former processes on this node. This is required
     # after an unclean restart, otherwise we need to wait for these locks to
     # timeout and that can take a long time.
-    client = Etcd3Client()
+    client = get_client()
 
     for data, metadata in client.get_prefix(
             LOCK_PREFIX + '/', sort_order='ascend', sort_target='key'):
@@ -162,7 +188,7 @@ def clear_stale_locks():
 
 def get_existing_locks():
     key_val = {}
-    for value in Etcd3Client().get_prefix(LOCK_PREFIX + '/'):
+    for value in get_client().get_prefix(LOCK_PREFIX + '/'):
         key_val[value[1]['key'].decode('utf-8')] = json.loads(value[0])
     return key_val
 
@@ -187,45 +213,133 @@ class JSONEncoderTasks(json.JSONEncoder):
 def put(objecttype, subtype, name, data, ttl=None):
     path = _construct_key(objecttype, subtype, name)
     encoded = json.dumps(data, indent=4, sort_keys=True, cls=JSONEncoderTasks)
-    Etcd3Client().put(path, encoded, lease=None)
+    get_client().put(path, encoded, lease=None)
 
 
 def create(objecttype, subtype, name, data, ttle=None):
     path = _construct_key(objecttype, subtype, name)
     encoded = json.dumps(data, indent=4, sort_keys=True, cls=JSONEncoderTasks)
-    return Etcd3Client().create(path, encoded, lease=None)
+    return get_client().create(path, encoded, lease=None)
 
 
 def get(objecttype, subtype, name):
     path = _construct_key(objecttype, subtype, name)
-    value = Etcd3Client().get(path, metadata=True)
+    value = get_client().get(path, metadata=True)
     if value is None or len(value) == 0:
         return None
     return json.loads(value[0][0])
 
 
+def get_with_revision(objecttype, subtype, name):
+    """Fetch a value and its mod revision, for use with compare_and_swap().
+
+    A key which does not exist has a revision of zero.
+    """
+    path = _construct_key(objecttype, subtype, name)
+    value = get_client().get(path, metadata=True)
+    if value is None or len(value) == 0:
+        return None, 0
+    return json.loads(value[0][0]), int(value[0][1]['mod_revision'])
+
+
+def compare_and_swap(objecttype, subtype, name, revision, data,
+                     also_put=None, also_delete=None):
+    """Write data only if the key has not changed since revision.
+
+    also_put is a list of (objecttype, subtype, name, data) tuples and
+    also_delete is a list of (objecttype, subtype, name) tuples. These are
+    applied in the same transaction, so either everything is written or
+    nothing is. Returns True if the transaction succeeded.
+    """
+    path = _construct_key(objecttype, subtype, name)
+    success = [{
+        'request_put': {
+            'key': _encode(path),
+            'value': _encode(json.dumps(data, indent=4, sort_keys=True,
+                                        cls=JSONEncoderTasks))
+        }
+    }]
+
+    for put_objecttype, put_subtype, put_name, put_data in also_put or []:
+        success.append({
+            'request_put': {
+                'key': _encode(_construct_key(put_objecttype, put_subtype,
+                                              put_name)),
+                'value': _encode(json.dumps(put_data, indent=4,
+                                            sort_keys=True,
+                                            cls=JSONEncoderTasks))
+            }
+        })
+
+    for del_objecttype, del_subtype, del_name in also_delete or []:
+        success.append({
+            'request_delete_range': {
+                'key': _encode(_construct_key(del_objecttype, del_subtype,
+                                              del_name))
+            }
+        })
+
+    result = get_client().transaction({
+        'compare': [{
+            'key': _encode(path),
+            'result': 'EQUAL',
+            'target': 'MOD',
+            'mod_revision': revision
+        }],
+        'success': success,
+        'failure': []
+    })
+    return result.get('succeeded', False)
+
+
 def get_all(objecttype, subtype, sort_order=None):
     path = _construct_key(objecttype, subtype, None)
-    for value in Etcd3Client().get_prefix(path, sort_order=sort_order):
+    for value in get_client().get_prefix(path, sort_order=sort_order):
         yield json.loads(value[0])
 
 
-def get_all_dict(objecttype, subtype=None, sort_order=None):
+def get_all_dict(objecttype, subtype=None, sort_order=None, prefix=None):
     path = _construct_key(objecttype, subtype, None)
+    if prefix:
+        path += prefix
     key_val = {}
-    for value in Etcd3Client().get_prefix(path, sort_order=sort_order):
+    for value in get_client().get_prefix(path, sort_order=sort_order):
         key_val[value[1]['key'].decode('utf-8')] = json.loads(value[0])
     return key_val
 
 
+def watch_prefix(objecttype, subtype=None):
+    """Watch for changes to keys under a prefix.
+
+    Returns an iterator of (key, value) tuples, where value is None if the
+    key was deleted, and a function which cancels the watch. The iterator
+    ends if the watch is cancelled or fails.
+    """
+    path = _construct_key(objecttype, subtype, None)
+    # A watch holds its connection open, so it gets a client of its own
+    events, cancel = Etcd3Client().watch_prefix(path)
+
+    def _changes():
+        for event in events:
+            key = event['kv']['key']
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            if event.get('type') == 'DELETE':
+                yield key, None
+            else:
+                yield key, json.loads(event['kv']['value'])
+
+    return _changes(), cancel
+
+
 def delete(objecttype, subtype, name):
     path = _construct_key(objecttype, subtype, name)
-    Etcd3Client().delete(path)
+    get_client().delete(path)
 
 
 def delete_all(objecttype, subtype, sort_order=None):
     path = _construct_key(objecttype, subtype, None)
-    Etcd3Client().delete_prefix(path)
+    get_client().delete_prefix(path)
 
 
 def enqueue(queuename, workitem):
@@ -286,7 +400,7 @@ def decodeTasks(obj):
 
 def dequeue(queuename):
     queue_path = _construct_key('queue', queuename, None)
-    client = Etcd3Client()
+    client = get_client()
 
     # We only hold the lock if there is anything in the queue
     if not client.get_prefix(queue_path):
@@ -325,7 +439,7 @@ def get_queue_length(queuename):
 def _restart_queue(queuename):
     queue_path = _construct_key('processing', queuename, None)
     with get_lock('queue', None, queuename, op='Restart'):
-        for data, metadata in Etcd3Client().get_prefix(queue_path, sort_order='ascend'):
+        for data, metadata in get_client().get_prefix(queue_path, sort_order='ascend'):
             jobname = str(metadata['key']).split('/')[-1].rstrip("'")
             workitem = json.loads(data)
             put('queue', queuename, jobname, workitem)
@@ -43,6 +43,14 @@ class BadMetadataPacket(DatabaseException):
     pass
 
 
+class PortAllocationException(DatabaseException):
+    pass
+
+
+class IdAllocationException(DatabaseException):
+    pass
+
+
 class VirtException(Exception):
     pass
 
@@ -51,6 +59,10 @@ class NoDomainException(VirtException):
     pass
 
 
+class CPUPinningException(VirtException):
+    pass
+
+
 class FlagException(Exception):
     pass
 
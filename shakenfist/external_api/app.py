@@ -20,6 +20,7 @@ from flask_jwt_extended.exceptions import (
 import flask_restful
 from flask_restful import fields
 from flask_restful import marshal_with
+import inspect
 import ipaddress
 import json
 from jwt.exceptions import DecodeError, PyJWTError
@@ -36,6 +37,7 @@ from shakenfist import exceptions
 from shakenfist import logutil
 from shakenfist import net
 from shakenfist import scheduler
+from shakenfist import tracing
 from shakenfist import util
 from shakenfist import virt
 from shakenfist.daemons import daemon
@@ -575,7 +577,9 @@ class Instance(Resource):
     @jwt_required
     @arg_is_instance_uuid
     @requires_instance_ownership
+    @tracing.traced('instance delete')
     def delete(self, instance_uuid=None, instance_from_db=None):
+        tracing.set_attribute('instance', instance_uuid)
 
         # Check if instance has already been deleted
         if instance_from_db['state'] == 'deleted':
@@ -591,7 +595,7 @@ class Instance(Resource):
 
         start_time = time.time()
         while time.time() - start_time < config.get('API_ASYNC_WAIT'):
-            i = db.get_instance(instance_uuid)
+            i = db.get_instance_state(instance_uuid)
             if i['state'] in ['deleted', 'error']:
                 return
 
@@ -600,121 +604,194 @@ class Instance(Resource):
         return
 
 
-class Instances(Resource):
-    @jwt_required
-    def get(self, all=False):
-        return list(db.get_instances(all=all, namespace=get_jwt_identity()))
+def _instance_create_prepare(name=None, cpus=None, memory=None, network=None,
+                             disk=None, ssh_key=None, user_data=None,
+                             placed_on=None, namespace=None, instance_uuid=None,
+                             video=None, cpu_policy=None, hugepages=None):
+    """Validate a request and create the instance and its interfaces.
 
-    @jwt_required
-    def post(self, name=None, cpus=None, memory=None, network=None,
-             disk=None, ssh_key=None, user_data=None, placed_on=None, namespace=None,
-             instance_uuid=None, video=None):
-        global SCHEDULER
+    Returns (instance, None) on success, or (None, error response).
+    """
+    # Check that the instance name is safe for use as a DNS host name
+    if name != re.sub(r'([^a-zA-Z0-9_\-])', '', name) or len(name) > 63:
+        return None, error(400, 'instance name must be useable as a DNS host name')
 
-        # Check that the instance name is safe for use as a DNS host name
-        if name != re.sub(r'([^a-zA-Z0-9_\-])', '', name) or len(name) > 63:
-            return error(400, 'instance name must be useable as a DNS host name')
+    # If we are placed, make sure that node exists
+    if placed_on and not db.get_node(placed_on):
+        return None, error(404, 'Specified node does not exist')
 
-        # If we are placed, make sure that node exists
-        if placed_on and not db.get_node(placed_on):
-            return error(404, 'Specified node does not exist')
+    # Sanity check
+    if not disk:
+        return None, error(400, 'instance must specify at least one disk')
+    for d in disk:
+        if not isinstance(d, dict):
+            return None, error(400, 'disk specification should contain JSON objects')
 
-        # Sanity check
-        if not disk:
-            return error(400, 'instance must specify at least one disk')
-        for d in disk:
-            if not isinstance(d, dict):
-                return error(400, 'disk specification should contain JSON objects')
+    if network:
+        for n in network:
+            if not isinstance(n, dict):
+                return None, error(
+                    400, 'network specification should contain JSON objects')
 
-        if network:
-            for n in network:
-                if not isinstance(n, dict):
-                    return error(400,
-                                 'network specification should contain JSON objects')
+            if 'network_uuid' not in n:
+                return None, error(400, 'network specification is missing network_uuid')
 
-                if 'network_uuid' not in n:
-                    return error(400, 'network specification is missing network_uuid')
+    if not video:
+        video = {'model': 'cirrus', 'memory': 16384}
 
-        if not video:
-            video = {'model': 'cirrus', 'memory': 16384}
+    if cpu_policy not in [None, 'shared', 'dedicated']:
+        return None, error(400, 'cpu_policy must be either shared or dedicated')
 
-        if not namespace:
-            namespace = get_jwt_identity()
+    if hugepages and hugepages not in util.HUGEPAGE_SIZES:
+        return None, error(400, 'hugepages must be one of %s'
+                           % ', '.join(sorted(util.HUGEPAGE_SIZES)))
 
-        # Only system can specify a uuid
-        if instance_uuid and get_jwt_identity() != 'system':
-            return error(401, 'only system can specify an instance uuid')
+    # Memory is in MB, hugepage sizes are in KB
+    if hugepages and memory and \
+            int(memory) * 1024 % util.HUGEPAGE_SIZES[hugepages] != 0:
+        return None, error(400, 'memory must be a multiple of the %s hugepage '
+                           'size' % hugepages)
 
-        # If accessing a foreign namespace, we need to be an admin
-        if get_jwt_identity() not in [namespace, 'system']:
-            return error(401,
-                         'only admins can create resources in a different namespace')
-
-        # The instance needs to exist in the DB before network interfaces are created
-        if not instance_uuid:
-            instance_uuid = str(uuid.uuid4())
-            db.add_event('instance', instance_uuid,
-                         'uuid allocated', None, None, None)
-
-        # Create instance object
-        instance = virt.from_db(instance_uuid)
-        if instance:
-            if get_jwt_identity() not in [instance.db_entry['namespace'], 'system']:
-                LOG.withField('instance', instance_uuid).info(
-                    'Instance not found, ownership test')
-                return error(404, 'instance not found')
-
-        if not instance:
-            instance = virt.from_definition(
-                uuid=instance_uuid,
-                name=name,
-                disks=disk,
-                memory_mb=memory,
-                vcpus=cpus,
-                ssh_key=ssh_key,
-                user_data=user_data,
-                owner=namespace,
-                video=video,
-                requested_placement=placed_on
-            )
+    if not namespace:
+        namespace = get_jwt_identity()
 
-        # Initialise metadata
-        db.persist_metadata('instance', instance_uuid, {})
-
-        # Allocate IP addresses
-        order = 0
-        if network:
-            for netdesc in network:
-                n = net.from_db(netdesc['network_uuid'])
-                if not n:
-                    m = 'missing network %s during IP allocation phase' % (
-                        netdesc['network_uuid'])
-                    db.enqueue_instance_error(instance_uuid, m)
-                    return error(
-                        404, 'network %s not found' % netdesc['network_uuid'])
-
-                with db.get_lock('ipmanager', None,  netdesc['network_uuid'],
-                                 ttl=120, op='Network allocate IP'):
-                    db.add_event('network', netdesc['network_uuid'], 'allocate address',
-                                 None, None, instance_uuid)
-                    ipm = db.get_ipmanager(netdesc['network_uuid'])
-                    if 'address' not in netdesc or not netdesc['address']:
-                        netdesc['address'] = ipm.get_random_free_address()
-                    else:
-                        if not ipm.reserve(netdesc['address']):
-                            m = 'failed to reserve an IP on network %s' % (
-                                netdesc['network_uuid'])
-                            db.enqueue_instance_error(instance_uuid, m)
-                            return error(409, 'address %s in use' %
-                                         netdesc['address'])
+    # Only system can specify a uuid
+    if instance_uuid and get_jwt_identity() != 'system':
+        return None, error(401, 'only system can specify an instance uuid')
+
+    # If accessing a foreign namespace, we need to be an admin
+    if get_jwt_identity() not in [namespace, 'system']:
+        return None, error(
+            401, 'only admins can create resources in a different namespace')
 
-                    db.persist_ipmanager(netdesc['network_uuid'], ipm.save())
+    # The instance needs to exist in the DB before network interfaces are created
+    if not instance_uuid:
+        instance_uuid = str(uuid.uuid4())
+        db.add_event('instance', instance_uuid,
+                     'uuid allocated', None, None, None)
+
+    # Create instance object
+    instance = virt.from_db(instance_uuid)
+    if instance:
+        if get_jwt_identity() not in [instance.db_entry['namespace'], 'system']:
+            LOG.withField('instance', instance_uuid).info(
+                'Instance not found, ownership test')
+            return None, error(404, 'instance not found')
+
+    if not instance:
+        instance = virt.from_definition(
+            uuid=instance_uuid,
+            name=name,
+            disks=disk,
+            memory_mb=memory,
+            vcpus=cpus,
+            ssh_key=ssh_key,
+            user_data=user_data,
+            owner=namespace,
+            video=video,
+            requested_placement=placed_on,
+            cpu_policy=cpu_policy,
+            hugepages=hugepages
+        )
+
+    # Initialise metadata
+    db.persist_metadata('instance', instance_uuid, {})
+
+    # Allocate IP addresses
+    order = 0
+    interfaces = []
+    if network:
+        for netdesc in network:
+            n = net.from_db(netdesc['network_uuid'])
+            if not n:
+                m = 'missing network %s during IP allocation phase' % (
+                    netdesc['network_uuid'])
+                db.enqueue_instance_error(instance_uuid, m)
+                return None, error(
+                    404, 'network %s not found' % netdesc['network_uuid'])
+
+            with db.get_lock('ipmanager', None,  netdesc['network_uuid'],
+                             ttl=120, op='Network allocate IP'):
+                db.add_event('network', netdesc['network_uuid'], 'allocate address',
+                             None, None, instance_uuid)
+                ipm = db.get_ipmanager(netdesc['network_uuid'])
+                if 'address' not in netdesc or not netdesc['address']:
+                    netdesc['address'] = ipm.get_random_free_address()
+                else:
+                    if not ipm.reserve(netdesc['address']):
+                        m = 'failed to reserve an IP on network %s' % (
+                            netdesc['network_uuid'])
+                        db.enqueue_instance_error(instance_uuid, m)
+                        return None, error(409, 'address %s in use' %
+                                           netdesc['address'])
+
+                db.persist_ipmanager(netdesc['network_uuid'], ipm.save())
+
+            if 'model' not in netdesc or not netdesc['model']:
+                netdesc['model'] = 'virtio'
+
+            interfaces.append((str(uuid.uuid4()), netdesc))
+
+    # Allocate MAC addresses for all interfaces at once
+    needs_mac = [(iface_uuid, netdesc) for iface_uuid, netdesc in interfaces
+                 if not netdesc.get('macaddress')]
+    if needs_mac:
+        macaddrs = db.allocate_macaddresses(
+            [iface_uuid for iface_uuid, _ in needs_mac])
+        for (_, netdesc), macaddr in zip(needs_mac, macaddrs):
+            netdesc['macaddress'] = macaddr
+
+    for iface_uuid, netdesc in interfaces:
+        db.create_network_interface(
+            iface_uuid, netdesc, instance_uuid, order)
+
+    return instance, None
+
+
+def _instance_create_enqueue(instance, network, placement, reservation=None):
+    instance_uuid = instance.db_entry['uuid']
+
+    # Record placement
+    db.place_instance(instance_uuid, placement)
+    db.add_event('instance', instance_uuid,
+                 'placement', None, None, placement)
+
+    # Create a queue entry for the instance start
+    tasks = [PreflightInstanceTask(instance_uuid, network, placement=placement,
+                                   reservation=reservation)]
+    for disk in instance.db_entry['block_devices']['devices']:
+        if 'base' in disk and disk['base']:
+            tasks.append(FetchImageTask(disk['base'], instance_uuid))
+    tasks.append(StartInstanceTask(instance_uuid, network))
+
+    # Enqueue creation tasks on desired node task queue
+    db.enqueue(placement, {'tasks': tasks})
+    db.add_event('instance', instance_uuid,
+                 'create', 'enqueued', None, None)
 
-                if 'model' not in netdesc or not netdesc['model']:
-                    netdesc['model'] = 'virtio'
 
-                db.create_network_interface(
-                    str(uuid.uuid4()), netdesc, instance_uuid, order)
+class Instances(Resource):
+    @jwt_required
+    def get(self, all=False):
+        return list(db.get_instances(all=all, namespace=get_jwt_identity()))
+
+    @jwt_required
+    @tracing.traced('instance create')
+    def post(self, name=None, cpus=None, memory=None, network=None,
+             disk=None, ssh_key=None, user_data=None, placed_on=None, namespace=None,
+             instance_uuid=None, video=None, cpu_policy=None,
+             hugepages=None):
+        global SCHEDULER
+
+        instance, err = _instance_create_prepare(
+            name=name, cpus=cpus, memory=memory, network=network, disk=disk,
+            ssh_key=ssh_key, user_data=user_data, placed_on=placed_on,
+            namespace=namespace, instance_uuid=instance_uuid, video=video,
+            cpu_policy=cpu_policy, hugepages=hugepages)
+        if err:
+            return err
+        instance_uuid = instance.db_entry['uuid']
+        tracing.set_attribute('instance', instance_uuid)
 
         if not SCHEDULER:
             SCHEDULER = scheduler.Scheduler()
@@ -742,22 +819,8 @@ class Instances(Resource):
             db.enqueue_instance_error(instance_uuid, 'scheduling failed')
             return error(404, 'node not found: %s' % e)
 
-        # Record placement
-        db.place_instance(instance_uuid, placement)
-        db.add_event('instance', instance_uuid,
-                     'placement', None, None, placement)
-
-        # Create a queue entry for the instance start
-        tasks = [PreflightInstanceTask(instance_uuid, network)]
-        for disk in instance.db_entry['block_devices']['devices']:
-            if 'base' in disk and disk['base']:
-                tasks.append(FetchImageTask(disk['base'], instance_uuid))
-        tasks.append(StartInstanceTask(instance_uuid, network))
-
-        # Enqueue creation tasks on desired node task queue
-        db.enqueue(placement, {'tasks': tasks})
-        db.add_event('instance', instance_uuid,
-                     'create', 'enqueued', None, None)
+        reservation = SCHEDULER.reserve(instance, placement)
+        _instance_create_enqueue(instance, network, placement, reservation)
 
         # Watch for a while and return results if things are fast, give up
         # after a while and just return the current state
@@ -812,13 +875,70 @@ class Instances(Resource):
         while (waiting_for and
                (time.time() - start_time < config.get('API_ASYNC_WAIT'))):
             for instance_uuid in copy.copy(waiting_for):
-                i = db.get_instance(instance_uuid)
+                i = db.get_instance_state(instance_uuid)
                 if i['state'] in ['deleted', 'error']:
                     waiting_for.remove(instance_uuid)
 
         return instances_del
 
 
+class InstancesBatch(Resource):
+    @jwt_required
+    @tracing.traced('instance batch create')
+    def post(self, instances=None):
+        """Create many instances, scheduling them as a single batch."""
+        global SCHEDULER
+
+        if not instances or not isinstance(instances, list):
+            return error(400, 'instances must be a list of instance specifications')
+        allowed = inspect.signature(_instance_create_prepare).parameters
+        for spec in instances:
+            if not isinstance(spec, dict):
+                return error(400, 'instance specification should contain JSON objects')
+            unknown = sorted(set(spec) - set(allowed))
+            if unknown:
+                return error(400, 'unknown instance specification fields: %s'
+                             % ', '.join(unknown))
+        tracing.set_attribute('instances', len(instances))
+
+        batch = []
+        for spec in instances:
+            instance, err = _instance_create_prepare(**spec)
+            if err:
+                for instance, _, _ in batch:
+                    db.enqueue_instance_error(instance.db_entry['uuid'],
+                                              'batch creation failed')
+                return err
+
+            placed_on = spec.get('placed_on')
+            batch.append((instance, spec.get('network'),
+                          [placed_on] if placed_on else None))
+
+        if not SCHEDULER:
+            SCHEDULER = scheduler.Scheduler()
+
+        try:
+            placements = SCHEDULER.place_instances(batch)
+
+        except (exceptions.LowResourceException,
+                exceptions.CandidateNodeNotFoundException) as e:
+            for instance, _, _ in batch:
+                db.add_event('instance', instance.db_entry['uuid'], 'schedule',
+                             'failed', None, 'batch scheduling failed: ' + str(e))
+                db.enqueue_instance_error(instance.db_entry['uuid'],
+                                          'scheduling failed')
+            if isinstance(e, exceptions.CandidateNodeNotFoundException):
+                return error(404, 'node not found: %s' % e)
+            return error(507, str(e))
+
+        for (instance, network, _), placement in zip(batch, placements):
+            reservation = SCHEDULER.reserve(instance, placement)
+            _instance_create_enqueue(instance, network, placement, reservation)
+
+        return [db.get_instance(instance.db_entry['uuid'])
+                for instance, _, _ in batch]
+
+
 class InstanceInterfaces(Resource):
     @jwt_required
     @arg_is_instance_uuid
@@ -1355,6 +1475,7 @@ api.add_resource(AuthMetadata,
                  '/auth/namespaces/<namespace>/metadata/<key>')
 
 api.add_resource(Instances, '/instances')
+api.add_resource(InstancesBatch, '/instances/batch')
 api.add_resource(Instance, '/instances/<instance_uuid>')
 api.add_resource(InstanceEvents, '/instances/<instance_uuid>/events')
 api.add_resource(InstanceInterfaces, '/instances/<instance_uuid>/interfaces')
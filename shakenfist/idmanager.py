@@ -0,0 +1,80 @@
+def from_db(d):
+    ip = IdPool(d['idmanager.v1']['first'], d['idmanager.v1']['last'])
+    ip.next_id = d['idmanager.v1']['next_id']
+    ip.free = d['idmanager.v1']['free']
+    ip.reserved = d['idmanager.v1'].get('reserved', [])
+    return ip
+
+
+class IdPool(object):
+    """Hands out integer IDs from a high water mark and a free list.
+
+    Released IDs are reused before the high water mark moves, oldest first,
+    so that of the released IDs the one freed most recently is the last to
+    be handed out again. IDs which were allocated before the pool existed
+    are kept in a sorted reserved list, and are skipped as the high water
+    mark passes them.
+    """
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.next_id = first
+        self.free = []
+        self.reserved = []
+
+    def is_free(self, id):
+        if id < self.first or id > self.last:
+            return False
+        if id in self.reserved:
+            return False
+        return id >= self.next_id or id in self.free
+
+    def reserve_existing(self, in_use):
+        """Seed the pool with IDs allocated before the pool existed."""
+        self.reserved = sorted(
+            set(i for i in in_use
+                if i >= self.next_id and i <= self.last))
+
+    def get_free_id(self):
+        if self.free:
+            return self.free.pop(0)
+
+        while self.next_id <= self.last:
+            id = self.next_id
+            self.next_id += 1
+
+            if self.reserved and self.reserved[0] == id:
+                self.reserved.pop(0)
+                continue
+            return id
+
+        return None
+
+    def get_free_ids(self, count):
+        ids = []
+        while len(ids) < count:
+            id = self.get_free_id()
+            if id is None:
+                break
+            ids.append(id)
+        return ids
+
+    def release(self, id):
+        if id in self.reserved:
+            self.reserved.remove(id)
+            return
+        if id < self.first or id >= self.next_id or id in self.free:
+            return
+        self.free.append(id)
+
+    def save(self):
+        return {
+            'idmanager.v1': {
+                'first': self.first,
+                'last': self.last,
+                'next_id': self.next_id,
+                'free': self.free,
+                'reserved': self.reserved
+            }
+        }
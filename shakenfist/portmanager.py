@@ -0,0 +1,92 @@
+import base64
+
+
+def from_db(d):
+    pb = PortBlock(d['portmanager.v1']['first'], d['portmanager.v1']['last'])
+    pb.bitmap = bytearray(base64.b64decode(d['portmanager.v1']['in_use']))
+    pb.hint = d['portmanager.v1'].get('hint', 0)
+    pb.in_use_counter = sum(bin(b).count('1') for b in pb.bitmap)
+    return pb
+
+
+class PortBlock(object):
+    """A compact record of which ports in a range are allocated.
+
+    Each port is a single bit, so the 30000 to 50000 console port range
+    is about 2.5kb. The hint is where the last search stopped, which means
+    a search normally only has to look at the next byte or so.
+    """
+
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+        self.num_ports = last - first + 1
+        self.bitmap = bytearray((self.num_ports + 7) // 8)
+        self.hint = 0
+        self.in_use_counter = 0
+
+    def _index(self, port):
+        port = int(port)
+        if port < self.first or port > self.last:
+            return None
+        return port - self.first
+
+    def is_free(self, port):
+        idx = self._index(port)
+        if idx is None:
+            return False
+        return not self.bitmap[idx // 8] & (1 << (idx % 8))
+
+    def reserve(self, port):
+        if not self.is_free(port):
+            return False
+
+        idx = self._index(port)
+        self.bitmap[idx // 8] |= 1 << (idx % 8)
+        self.in_use_counter += 1
+        return True
+
+    def release(self, port):
+        idx = self._index(port)
+        if idx is None or self.is_free(port):
+            return
+
+        self.bitmap[idx // 8] &= ~(1 << (idx % 8)) & 0xff
+        self.in_use_counter -= 1
+
+    def get_free_port(self):
+        """Reserve and return the next free port, or None if full."""
+        if self.in_use_counter >= self.num_ports:
+            return None
+
+        # Walk bytes starting at the hint, skipping any which are full
+        num_bytes = len(self.bitmap)
+        start = self.hint // 8
+        for offset in range(num_bytes + 1):
+            byte_idx = (start + offset) % num_bytes
+            if self.bitmap[byte_idx] == 0xff:
+                continue
+
+            for bit in range(8):
+                idx = byte_idx * 8 + bit
+                if idx >= self.num_ports:
+                    break
+                if offset == 0 and idx < self.hint:
+                    continue
+
+                port = self.first + idx
+                if self.reserve(port):
+                    self.hint = (idx + 1) % self.num_ports
+                    return port
+
+        return None
+
+    def save(self):
+        return {
+            'portmanager.v1': {
+                'first': self.first,
+                'last': self.last,
+                'hint': self.hint,
+                'in_use': base64.b64encode(bytes(self.bitmap)).decode('ascii')
+            }
+        }
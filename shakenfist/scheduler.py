@@ -1,11 +1,18 @@
 # Make scheduling decisions
 
 import copy
+import json
+import os
 import random
+import threading
 import time
+import uuid
+
+import numpy
 
 from shakenfist.config import config
 from shakenfist import db
+from shakenfist import etcd
 from shakenfist import exceptions
 from shakenfist import logutil
 from shakenfist import util
@@ -14,52 +21,580 @@ from shakenfist import util
 LOG, _ = logutil.setup(__name__)
 
 
+# Node metrics which the filters use. These are held as one array per metric
+# with one entry per node, so that a filter is a single vector operation
+# rather than a loop over the nodes.
+METRIC_COLUMNS = ['cpu_max', 'cpu_max_per_instance', 'cpu_total_instance_vcpus',
+                  'cpu_pinned', 'cpu_load_5', 'memory_available', 'memory_max',
+                  'memory_total_instance_actual', 'disk_free',
+                  'memory_hugepages_2m_free', 'memory_hugepages_1g_free']
+
+# Metrics reported for each NUMA cell of a node. These are held as one array
+# per metric with a row per node and a column per cell.
+NUMA_COLUMNS = ['cpu_max', 'cpu_available', 'memory_max', 'memory_available',
+                'hugepages_2m_free', 'hugepages_1g_free']
+
+
+def _numa_cells(metrics):
+    # A node which doesn't report NUMA cells is treated as a single cell
+    cells = []
+    for i in range(int(metrics.get('numa_cells', 0))):
+        cells.append([float(metrics.get('numa_cell%d_%s' % (i, column), 0))
+                      for column in NUMA_COLUMNS])
+    if not cells:
+        cells.append([float(metrics.get('cpu_max', 0)),
+                      float(metrics.get('cpu_max', 0)),
+                      float(metrics.get('memory_max', 0)),
+                      float(metrics.get('memory_available', 0)),
+                      float(metrics.get('memory_hugepages_2m_free', 0)),
+                      float(metrics.get('memory_hugepages_1g_free', 0))])
+    return cells
+
+
+def _dedicated(instance):
+    return instance.db_entry.get('cpu_policy') == 'dedicated'
+
+
+def _hugepages(instance):
+    # The suffix of the metrics and reservations for the instance's hugepage
+    # size, or None if its memory isn't backed by hugepages
+    size = instance.db_entry.get('hugepages')
+    if not size:
+        return None
+    return size.lower()
+
+
+def _normalize(values):
+    # Scale to between zero and one, so that multipliers are comparable
+    lowest = values.min()
+    spread = values.max() - lowest
+    if spread == 0:
+        return numpy.zeros(len(values))
+    return (values - lowest) / spread
+
+
+class Weigher(object):
+    """Scores the nodes which passed the filters.
+
+    weigh() returns a raw value for each of the candidate nodes, where
+    higher means emptier for resource weighers and closer for locality
+    weighers. Values are normalized and multiplied by the configured
+    multiplier. When packing, resource weighers are inverted so that the
+    fullest node which still fits is preferred.
+    """
+    multiplier = None
+    follows_strategy = True
+
+    def weigh(self, scheduler, indices, request):
+        # A weigher with nothing to say scores every candidate the same
+        return numpy.zeros(len(indices))
+
+
+class FreeRamWeigher(Weigher):
+    multiplier = 'SCHEDULER_WEIGHT_FREE_RAM'
+
+    def weigh(self, scheduler, indices, request):
+        return (scheduler.columns['memory_available'][indices] -
+                request['reserved_memory'][indices])
+
+
+class FreeCpuWeigher(Weigher):
+    multiplier = 'SCHEDULER_WEIGHT_FREE_CPU'
+
+    def weigh(self, scheduler, indices, request):
+        max_cpu = (scheduler.columns['cpu_max'][indices] *
+                   config.get('CPU_OVERCOMMIT_RATIO'))
+        used = (scheduler.columns['cpu_total_instance_vcpus'][indices] +
+                request['reserved_cpus'][indices])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.nan_to_num(1 - used / max_cpu)
+
+
+class LoadWeigher(Weigher):
+    multiplier = 'SCHEDULER_WEIGHT_LOAD'
+
+    def weigh(self, scheduler, indices, request):
+        # Load per core, negated because a lower load is emptier
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return -numpy.nan_to_num(scheduler.columns['cpu_load_5'][indices] /
+                                     scheduler.columns['cpu_max'][indices])
+
+
+class NetworkLocalityWeigher(Weigher):
+    multiplier = 'SCHEDULER_WEIGHT_NETWORK_LOCALITY'
+    follows_strategy = False
+
+    def weigh(self, scheduler, indices, request):
+        if not request['networks']:
+            return numpy.zeros(len(indices))
+        locality = get_locality_index()
+        return numpy.array(
+            [len(request['networks'] & locality.networks_on_node(
+                scheduler.nodes[i])) for i in indices], dtype=float)
+
+
+class ImageLocalityWeigher(Weigher):
+    multiplier = 'SCHEDULER_WEIGHT_IMAGE_LOCALITY'
+    follows_strategy = False
+
+    def weigh(self, scheduler, indices, request):
+        locality = get_locality_index()
+        if not request['images'] or not locality.has_images():
+            return numpy.zeros(len(indices))
+        return numpy.array(
+            [len(request['images'] & locality.images_on_node(
+                scheduler.nodes[i])) for i in indices], dtype=float)
+
+
+class NumaFitWeigher(Weigher):
+    multiplier = 'SCHEDULER_WEIGHT_NUMA_FIT'
+    follows_strategy = False
+
+    def weigh(self, scheduler, indices, request):
+        # An instance which spans cells suffers remote memory access
+        return scheduler._fits_numa_cell(request['instance'])[indices].astype(
+            float)
+
+
+WEIGHERS = [FreeRamWeigher(), FreeCpuWeigher(), LoadWeigher(),
+            NetworkLocalityWeigher(), ImageLocalityWeigher(), NumaFitWeigher()]
+
+
+class WatchedIndex(object):
+    """State loaded once from etcd and then kept current from watches.
+
+    Subclasses list the prefixes they follow in watches() and read their
+    initial state in load(). If a watch ends the index is marked stale, and
+    _get_watched() builds a new one the next time it is asked for. A watch
+    can also stall without ending, so indexes are rebuilt from scratch every
+    SCHEDULER_INDEX_RELOAD_INTERVAL seconds regardless.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stale = False
+        self.pid = os.getpid()
+        self.cancels = []
+        self.created = time.time()
+
+    def expired(self):
+        return (self.stale or time.time() - self.created >
+                config.get('SCHEDULER_INDEX_RELOAD_INTERVAL'))
+
+    def watches(self):
+        """Return a list of (object type, handler(key, value)) tuples."""
+        return []
+
+    def load(self):
+        """Read the initial state of the index."""
+        pass
+
+    def _follow(self, changes, handler):
+        try:
+            for key, value in changes:
+                with self.lock:
+                    handler(key, value)
+        except Exception as e:
+            util.ignore_exception('%s watch' % self.__class__.__name__, e)
+        self.stale = True
+
+    def start(self):
+        # Watches are started before load() so that no change is missed.
+        # Changes which load() also sees are applied twice, which is harmless.
+        for objecttype, handler in self.watches():
+            changes, cancel = etcd.watch_prefix(objecttype)
+            self.cancels.append(cancel)
+            threading.Thread(target=self._follow, args=(changes, handler),
+                             daemon=True).start()
+
+    def close(self):
+        for cancel in self.cancels:
+            cancel()
+        self.cancels = []
+
+
+def _get_watched(current, cls):
+    # Watch threads don't survive a fork, so a forked child builds its own
+    if current and not current.expired() and current.pid == os.getpid():
+        return current
+
+    if current and current.pid == os.getpid():
+        current.close()
+
+    index = cls()
+    index.start()
+    index.load()
+    return index
+
+
+class LocalityIndex(WatchedIndex):
+    """Which networks and images are present on each node.
+
+    Locality scoring is a lookup per candidate node instead of reading every
+    instance, interface and image record on every placement.
+    """
+
+    def __init__(self):
+        super(LocalityIndex, self).__init__()
+
+        # instance uuid -> node
+        self.instance_nodes = {}
+        # instance uuid -> {interface uuid: network uuid}
+        self.instance_networks = {}
+        # interface uuid -> instance uuid
+        self.interface_instances = {}
+        # instance uuid -> (node, set of network uuids) as currently counted
+        self.instance_counted = {}
+        # node -> {network uuid: number of instances using it}
+        self.node_networks = {}
+
+        # image key -> (node, url)
+        self.images = {}
+        # node -> {url: number of image records}
+        self.node_images = {}
+
+    def _recount_instance(self, instance_uuid):
+        counted = self.instance_counted.pop(instance_uuid, None)
+        if counted:
+            node, networks = counted
+            for network_uuid in networks:
+                self.node_networks[node][network_uuid] -= 1
+                if self.node_networks[node][network_uuid] == 0:
+                    del self.node_networks[node][network_uuid]
+
+        node = self.instance_nodes.get(instance_uuid)
+        networks = set(self.instance_networks.get(instance_uuid, {}).values())
+        if node and networks:
+            for network_uuid in networks:
+                self.node_networks.setdefault(node, {}).setdefault(network_uuid, 0)
+                self.node_networks[node][network_uuid] += 1
+            self.instance_counted[instance_uuid] = (node, networks)
+
+    def instance_changed(self, instance_uuid, state):
+        if (not state or not state.get('node') or
+                state.get('state') in ['deleted', 'error']):
+            self.instance_nodes.pop(instance_uuid, None)
+        else:
+            self.instance_nodes[instance_uuid] = state['node']
+        self._recount_instance(instance_uuid)
+
+    def interface_changed(self, interface_uuid, iface):
+        instance_uuid = self.interface_instances.pop(interface_uuid, None)
+        if instance_uuid:
+            self.instance_networks.get(instance_uuid, {}).pop(
+                interface_uuid, None)
+            self._recount_instance(instance_uuid)
+
+        if iface and iface.get('state') != 'deleted':
+            instance_uuid = iface['instance_uuid']
+            self.interface_instances[interface_uuid] = instance_uuid
+            self.instance_networks.setdefault(
+                instance_uuid, {})[interface_uuid] = iface['network_uuid']
+            self._recount_instance(instance_uuid)
+
+    def image_changed(self, key, meta):
+        old = self.images.pop(key, None)
+        if old:
+            node, url = old
+            self.node_images[node][url] -= 1
+            if self.node_images[node][url] == 0:
+                del self.node_images[node][url]
+
+        if meta and meta.get('url'):
+            node = key.split('/')[-1]
+            self.images[key] = (node, meta['url'])
+            self.node_images.setdefault(node, {}).setdefault(meta['url'], 0)
+            self.node_images[node][meta['url']] += 1
+
+    def networks_on_node(self, node):
+        with self.lock:
+            return set(self.node_networks.get(node, {}))
+
+    def images_on_node(self, node):
+        with self.lock:
+            return set(self.node_images.get(node, {}))
+
+    def has_images(self):
+        with self.lock:
+            return len(self.images) > 0
+
+    def load(self):
+        with self.lock:
+            for inst in db.get_instances():
+                self.instance_changed(inst['uuid'], inst)
+            for iface in db.get_all_network_interfaces():
+                self.interface_changed(iface['uuid'], iface)
+            for key, meta in (db.get_image_metadata_all() or {}).items():
+                self.image_changed(key, meta)
+
+    def watches(self):
+        return [
+            ('instancestate',
+             lambda k, v: self.instance_changed(k.split('/')[-1], v)),
+            ('networkinterface',
+             lambda k, v: self.interface_changed(k.split('/')[-1], v)),
+            ('image', self.image_changed)]
+
+
+class ClusterState(WatchedIndex):
+    """Metrics and reservations for every node in the cluster.
+
+    Every scheduler in a process shares one of these, so a placement never
+    refetches cluster metrics. The per-metric arrays the filters use are
+    rebuilt at most once per change, however many schedulers ask for them.
+    """
+
+    def __init__(self):
+        super(ClusterState, self).__init__()
+
+        # Bumped on every change, so that schedulers know to take a new
+        # snapshot
+        self.generation = 0
+        # node -> metrics
+        self.metrics = {}
+        # node -> {instance uuid: reservation}
+        self.reservations = {}
+
+        # (generation, nodes, node index, columns) for the last snapshot
+        self.arrays = None
+
+    def metrics_changed(self, key, value):
+        node = key.rstrip('/').split('/')[-1]
+        if value:
+            self.metrics[node] = value.get('metrics', {})
+        else:
+            self.metrics.pop(node, None)
+        self.generation += 1
+
+    def reservation_changed(self, key, value):
+        node, instance_uuid = key.split('/')[-2:]
+        if value:
+            self.reservations.setdefault(node, {})[instance_uuid] = value
+        elif node in self.reservations:
+            self.reservations[node].pop(instance_uuid, None)
+            if not self.reservations[node]:
+                del self.reservations[node]
+        self.generation += 1
+
+    def load(self):
+        with self.lock:
+            for node, metrics in db.get_all_metrics().items():
+                self.metrics[node] = metrics
+            for node, reservations in db.get_reservations().items():
+                for r in reservations.values():
+                    self.reservations.setdefault(node, {})[
+                        r['instance_uuid']] = r
+            self.generation += 1
+
+    def watches(self):
+        return [('metrics', self.metrics_changed),
+                ('reservation', self.reservation_changed)]
+
+    def snapshot(self):
+        """Return the generation, nodes, an index of node positions, metric
+        arrays and unexpired reservations.
+
+        All but the reservations are shared between callers and must not be
+        modified. The reservations are a copy, which the caller may add to.
+        """
+        now = time.time()
+        with self.lock:
+            if not self.arrays or self.arrays[0] != self.generation:
+                nodes = list(self.metrics.keys())
+                columns = {}
+                for column in METRIC_COLUMNS:
+                    columns[column] = numpy.array(
+                        [float(self.metrics[node].get(column, 0))
+                         for node in nodes], dtype=float)
+
+                # Nodes with fewer cells are padded with empty ones
+                cells = [_numa_cells(self.metrics[node]) for node in nodes]
+                numa = numpy.zeros((len(nodes), max([len(c) for c in cells] or [1]),
+                                    len(NUMA_COLUMNS)))
+                for i, node_cells in enumerate(cells):
+                    numa[i, :len(node_cells)] = node_cells
+                for i, column in enumerate(NUMA_COLUMNS):
+                    columns['numa_' + column] = numa[:, :, i]
+                self.arrays = (self.generation, nodes,
+                               {node: i for i, node in enumerate(nodes)},
+                               columns)
+
+            reservations = {}
+            for node, node_reservations in self.reservations.items():
+                for instance_uuid, r in node_reservations.items():
+                    if r['expires'] >= now:
+                        reservations.setdefault(node, {})[instance_uuid] = \
+                            dict(r)
+            return self.arrays + (reservations,)
+
+
+class SchedulingDecision(object):
+    """A record of how one placement was decided.
+
+    Each stage records how many nodes survived and why the others were
+    eliminated. The whole record is written as a single event once the
+    decision is made, rather than an event per stage.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.start_time = time.time()
+        self.stages = []
+        self.outcome = None
+
+    def record(self, stage, surviving, eliminated=None):
+        entry = {
+            'stage': stage,
+            'surviving': len(surviving),
+            'eliminated': eliminated or {},
+        }
+        if config.get('SCHEDULER_DEBUG'):
+            entry['candidates'] = list(surviving)
+        self.stages.append(entry)
+
+    def save(self):
+        duration = time.time() - self.start_time
+        LOG.withObj(self.instance).withField('duration', duration).info(
+            'Scheduling decision: %s' % self.outcome)
+        db.add_event('instance', self.instance.db_entry['uuid'], 'schedule',
+                     'decision', duration,
+                     json.dumps({'stages': self.stages,
+                                 'outcome': self.outcome},
+                                sort_keys=True))
+
+
+LOCALITY_INDEX = None
+CLUSTER_STATE = None
+
+
+def get_locality_index():
+    global LOCALITY_INDEX
+    LOCALITY_INDEX = _get_watched(LOCALITY_INDEX, LocalityIndex)
+    return LOCALITY_INDEX
+
+
+def get_cluster_state():
+    global CLUSTER_STATE
+    CLUSTER_STATE = _get_watched(CLUSTER_STATE, ClusterState)
+    return CLUSTER_STATE
+
+
 class Scheduler(object):
     def __init__(self):
         self.refresh_metrics()
 
     def refresh_metrics(self):
-        metrics = {}
-
-        for node in db.get_nodes():
-            node_name = node['fqdn']
-            try:
-                metrics[node_name] = db.get_metrics(node_name)
-            except exceptions.ReadException:
-                pass
-
-        self.metrics = metrics
+        (self.generation, self.nodes, self.node_index, self.columns,
+         self.reservations) = get_cluster_state().snapshot()
         self.metrics_updated = time.time()
 
-    def _has_sufficient_cpu(self, cpus, node):
-        max_cpu = (self.metrics[node].get('cpu_max', 0) *
+    def _refresh_metrics_if_stale(self):
+        # Snapshots are cheap, but are also retaken after a while so that
+        # expired reservations are dropped even if nothing else changes
+        diff = time.time() - self.metrics_updated
+        if (get_cluster_state().generation != self.generation or
+                diff > config.get('SCHEDULER_CACHE_TIMEOUT')):
+            self.refresh_metrics()
+
+    def _candidates(self, mask):
+        return [self.nodes[i] for i in numpy.flatnonzero(mask)]
+
+    def _reserved(self, resource, instance_uuid=None):
+        # Resources held for instances placed on each node which aren't
+        # running yet, and therefore aren't in the node's metrics. An
+        # instance never competes with its own reservation.
+        reserved = numpy.zeros(len(self.nodes))
+        for node, reservations in self.reservations.items():
+            i = self.node_index.get(node)
+            if i is None:
+                continue
+            reserved[i] = sum(r.get(resource, 0) for r in reservations.values()
+                              if r['instance_uuid'] != instance_uuid)
+        return reserved
+
+    def _has_sufficient_cpu(self, cpus, instance_uuid=None, dedicated=False):
+        # Only CPUs which aren't pinned are overcommitted, and the vCPUs of
+        # dedicated instances don't run on them
+        pinned = self.columns['cpu_pinned']
+        shared_cpu = (self.columns['cpu_total_instance_vcpus'] - pinned +
+                      self._reserved('cpus', instance_uuid))
+        if dedicated:
+            pinned = pinned + cpus
+        else:
+            shared_cpu = shared_cpu + cpus
+        max_cpu = (numpy.maximum(self.columns['cpu_max'] - pinned, 0) *
                    config.get('CPU_OVERCOMMIT_RATIO'))
-        current_cpu = self.metrics[node].get('cpu_total_instance_vcpus', 0)
-        if current_cpu + cpus > max_cpu:
-            return False
-        return True
+        return shared_cpu <= max_cpu
+
+    def _has_sufficient_dedicated_cpu(self, cpus, instance_uuid=None):
+        # Each vCPU of a dedicated instance needs a host CPU of its own. Other
+        # reservations aren't necessarily dedicated, so this is conservative.
+        unpinned = self.columns['numa_cpu_available'].sum(axis=1)
+        return unpinned - self._reserved('cpus', instance_uuid) >= cpus
+
+    def _fits_numa_cell(self, instance):
+        # Whether each node has a cell with room for the whole instance
+        if _dedicated(instance):
+            cpus = self.columns['numa_cpu_available']
+        else:
+            cpus = self.columns['numa_cpu_max']
+        if _hugepages(instance):
+            memory = self.columns['numa_hugepages_%s_free'
+                                  % _hugepages(instance)]
+        else:
+            memory = self.columns['numa_memory_available']
+        fits = ((cpus >= instance.db_entry['cpus']) &
+                (memory >= instance.db_entry['memory']))
+        return fits.any(axis=1)
+
+    def _has_sufficient_pinned_hugepages(self, instance):
+        # A dedicated instance's memory is bound to the cells its CPUs are
+        # pinned to, so those cells must hold all of its hugepages. This
+        # follows virt._choose_cpu_pinning(): the instance goes in one cell
+        # if it can, otherwise it takes CPUs from the emptiest cells first.
+        cpus = self.columns['numa_cpu_available']
+        hugepages = self.columns['numa_hugepages_%s_free'
+                                 % _hugepages(instance)]
+        order = numpy.argsort(-cpus, axis=1, kind='stable')
+        cpus = numpy.take_along_axis(cpus, order, axis=1)
+        hugepages = numpy.take_along_axis(hugepages, order, axis=1)
+        used = ((cpus > 0) &
+                (cpus.cumsum(axis=1) - cpus < instance.db_entry['cpus']))
+        spanned = (hugepages * used).sum(axis=1)
+        return (self._fits_numa_cell(instance) |
+                (spanned >= instance.db_entry['memory']))
+
+    def _has_sufficient_hugepages(self, instance):
+        # Hugepages are a separate pool which is never overcommitted
+        size = _hugepages(instance)
+        free = (self.columns['memory_hugepages_%s_free' % size] -
+                self._reserved('hugepages_' + size,
+                               instance.db_entry['uuid']))
+        return free >= instance.db_entry['memory']
+
+    def _has_sufficient_ram(self, memory, instance_uuid=None):
+        reserved = self._reserved('memory', instance_uuid)
 
-    def _has_sufficient_ram(self, memory, node):
         # There are two things to track here... We must always have
         # RAM_SYSTEM_RESERVATION gb of RAM for operating system tasks -- assume
         # there is no overlap with existing VMs when checking this. Note as
         # well that metrics are in MB...
-        available = (self.metrics[node].get('memory_available', 0) -
+        available = (self.columns['memory_available'] - reserved -
                      (config.get('RAM_SYSTEM_RESERVATION') * 1024))
-        if available - memory < 0.0:
-            return False
+        sufficient = available - memory >= 0.0
 
         # ...Secondly, if we're using KSM and over committing memory, we
-        # shouldn't overcommit more than by RAM_OVERCOMMIT_RATIO
-        instance_memory = (
-            self.metrics[node].get('memory_total_instance_actual', 0) + memory)
-        if (instance_memory / self.metrics[node].get('memory_max', 0) >
-                config.get('RAM_OVERCOMMIT_RATIO')):
-            return False
+        # shouldn't overcommit more than by RAM_OVERCOMMIT_RATIO. A node
+        # which doesn't report memory_max divides by zero and is excluded.
+        instance_memory = (self.columns['memory_total_instance_actual'] +
+                           reserved + memory)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratio = instance_memory / self.columns['memory_max']
+        sufficient &= ratio <= config.get('RAM_OVERCOMMIT_RATIO')
 
-        return True
+        return sufficient
 
-    def _has_sufficient_disk(self, instance, node):
+    def _requested_disk(self, instance):
         requested_disk = 0
         for disk in instance.db_entry.get('block_devices', {}).get('devices', []):
             # TODO(mikal): this ignores "sizeless disks", that is ones that
@@ -67,198 +602,268 @@ class Scheduler(object):
             if 'size' in disk:
                 if not disk['size'] is None:
                     requested_disk += int(disk['size'])
-
-        if requested_disk > (int(self.metrics[node].get('disk_free', '0')) / 1024 / 1024 / 1024):
+        return requested_disk
+
+    def _has_sufficient_disk(self, instance):
+        requested_disk = (self._requested_disk(instance) +
+                          self._reserved('disk', instance.db_entry['uuid']))
+        return requested_disk <= self.columns['disk_free'] / 1024 / 1024 / 1024
+
+    def _reserve_locally(self, instance, node):
+        r = {
+            'instance_uuid': instance.db_entry['uuid'],
+            'cpus': instance.db_entry['cpus'],
+            'memory': instance.db_entry['memory'],
+            'disk': self._requested_disk(instance),
+            'token': str(uuid.uuid4()),
+        }
+
+        # Hugepage backed memory comes from its own pool, not general RAM
+        if _hugepages(instance):
+            r['memory'] = 0
+            r['hugepages_' + _hugepages(instance)] = instance.db_entry['memory']
+
+        self.reservations.setdefault(node, {})[instance.db_entry['uuid']] = r
+
+    def reserve(self, instance, node):
+        """Hold resources on node for an instance which has been placed there.
+
+        Node metrics only include the instance once it is running, so until
+        then every scheduler subtracts the reservation instead. Returns a
+        token for the reservation, for confirm_reservation().
+        """
+        self._reserve_locally(instance, node)
+        r = self.reservations[node][instance.db_entry['uuid']]
+        hugepages = {k: v for k, v in r.items() if k.startswith('hugepages_')}
+        db.add_reservation(node, r['instance_uuid'], r['cpus'], r['memory'],
+                           r['disk'], hugepages=hugepages or None,
+                           token=r['token'])
+        return r['token']
+
+    def confirm_reservation(self, instance, node, token):
+        """Check that an earlier placement on node still stands.
+
+        This is true if node still holds the reservation with this token and
+        still has room for the instance alongside everything else placed
+        there. It is much cheaper than placing the instance again.
+        """
+        self._refresh_metrics_if_stale()
+        r = self.reservations.get(node, {}).get(instance.db_entry['uuid'])
+        if not r or r.get('token') != token or node not in self.node_index:
             return False
-        return True
-
-    def _find_most_matching_networks(self, requested_networks, candidates):
-        if not candidates:
-            return []
-
-        # Find number of matching networks on each node
-        candidates_network_matches = {}
-        for node in candidates:
-            candidates_network_matches[node] = 0
-
-            # Make a list of networks for the node
-            present_networks = []
-            for inst in list(db.get_instances(only_node=node)):
-                for iface in db.get_instance_interfaces(inst['uuid']):
-                    if not iface['network_uuid'] in present_networks:
-                        present_networks.append(iface['network_uuid'])
-
-            # Count the requested networks present on this node
-            for network in present_networks:
-                if network in requested_networks:
-                    candidates_network_matches[node] += 1
-
-        # Store candidate nodes keyed by number of matches
-        candidates_by_network_matches = {}
-        for node in candidates:
-            matches = candidates_network_matches[node]
-            candidates_by_network_matches.setdefault(matches, []).append(node)
-
-        # Find maximum matches of networks on a node
-        max_matches = max(candidates_by_network_matches.keys())
-
-        # Check that the maximum is not just the network node.
-        # (Network node always has every network.)
-        net_node = db.get_network_node()['fqdn']
-        if (max_matches == 1 and
-                candidates_by_network_matches[max_matches][0] == net_node):
-            # No preference, all candidates are a reasonable choice
-            return candidates
-
-        # Return list of candidates that has maximum networks
-        return candidates_by_network_matches[max_matches]
 
-    def _find_most_matching_images(self, requested_images, candidates):
-        candidates_image_matches = {}
-
-        img_meta = db.get_image_metadata_all()
-        if not img_meta:
-            # No images in the cluster so return the original candidate list
-            return candidates
-
-        # Determine number of matching images per node
-        for node in candidates:
-            candidates_image_matches[node] = 0
-
-            present_images = []
-            for key, meta in img_meta.items():
-                if not key.endswith('/' + node):
-                    continue
-                present_images.append(meta['url'])
-
-            for image in present_images:
-                if image in requested_images:
-                    candidates_image_matches[node] += 1
-
-        # Create dict of candidate lists keyed by number of image matches
-        candidates_by_image_matches = {}
-        for node in candidates:
-            matches = candidates_image_matches[node]
-            candidates_by_image_matches.setdefault(matches, [])
-            candidates_by_image_matches[matches].append(node)
-
-        # If no matches, return the original candidate list
-        if len(candidates_by_image_matches) == 0:
-            return candidates
-
-        # Return all candidates that have the highest number of image matches
-        max_matches = max(candidates_by_image_matches.keys())
-        return candidates_by_image_matches[max_matches]
+        instance_uuid = instance.db_entry['uuid']
+        cpus = instance.db_entry['cpus']
+        fits = ((self.columns['cpu_max_per_instance'] >= cpus) &
+                self._has_sufficient_cpu(cpus, instance_uuid=instance_uuid,
+                                         dedicated=_dedicated(instance)) &
+                self._has_sufficient_disk(instance))
+        if _dedicated(instance):
+            fits &= self._has_sufficient_dedicated_cpu(
+                cpus, instance_uuid=instance_uuid)
+        if _hugepages(instance):
+            fits &= self._has_sufficient_hugepages(instance)
+        else:
+            fits &= self._has_sufficient_ram(instance.db_entry['memory'],
+                                             instance_uuid=instance_uuid)
+        if _dedicated(instance) and _hugepages(instance):
+            fits &= self._has_sufficient_pinned_hugepages(instance)
+        return bool(fits[self.node_index[node]])
+
+    def _weigh(self, instance, requested_networks, requested_images,
+               candidates):
+        """Return candidates ordered best first. Ties are broken randomly."""
+        random.shuffle(candidates)
+        indices = numpy.array([self.node_index[node] for node in candidates],
+                              dtype=int)
+        request = {
+            'instance': instance,
+            'networks': set(requested_networks),
+            'images': set(requested_images),
+            'reserved_cpus': self._reserved('cpus', instance.db_entry['uuid']),
+            'reserved_memory': self._reserved('memory',
+                                              instance.db_entry['uuid']),
+        }
+
+        pack = config.get('SCHEDULER_STRATEGY') == 'pack'
+        scores = numpy.zeros(len(candidates))
+        for weigher in WEIGHERS:
+            multiplier = config.get(weigher.multiplier)
+            if not multiplier:
+                continue
+
+            weights = _normalize(weigher.weigh(self, indices, request))
+            if pack and weigher.follows_strategy:
+                weights = 1 - weights
+            scores += multiplier * weights
+
+        # A stable sort, so that the shuffle above breaks ties
+        order = numpy.argsort(-scores, kind='stable')
+        return [candidates[i] for i in order]
 
     def place_instance(self, instance, network, candidates=None):
         with util.RecordedOperation('schedule', instance):
-            log_ctx = LOG.withObj(instance)
-
-            diff = time.time() - self.metrics_updated
-            if diff > config.get('SCHEDULER_CACHE_TIMEOUT'):
-                self.refresh_metrics()
-
-            if candidates:
-                log_ctx.info('Scheduling %s forced as candidates' %
-                             candidates)
-                db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                             'Forced candidates', None, str(candidates))
-                for node in candidates:
-                    if node not in self.metrics:
-                        raise exceptions.CandidateNodeNotFoundException(node)
-            else:
-                candidates = []
-                for node in self.metrics.keys():
-                    candidates.append(node)
-            log_ctx.info('Scheduling %s start as candidates' % candidates)
-            db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                         'Initial candidates', None, str(candidates))
-            if not candidates:
-                raise exceptions.LowResourceException('No nodes with metrics')
-
-            # Can we host that many vCPUs?
-            for node in copy.copy(candidates):
-                max_cpu = self.metrics[node].get('cpu_max_per_instance', 0)
-                if instance.db_entry['cpus'] > max_cpu:
-                    candidates.remove(node)
-            log_ctx.info('Scheduling %s have enough actual CPU' % candidates)
-            db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                         'Have enough actual CPU', None, str(candidates))
-            if not candidates:
+            self._refresh_metrics_if_stale()
+            return self._place_instance(instance, network, candidates)
+
+    def place_instances(self, batch):
+        """Place a batch of instances in one pass.
+
+        batch is a list of (instance, network, candidates) tuples, where
+        candidates may be None. Each placement is reserved in memory before
+        the next instance is considered, so a large batch spreads out instead
+        of landing on whichever node looked best at the start. Returns the
+        chosen node for each instance, in batch order. If any instance cannot
+        be placed, the exception is raised and none of the reservations are
+        kept. Callers should reserve() each placement they go on to use.
+        """
+        self._refresh_metrics_if_stale()
+
+        original_reservations = copy.deepcopy(self.reservations)
+
+        placements = []
+        try:
+            for instance, network, candidates in batch:
+                with util.RecordedOperation('schedule', instance):
+                    nodes = self._place_instance(
+                        instance, network,
+                        candidates=copy.copy(candidates) if candidates else None)
+                self._reserve_locally(instance, nodes[0])
+                placements.append(nodes[0])
+        except Exception:
+            self.reservations = original_reservations
+            raise
+
+        return placements
+
+    def _eliminated(self, before, after, reason):
+        return {self.nodes[i]: reason for i in numpy.flatnonzero(before & ~after)}
+
+    def _filter(self, decision, stage, mask, passes, reason):
+        after = mask & passes
+        decision.record(stage, self._candidates(after),
+                        self._eliminated(mask, after, reason))
+        return after
+
+    def _place_instance(self, instance, network, candidates=None):
+        decision = SchedulingDecision(instance)
+        try:
+            candidates = self._decide(decision, instance, network, candidates)
+            decision.outcome = 'placed on %s' % candidates[0]
+            return candidates
+
+        except (exceptions.LowResourceException,
+                exceptions.CandidateNodeNotFoundException) as e:
+            decision.outcome = 'failed: %s' % e
+            raise
+
+        finally:
+            decision.save()
+
+    def _decide(self, decision, instance, network, candidates):
+        mask = numpy.zeros(len(self.nodes), dtype=bool)
+        if candidates:
+            for node in candidates:
+                if node not in self.node_index:
+                    raise exceptions.CandidateNodeNotFoundException(node)
+                mask[self.node_index[node]] = True
+            decision.record('forced candidates', candidates)
+        else:
+            mask[:] = True
+            decision.record('initial candidates', self.nodes)
+        if not mask.any():
+            raise exceptions.LowResourceException('No nodes with metrics')
+
+        # Can we host that many vCPUs?
+        mask = self._filter(
+            decision, 'enough actual CPU', mask,
+            self.columns['cpu_max_per_instance'] >= instance.db_entry['cpus'],
+            'too few vCPUs per instance')
+        if not mask.any():
+            raise exceptions.LowResourceException(
+                'Requested vCPUs exceeds vCPU limit')
+
+        # Do we have enough idle CPU?
+        mask = self._filter(
+            decision, 'enough idle CPU', mask,
+            self._has_sufficient_cpu(instance.db_entry['cpus'],
+                                     instance_uuid=instance.db_entry['uuid'],
+                                     dedicated=_dedicated(instance)),
+            'not enough idle CPU')
+        if not mask.any():
+            raise exceptions.LowResourceException(
+                'No nodes with enough idle CPU')
+
+        # Are there enough host CPUs to pin to?
+        if _dedicated(instance):
+            mask = self._filter(
+                decision, 'enough dedicated CPU', mask,
+                self._has_sufficient_dedicated_cpu(
+                    instance.db_entry['cpus'],
+                    instance_uuid=instance.db_entry['uuid']),
+                'not enough unpinned CPUs')
+            if not mask.any():
                 raise exceptions.LowResourceException(
-                    'Requested vCPUs exceeds vCPU limit')
-
-            # Do we have enough idle CPU?
-            for node in copy.copy(candidates):
-                if not self._has_sufficient_cpu(
-                        instance.db_entry['cpus'], node):
-                    candidates.remove(node)
-            log_ctx.info('Scheduling %s have enough idle CPU' % candidates)
-            db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                         'Have enough idle CPU', None, str(candidates))
-            if not candidates:
+                    'No nodes with enough dedicated CPUs')
+
+        # Do we have enough idle RAM, or free hugepages for hugepage backed
+        # instances?
+        if _hugepages(instance):
+            mask = self._filter(
+                decision, 'enough free hugepages', mask,
+                self._has_sufficient_hugepages(instance),
+                'not enough free %s hugepages' % instance.db_entry['hugepages'])
+            if not mask.any():
                 raise exceptions.LowResourceException(
-                    'No nodes with enough idle CPU')
-
-            # Do we have enough idle RAM?
-            for node in copy.copy(candidates):
-                if not self._has_sufficient_ram(
-                        instance.db_entry['memory'], node):
-                    candidates.remove(node)
-            log_ctx.info('Scheduling %s have enough idle RAM' % candidates)
-            db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                         'Have enough idle RAM', None, str(candidates))
-            if not candidates:
+                    'No nodes with enough free hugepages')
+
+            if _dedicated(instance):
+                mask = self._filter(
+                    decision, 'enough hugepages in pinned cells', mask,
+                    self._has_sufficient_pinned_hugepages(instance),
+                    'not enough free %s hugepages in the NUMA cells pinned to'
+                    % instance.db_entry['hugepages'])
+                if not mask.any():
+                    raise exceptions.LowResourceException(
+                        'No nodes with enough free hugepages in the NUMA '
+                        'cells pinned to')
+        else:
+            mask = self._filter(
+                decision, 'enough idle RAM', mask,
+                self._has_sufficient_ram(instance.db_entry['memory'],
+                                         instance_uuid=instance.db_entry['uuid']),
+                'not enough idle RAM')
+            if not mask.any():
                 raise exceptions.LowResourceException(
                     'No nodes with enough idle RAM')
 
-            # Do we have enough idle disk?
-            for node in copy.copy(candidates):
-                if not self._has_sufficient_disk(instance, node):
-                    candidates.remove(node)
-            log_ctx.info('Scheduling %s have enough idle disk' % candidates)
-            db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                         'Have enough idle disk', None, str(candidates))
-            if not candidates:
-                raise exceptions.LowResourceException(
-                    'No nodes with enough disk space')
-
-            # What nodes have the highest number of networks already present?
-            if network:
-                requested_networks = []
-                for net in network:
-                    network_uuid = net['network_uuid']
-                    if network_uuid not in requested_networks:
-                        requested_networks.append(network_uuid)
-
-                candidates = self._find_most_matching_networks(
-                    requested_networks, candidates)
-                log_ctx.info('Scheduling %s have most matching networks'
-                             % candidates)
-                db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                             'Have most matching networks', None,
-                             str(candidates))
-
-            # What nodes have the base image already?
-            requested_images = []
-            for disk in instance.db_entry['block_devices']['devices']:
-                if disk.get('base'):
-                    requested_images = disk.get('base')
-
-            candidates = self._find_most_matching_images(
-                requested_images, candidates)
-            log_ctx.info('Scheduling %s have most matching images' % candidates)
-            db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                         'Have most matching images', None, str(candidates))
-
-            # Avoid allocating to network node if possible
-            net_node = db.get_network_node()
-            if len(candidates) > 1 and net_node['fqdn'] in candidates:
-                candidates.remove(net_node['fqdn'])
-                log_ctx.info('Scheduling %s are non-network nodes' % candidates)
-                db.add_event('instance', instance.db_entry['uuid'], 'schedule',
-                             'Are non-network nodes', None, str(candidates))
-
-            # Return a shuffled list of options
-            random.shuffle(candidates)
-            return candidates
+        # Do we have enough idle disk?
+        mask = self._filter(
+            decision, 'enough idle disk', mask,
+            self._has_sufficient_disk(instance), 'not enough disk')
+        if not mask.any():
+            raise exceptions.LowResourceException(
+                'No nodes with enough disk space')
+        candidates = self._candidates(mask)
+
+        # Avoid allocating to network node if possible
+        net_node = db.get_network_node()
+        if len(candidates) > 1 and net_node['fqdn'] in candidates:
+            candidates.remove(net_node['fqdn'])
+            decision.record('non-network nodes', candidates,
+                            {net_node['fqdn']: 'is the network node'})
+
+        # Order the remaining nodes by preference
+        requested_networks = []
+        for net in network or []:
+            requested_networks.append(net['network_uuid'])
+
+        requested_images = []
+        for disk in instance.db_entry['block_devices']['devices']:
+            if disk.get('base'):
+                requested_images.append(disk.get('base'))
+
+        candidates = self._weigh(instance, requested_networks,
+                                 requested_images, candidates)
+        decision.record('weighed', candidates)
+        return candidates
@@ -3,6 +3,7 @@ from shakenfist.exceptions import (NoURLImageFetchTaskException,
                                    NoInstanceTaskException,
                                    NoNetworkTaskException,
                                    )
+from shakenfist import tracing
 
 
 class QueueTask(object):
@@ -10,6 +11,11 @@ class QueueTask(object):
     _name = None
     _version = 1  # Enable future upgrades to existing tasks
 
+    def __init__(self, trace=None):
+        # The trace span this task was queued from, so that the work done for
+        # it can be traced as part of the same operation
+        self._trace = trace or tracing.traceparent()
+
     @classmethod
     def name(self):
         return self._name
@@ -31,19 +37,29 @@ class QueueTask(object):
         return self.__hash__() == other.__hash__()
 
     def __hash__(self):
-        return hash(str(self.json_dump()))
+        # The trace only records where a task was queued from, two tasks for
+        # the same work are still the same task
+        d = self.json_dump()
+        d.pop('trace', None)
+        return hash(str(d))
 
     def json_dump(self):
-        return {'task': self._name,
-                'version': self._version}
+        d = {'task': self._name,
+             'version': self._version}
+        if self._trace:
+            d['trace'] = self._trace
+        return d
+
+    def trace(self):
+        return self._trace
 
 
 #
 # Instance Tasks
 #
 class InstanceTask(QueueTask):
-    def __init__(self, instance_uuid, network=None):
-        super(InstanceTask, self).__init__()
+    def __init__(self, instance_uuid, network=None, trace=None):
+        super(InstanceTask, self).__init__(trace=trace)
         self._instance_uuid = instance_uuid
         # Only set network if deliberately set in function paramater. This
         # avoids setting _network to None which is not iterable.
@@ -73,8 +89,31 @@ class InstanceTask(QueueTask):
 
 
 class PreflightInstanceTask(InstanceTask):
+    """Check an instance can start on the node it was placed on.
+
+    placement is the node the instance was scheduled to, and reservation the
+    token of the resources reserved for it there.
+    """
     _name = 'instance_preflight'
 
+    def __init__(self, instance_uuid, network=None, placement=None,
+                 reservation=None, trace=None):
+        super(PreflightInstanceTask, self).__init__(instance_uuid, network,
+                                                    trace=trace)
+        self._placement = placement
+        self._reservation = reservation
+
+    def json_dump(self):
+        return {**super(PreflightInstanceTask, self).json_dump(),
+                'placement': self._placement,
+                'reservation': self._reservation}
+
+    def placement(self):
+        return self._placement
+
+    def reservation(self):
+        return self._reservation
+
 
 class StartInstanceTask(InstanceTask):
     _name = 'instance_start'
@@ -87,8 +126,9 @@ class DeleteInstanceTask(InstanceTask):
 class ErrorInstanceTask(InstanceTask):
     _name = 'instance_error'
 
-    def __init__(self, instance_uuid, error_msg=None, network=None):
-        super(ErrorInstanceTask, self).__init__(instance_uuid)
+    def __init__(self, instance_uuid, error_msg=None, network=None,
+                 trace=None):
+        super(ErrorInstanceTask, self).__init__(instance_uuid, trace=trace)
         self._error_msg = error_msg
 
     def json_dump(self):
@@ -103,8 +143,8 @@ class ErrorInstanceTask(InstanceTask):
 # Network Tasks
 #
 class NetworkTask(QueueTask):
-    def __init__(self, network_uuid):
-        super(NetworkTask, self).__init__()
+    def __init__(self, network_uuid, trace=None):
+        super(NetworkTask, self).__init__(trace=trace)
         self._network_uuid = network_uuid
 
         # General checks
@@ -138,8 +178,8 @@ class RemoveDHCPNetworkTask(NetworkTask):
 # Image Tasks
 #
 class ImageTask(QueueTask):
-    def __init__(self, url):
-        super(ImageTask, self).__init__()
+    def __init__(self, url, trace=None):
+        super(ImageTask, self).__init__(trace=trace)
         self._url = url
 
         if not isinstance(url, str):
@@ -157,8 +197,8 @@ class ImageTask(QueueTask):
 class FetchImageTask(ImageTask):
     _name = 'image_fetch'
 
-    def __init__(self, url, instance_uuid=None):
-        super(FetchImageTask, self).__init__(url)
+    def __init__(self, url, instance_uuid=None, trace=None):
+        super(FetchImageTask, self).__init__(url, trace=trace)
         self._instance_uuid = instance_uuid
 
     def json_dump(self):
@@ -92,6 +92,12 @@ class CleanerTestCase(test_shakenfist.ShakenFistTestCase):
         self.mock_libvirt = self.libvirt.start()
         self.addCleanup(self.libvirt.stop)
 
+        # Don't reuse a connection cached by another test
+        self.connection = mock.patch('shakenfist.util.LIBVIRT_CONNECTION',
+                                     None)
+        self.connection.start()
+        self.addCleanup(self.connection.stop)
+
         self.proctitle = mock.patch('setproctitle.setproctitle')
         self.mock_proctitle = self.proctitle.start()
         self.addCleanup(self.proctitle.stop)
@@ -102,38 +108,35 @@ class CleanerTestCase(test_shakenfist.ShakenFistTestCase):
 
     @mock.patch('shakenfist.db.see_this_node')
     @mock.patch('shakenfist.db.add_event')
+    @mock.patch('shakenfist.db.release_reservation')
     @mock.patch('shakenfist.etcd.get', side_effect=fake_get)
     @mock.patch('shakenfist.etcd.put', side_effect=fake_put)
     @mock.patch('os.path.exists', side_effect=fake_exists)
     @mock.patch('time.time', return_value=7)
     def test_update_power_states(self, mock_time, mock_exists, mock_put,
-                                 mock_get, mock_event, mock_see):
+                                 mock_get, mock_release, mock_event, mock_see):
         m = cleaner.Monitor('cleaner')
         m._update_power_states()
 
         self.assertEqual(
             [
-                mock.call('instance', None, 'running',
+                mock.call('instancestate', None, 'running',
                           {
                               'uuid': 'running',
                               'node': 'abigcomputer',
                               'power_state_previous': 'unknown',
                               'power_state': 'on',
                               'power_state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'shutoff',
+                mock.call('instancestate', None, 'shutoff',
                           {
                               'uuid': 'shutoff',
                               'node': 'abigcomputer',
                               'power_state_previous': 'unknown',
                               'power_state': 'off',
                               'power_state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'crashed',
+                mock.call('instancestate', None, 'crashed',
                           {
                               'uuid': 'crashed',
                               'node': 'abigcomputer',
@@ -142,10 +145,8 @@ class CleanerTestCase(test_shakenfist.ShakenFistTestCase):
                               'power_state_updated': 7,
                               'state': 'error',
                               'state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'crashed',
+                mock.call('instancestate', None, 'crashed',
                           {
                               'uuid': 'crashed',
                               'node': 'abigcomputer',
@@ -154,57 +155,45 @@ class CleanerTestCase(test_shakenfist.ShakenFistTestCase):
                               'power_state_updated': 7,
                               'state': 'error',
                               'state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'paused',
+                mock.call('instancestate', None, 'paused',
                           {
                               'uuid': 'paused',
                               'node': 'abigcomputer',
                               'power_state_previous': 'unknown',
                               'power_state': 'paused',
                               'power_state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'suspended',
+                mock.call('instancestate', None, 'suspended',
                           {
                               'uuid': 'suspended',
                               'node': 'abigcomputer',
                               'power_state_previous': 'unknown',
                               'power_state': 'paused',
                               'power_state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'foo',
+                mock.call('instancestate', None, 'foo',
                           {
                               'uuid': 'foo',
                               'node': 'abigcomputer',
                               'power_state_previous': 'unknown',
                               'power_state': 'off',
                               'power_state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'bar',
+                mock.call('instancestate', None, 'bar',
                           {
                               'uuid': 'bar',
                               'node': 'abigcomputer',
                               'power_state_previous': 'unknown',
                               'power_state': 'off',
                               'power_state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           }),
-                mock.call('instance', None, 'nofiles',
+                mock.call('instancestate', None, 'nofiles',
                           {
                               'uuid': 'nofiles',
                               'node': 'abigcomputer',
                               'state': 'error',
                               'state_updated': 7,
-                              'video': {'memory': 16384, 'model': 'cirrus'},
-                              'error_message': None,
                           })
             ],
             mock_put.mock_calls)
@@ -0,0 +1,336 @@
+import mock
+import time
+
+from shakenfist.config import SFConfig
+from shakenfist.daemons import queues
+from shakenfist import exceptions
+from shakenfist.tasks import (DeleteInstanceTask,
+                              FetchImageTask,
+                              PreflightInstanceTask,
+                              StartInstanceTask)
+from shakenfist.tests import test_shakenfist
+
+
+class WorkerPoolTestCase(test_shakenfist.ShakenFistTestCase):
+    def setUp(self):
+        super(WorkerPoolTestCase, self).setUp()
+
+        # Workers are forked after this patch, so they inherit it
+        self.mock_handle = mock.patch('shakenfist.daemons.queues.handle')
+        self.handle = self.mock_handle.start()
+        self.addCleanup(self.mock_handle.stop)
+
+        self.mock_libvirt = mock.patch('shakenfist.util.get_libvirt')
+        self.mock_libvirt.start()
+        self.addCleanup(self.mock_libvirt.stop)
+
+    def _run(self, pool, jobname):
+        w = pool.idle_worker()
+        pool.dispatch(jobname, {'tasks': []})
+        self.assertIsNone(pool.idle_worker())
+        pool.wait(5)
+        pool.reap()
+        return w
+
+    def test_persistent_worker(self):
+        pool = queues.WorkerPool(1, 10)
+        self.addCleanup(pool.close)
+
+        first = self._run(pool, 'job1')
+        second = self._run(pool, 'job2')
+        self.assertIs(first, second)
+        self.assertEqual(2, second.tasks)
+        self.assertIs(second, pool.idle_worker())
+
+        metrics = pool.metrics()
+        self.assertEqual(1, metrics['queue_workers'])
+        self.assertEqual(0, metrics['queue_workers_busy'])
+        self.assertEqual(2, metrics['queue_worker0_tasks'])
+        self.assertEqual(0, metrics['queue_workers_recycled'])
+        self.assertEqual(0, metrics['queue_delete_running'])
+        self.assertEqual(1, metrics['queue_delete_limit'])
+
+    def test_class_limit(self):
+        pool = queues.WorkerPool(4, 10)
+        self.addCleanup(pool.close)
+
+        pool.dispatch('job1', {'tasks': []})
+        self.assertFalse(pool.can_dispatch({'tasks': []}))
+        self.assertTrue(pool.can_dispatch({'tasks': [
+            FetchImageTask('http://example.com/image')]}))
+
+    def test_coalesced_fetch(self):
+        def fetch(jobname, workitem):
+            queues.NOTIFY('fetched', 'http://example.com/image')
+            time.sleep(0.5)
+
+        self.handle.side_effect = fetch
+
+        # Large enough that two fetches may run at once
+        pool = queues.WorkerPool(8, 10)
+        self.addCleanup(pool.close)
+
+        workitem = {'tasks': [
+            FetchImageTask('http://example.com/image', 'uuid42')]}
+        self.assertTrue(pool.can_dispatch(workitem))
+        pool.dispatch('job1', workitem)
+        self.assertEqual({'http://example.com/image': 'job1'},
+                         pool.fetches.fetching)
+
+        # Another workitem for the same image waits, even though a worker
+        # is free, until the fetch is done but before job1 is finished
+        self.assertFalse(pool.can_dispatch(workitem))
+        pool.wait(5)
+        pool.reap()
+        self.assertEqual({}, pool.fetches.fetching)
+        self.assertIsNotNone(pool.workers[0].jobname)
+        self.assertTrue(pool.can_dispatch(workitem))
+
+    def test_recycled(self):
+        pool = queues.WorkerPool(1, 1)
+        self.addCleanup(pool.close)
+
+        first = self._run(pool, 'job1')
+        self.assertTrue(first.retiring)
+        self.assertIsNone(pool.idle_worker())
+
+        first.process.join(5)
+        pool.reap()
+        self.assertEqual(1, pool.recycled)
+        self.assertEqual(0, pool.crashed)
+        self.assertIsNot(first, pool.idle_worker())
+        self.assertEqual(0, pool.workers[0].slot)
+
+
+class ConcurrencyTestCase(test_shakenfist.ShakenFistTestCase):
+    calm = {'load': 0.1, 'iowait': 1.0, 'disk_queue': 0.5}
+
+    def setUp(self):
+        super(ConcurrencyTestCase, self).setUp()
+
+        self.config = mock.patch('shakenfist.daemons.queues.config',
+                                 SFConfig())
+        self.config.start()
+        self.addCleanup(self.config.stop)
+
+    def test_fetch_coordinator(self):
+        fetches = queues.FetchCoordinator()
+        workitem = {'tasks': [
+            PreflightInstanceTask('uuid42'),
+            FetchImageTask('http://example.com/image', 'uuid42'),
+            StartInstanceTask('uuid42')]}
+        self.assertFalse(fetches.blocked(workitem))
+
+        fetches.claim('job1', workitem)
+        self.assertTrue(fetches.blocked(workitem))
+        self.assertFalse(fetches.blocked({'tasks': [
+            FetchImageTask('http://example.com/other')]}))
+
+        # A workitem which finishes without fetching, for example because it
+        # was redirected to another node, releases its claim
+        fetches.finished('job1')
+        self.assertFalse(fetches.blocked(workitem))
+
+    def test_task_class(self):
+        self.assertEqual('start', queues.task_class({'tasks': [
+            PreflightInstanceTask('uuid42'),
+            FetchImageTask('http://example.com/image', 'uuid42'),
+            StartInstanceTask('uuid42')]}))
+        self.assertEqual('fetch', queues.task_class({'tasks': [
+            FetchImageTask('http://example.com/image')]}))
+        self.assertEqual('delete', queues.task_class({'tasks': [
+            DeleteInstanceTask('uuid42')]}))
+
+    def test_grows_when_saturated(self):
+        limit = queues.ConcurrencyLimit('start', 16)
+        self.assertEqual(4, limit.limit)
+
+        # Not every slot was used, so there is no reason to grow
+        limit.started()
+        self.assertEqual([], limit.adjust(self.calm))
+        self.assertEqual(4, limit.limit)
+
+        for _ in range(3):
+            limit.started()
+        self.assertFalse(limit.has_capacity())
+        limit.adjust(self.calm)
+        self.assertEqual(5, limit.limit)
+        self.assertTrue(limit.has_capacity())
+
+    def test_never_exceeds_maximum(self):
+        limit = queues.ConcurrencyLimit('start', 2)
+        limit.started()
+        limit.adjust(self.calm)
+        limit.started()
+        limit.adjust(self.calm)
+        self.assertEqual(2, limit.limit)
+
+    def test_shrinks_under_pressure(self):
+        limit = queues.ConcurrencyLimit('fetch', 32)
+        self.assertEqual(8, limit.limit)
+
+        self.assertEqual(['disk_queue'], limit.adjust(
+            {'load': 0.1, 'iowait': 1.0, 'disk_queue': 12.0}))
+        self.assertEqual(4, limit.limit)
+
+        # Fetches aren't limited by CPU load
+        self.assertEqual([], limit.adjust(
+            {'load': 5.0, 'iowait': 1.0, 'disk_queue': 0.5}))
+
+        for _ in range(3):
+            limit.adjust({'load': 0.1, 'iowait': 90.0, 'disk_queue': 0.5})
+        self.assertEqual(1, limit.limit)
+
+    def test_shrinks_when_slow(self):
+        limit = queues.ConcurrencyLimit('delete', 8)
+        limit.limit = 4
+        for _ in range(4):
+            limit.started()
+        limit.finished(1.0)
+        for _ in range(3):
+            limit.finished(20.0)
+
+        self.assertEqual(['latency'], limit.adjust(self.calm))
+        self.assertEqual(2, limit.limit)
+        self.assertEqual(0, limit.running)
+
+
+class InstanceStartTestCase(test_shakenfist.ShakenFistTestCase):
+    @mock.patch('shakenfist.daemons.queues.instance_start')
+    @mock.patch('shakenfist.daemons.queues.instance_preflight',
+                return_value=(None, None))
+    @mock.patch('shakenfist.daemons.queues.image_fetch')
+    @mock.patch('shakenfist.db.add_event')
+    @mock.patch('shakenfist.db.update_instance_state')
+    @mock.patch('shakenfist.db.enqueue')
+    @mock.patch('shakenfist.db.resolve')
+    def test_fetches_deferred_to_start(self, mock_resolve, mock_enqueue,
+                                       mock_state, mock_event, mock_fetch,
+                                       mock_preflight, mock_start):
+        queues.handle('job1', {'tasks': [
+            PreflightInstanceTask('uuid42'),
+            FetchImageTask('http://example.com/image', 'uuid42'),
+            StartInstanceTask('uuid42')]})
+        mock_fetch.assert_not_called()
+        mock_start.assert_called_with(
+            'uuid42', [], image_urls=['http://example.com/image'])
+
+        queues.handle('job2', {'tasks': [
+            FetchImageTask('http://example.com/image')]})
+        mock_fetch.assert_called_with('http://example.com/image', None)
+
+    @mock.patch('shakenfist.db.get_lock')
+    @mock.patch('shakenfist.db.update_instance_state')
+    @mock.patch('shakenfist.db.add_event')
+    @mock.patch('shakenfist.db.add_network_users')
+    @mock.patch('shakenfist.db.get_instance_interfaces', return_value=[])
+    @mock.patch('shakenfist.db.enqueue_instance_error')
+    @mock.patch('shakenfist.util.get_libvirt')
+    @mock.patch('shakenfist.daemons.queues.image_fetch')
+    @mock.patch('shakenfist.virt.from_db')
+    def test_start_graph(self, mock_from_db, mock_fetch, mock_libvirt,
+                         mock_error, mock_interfaces, mock_users, mock_event,
+                         mock_state, mock_lock):
+        order = []
+        instance = mock_from_db.return_value
+        instance.db_entry = {'uuid': 'uuid42'}
+        instance.unique_label.return_value = ('instance', 'uuid42')
+        mock_fetch.side_effect = lambda url, uuid: order.append('fetch')
+        instance.create_config_drive.side_effect = \
+            lambda: order.append('config drive')
+        instance.allocate_instance_ports.side_effect = \
+            lambda: order.append('ports')
+        instance.create_disks.side_effect = \
+            lambda lock=None: order.append('disks')
+        instance.create_domain.side_effect = lambda: order.append('domain')
+
+        queues.instance_start('uuid42', [], image_urls=['http://image'])
+        self.assertEqual(['disks', 'domain'], order[-2:])
+        self.assertCountEqual(['fetch', 'config drive', 'ports'], order[:3])
+        mock_error.assert_not_called()
+
+    @mock.patch('shakenfist.db.get_lock')
+    @mock.patch('shakenfist.db.update_instance_state')
+    @mock.patch('shakenfist.db.add_event')
+    @mock.patch('shakenfist.db.enqueue_instance_error')
+    @mock.patch('shakenfist.util.get_libvirt')
+    @mock.patch('shakenfist.net.from_db', return_value=None)
+    @mock.patch('shakenfist.virt.from_db')
+    def test_start_missing_network(self, mock_from_db, mock_net, mock_libvirt,
+                                   mock_error, mock_event, mock_state,
+                                   mock_lock):
+        instance = mock_from_db.return_value
+        instance.db_entry = {'uuid': 'uuid42'}
+        instance.unique_label.return_value = ('instance', 'uuid42')
+
+        queues.instance_start('uuid42', [{'network_uuid': 'net1'}])
+        mock_error.assert_called_with('uuid42', 'missing network')
+        instance.create_domain.assert_not_called()
+
+
+class PreflightTestCase(test_shakenfist.ShakenFistTestCase):
+    def setUp(self):
+        super(PreflightTestCase, self).setUp()
+
+        for target in ['shakenfist.db.update_instance_state',
+                       'shakenfist.db.add_event',
+                       'shakenfist.db.release_reservation']:
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.mock_from_db = mock.patch('shakenfist.virt.from_db')
+        self.mock_from_db.start().return_value.db_entry = {
+            'uuid': 'uuid42', 'placement_attempts': 1}
+        self.addCleanup(self.mock_from_db.stop)
+
+        self.mock_scheduler = mock.patch('shakenfist.scheduler.Scheduler')
+        self.scheduler = self.mock_scheduler.start().return_value
+        self.addCleanup(self.mock_scheduler.stop)
+
+        self.mock_config = mock.patch(
+            'shakenfist.daemons.queues.config', SFConfig(NODE_NAME='node1'))
+        self.mock_config.start()
+        self.addCleanup(self.mock_config.stop)
+
+    def test_confirmed(self):
+        self.scheduler.confirm_reservation.return_value = True
+        self.assertEqual((None, None), queues.instance_preflight(
+            'uuid42', [], placement='node1', reservation='token'))
+        self.scheduler.place_instance.assert_not_called()
+
+    def test_reservation_missed(self):
+        self.scheduler.confirm_reservation.return_value = False
+        self.assertEqual((None, None), queues.instance_preflight(
+            'uuid42', [], placement='node1', reservation='token'))
+        self.scheduler.place_instance.assert_called_with(
+            mock.ANY, [], candidates=['node1'])
+
+    def test_redirected(self):
+        self.scheduler.nodes = ['node1', 'node2']
+        self.scheduler.place_instance.side_effect = [
+            exceptions.LowResourceException('full'), ['node2']]
+        self.scheduler.reserve.return_value = 'newtoken'
+
+        self.assertEqual(('node2', 'newtoken'), queues.instance_preflight(
+            'uuid42', [], placement='node1'))
+        self.scheduler.confirm_reservation.assert_not_called()
+        self.scheduler.place_instance.assert_called_with(
+            mock.ANY, [], candidates=['node2'])
+
+    @mock.patch('shakenfist.daemons.queues.instance_preflight',
+                return_value=('node2', 'newtoken'))
+    @mock.patch('shakenfist.db.place_instance')
+    @mock.patch('shakenfist.db.enqueue')
+    @mock.patch('shakenfist.db.resolve')
+    def test_redirect_carries_reservation(self, mock_resolve, mock_enqueue,
+                                          mock_place, mock_preflight):
+        queues.handle('job1', {'tasks': [
+            PreflightInstanceTask('uuid42', placement='node1',
+                                  reservation='token'),
+            StartInstanceTask('uuid42')]})
+        mock_place.assert_called_with('uuid42', 'node2')
+        mock_enqueue.assert_called_with('node2', {'tasks': [
+            PreflightInstanceTask('uuid42', placement='node2',
+                                  reservation='newtoken'),
+            StartInstanceTask('uuid42')]})
@@ -0,0 +1,171 @@
+import mock
+from prometheus_client import CollectorRegistry
+
+from shakenfist.config import SFConfigBase
+from shakenfist.daemons import resources
+from shakenfist.tests import test_shakenfist
+
+
+class FakeLibvirt(object):
+    VIR_DOMAIN_STATS_CPU_TOTAL = 2
+    VIR_DOMAIN_STATS_BALLOON = 4
+    VIR_DOMAIN_STATS_VCPU = 8
+    VIR_DOMAIN_STATS_INTERFACE = 16
+    VIR_DOMAIN_STATS_BLOCK = 32
+    VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE = 1
+
+
+class FakeConfig(SFConfigBase):
+    INSTANCE_METRICS_MAX: int = 2
+    METRICS_PUBLISH_CHANGE: float = 0.1
+    METRICS_PUBLISH_HEARTBEAT: int = 60
+
+
+fake_config = FakeConfig()
+
+
+def fake_domain(name):
+    d = mock.MagicMock()
+    d.name.return_value = name
+    return d
+
+
+class ResourcesTestCase(test_shakenfist.ShakenFistTestCase):
+    def test_get_domain_stats(self):
+        conn = mock.MagicMock()
+        conn.getAllDomainStats.return_value = [
+            (fake_domain('sf:uuid1'), {
+                'cpu.time': 1000,
+                'vcpu.current': 2,
+                'vcpu.maximum': 2,
+                'vcpu.0.delay': 5,
+                'vcpu.1.delay': 7,
+                'balloon.maximum': 2048,
+                'balloon.current': 1024,
+                'balloon.rss': 900,
+                'block.count': 2,
+                'block.0.rd.bytes': 10,
+                'block.0.wr.bytes': 20,
+                'block.0.rd.reqs': 1,
+                'block.0.wr.reqs': 2,
+                'block.1.rd.bytes': 30,
+                'block.1.wr.bytes': 40,
+                'block.1.rd.reqs': 3,
+                'block.1.wr.reqs': 4,
+                'net.count': 1,
+                'net.0.rx.bytes': 50,
+                'net.0.tx.bytes': 60,
+            }),
+            (fake_domain('other'), {}),
+        ]
+
+        self.assertEqual(
+            {
+                'sf:uuid1': {
+                    'cpu_time': 1000,
+                    'cpu_steal_time': 12,
+                    'vcpus': 2,
+                    'memory_max': 2048,
+                    'memory_actual': 1024,
+                    'memory_rss': 900,
+                    'disk_read_bytes': 40,
+                    'disk_write_bytes': 60,
+                    'disk_read_ops': 4,
+                    'disk_write_ops': 6,
+                    'network_read_bytes': 50,
+                    'network_write_bytes': 60,
+                },
+                'other': {
+                    'cpu_time': 0,
+                    'cpu_steal_time': 0,
+                    'vcpus': 0,
+                    'memory_max': 0,
+                    'memory_actual': 0,
+                    'memory_rss': 0,
+                    'disk_read_bytes': 0,
+                    'disk_write_bytes': 0,
+                    'disk_read_ops': 0,
+                    'disk_write_ops': 0,
+                    'network_read_bytes': 0,
+                    'network_write_bytes': 0,
+                },
+            },
+            resources._get_domain_stats(FakeLibvirt(), conn))
+
+        # Every domain's statistics come from a single call
+        conn.getAllDomainStats.assert_called_once_with(62, 1)
+
+    @mock.patch('shakenfist.daemons.resources.config', fake_config)
+    @mock.patch('shakenfist.db.get_instance',
+                side_effect=lambda u: {'uuid': u, 'namespace': 'ns-' + u})
+    def test_instance_metrics(self, mock_get_instance):
+        registry = CollectorRegistry()
+        metrics = resources.InstanceMetrics(registry=registry)
+
+        def domain_stats(cpu_time):
+            return {stat: cpu_time for stat, _, _ in metrics.METRICS}
+
+        def value(name, instance_uuid):
+            return registry.get_sample_value(
+                name, {'instance': instance_uuid,
+                       'namespace': 'ns-' + instance_uuid})
+
+        metrics.update({
+            'sf:uuid1': domain_stats(100),
+            'sf:uuid2': domain_stats(300),
+            'sf:uuid3': domain_stats(200),
+            'other': domain_stats(400),
+        })
+
+        # Only the two busiest instances are exported
+        self.assertEqual(300, value('instance_cpu_time_ns', 'uuid2'))
+        self.assertEqual(200, value('instance_disk_read_ops', 'uuid3'))
+        self.assertIsNone(value('instance_cpu_time_ns', 'uuid1'))
+
+        # Instances which are no longer running are removed, and namespaces
+        # are only looked up once per instance
+        metrics.update({
+            'sf:uuid1': domain_stats(100),
+            'sf:uuid2': domain_stats(300),
+        })
+        self.assertEqual(100, value('instance_cpu_time_ns', 'uuid1'))
+        self.assertIsNone(value('instance_cpu_time_ns', 'uuid3'))
+        self.assertEqual(3, mock_get_instance.call_count)
+
+    @mock.patch('shakenfist.daemons.resources.config', fake_config)
+    @mock.patch('shakenfist.db.update_metrics_bulk')
+    def test_metrics_publisher(self, mock_update):
+        publisher = resources.MetricsPublisher()
+        stats = {
+            'memory_available': 1000,
+            'disk_free': 5000,
+            'numa_cells': 1,
+            'numa_cell0_memory_available': 1000,
+            'disk_read_bytes': 42,
+        }
+
+        # Only the metrics the scheduler uses are published
+        self.assertTrue(publisher.publish(stats, ['uuid1']))
+        mock_update.assert_called_with({
+            'memory_available': 1000,
+            'disk_free': 5000,
+            'numa_cells': 1,
+            'numa_cell0_memory_available': 1000,
+        })
+
+        # Small changes and counters are not published
+        stats.update({'memory_available': 950, 'disk_read_bytes': 4242})
+        self.assertFalse(publisher.publish(stats, ['uuid1']))
+
+        # Large changes are
+        stats['numa_cell0_memory_available'] = 800
+        self.assertTrue(publisher.publish(stats, ['uuid1']))
+
+        # As are changes to the running instances
+        self.assertTrue(publisher.publish(stats, ['uuid1', 'uuid2']))
+        self.assertFalse(publisher.publish(stats, ['uuid2', 'uuid1']))
+
+        # And the heartbeat
+        publisher.published_at -= 61
+        self.assertTrue(publisher.publish(stats, ['uuid1', 'uuid2']))
+        self.assertEqual(4, mock_update.call_count)
@@ -1,10 +1,85 @@
+import copy
 import mock
 import time
 
+from shakenfist.config import config
 from shakenfist import db
+from shakenfist import idmanager
+from shakenfist import portmanager
 from shakenfist.tests import test_shakenfist
 
 
+class FakeEtcd(object):
+    """An in memory etcd which counts round trips."""
+
+    def __init__(self):
+        self.data = {}
+        self.revisions = {}
+        self.revision = 0
+        self.round_trips = 0
+
+    def _key(self, objecttype, subtype, name):
+        return '/'.join(str(x) for x in (objecttype, subtype, name))
+
+    def put(self, objecttype, subtype, name, data, ttl=None):
+        self.round_trips += 1
+        self.revision += 1
+        key = self._key(objecttype, subtype, name)
+        self.data[key] = data
+        self.revisions[key] = self.revision
+
+    def delete(self, objecttype, subtype, name):
+        self.round_trips += 1
+        self.data.pop(self._key(objecttype, subtype, name), None)
+        self.revisions.pop(self._key(objecttype, subtype, name), None)
+
+    def delete_all(self, objecttype, subtype, sort_order=None):
+        self.round_trips += 1
+        path = '%s/%s/' % (objecttype, subtype)
+        for k in [k for k in self.data if k.startswith(path)]:
+            del self.data[k]
+
+    def get(self, objecttype, subtype, name):
+        self.round_trips += 1
+        return self.data.get(self._key(objecttype, subtype, name))
+
+    def get_all(self, objecttype, subtype, sort_order=None):
+        self.round_trips += 1
+        path = '%s/%s/' % (objecttype, subtype)
+        return [v for k, v in self.data.items() if k.startswith(path)]
+
+    def get_all_dict(self, objecttype, subtype=None, sort_order=None,
+                     prefix=None):
+        self.round_trips += 1
+        if subtype is None and not prefix:
+            path = '%s/' % objecttype
+        else:
+            path = '%s/%s/%s' % (objecttype, subtype, prefix or '')
+        return {k: v for k, v in self.data.items() if k.startswith(path)}
+
+    def get_with_revision(self, objecttype, subtype, name):
+        self.round_trips += 1
+        key = self._key(objecttype, subtype, name)
+        return self.data.get(key), self.revisions.get(key, 0)
+
+    def compare_and_swap(self, objecttype, subtype, name, revision, data,
+                         also_put=None, also_delete=None):
+        self.round_trips += 1
+        key = self._key(objecttype, subtype, name)
+        if self.revisions.get(key, 0) != revision:
+            return False
+
+        self.revision += 1
+        self.data[key] = data
+        self.revisions[key] = self.revision
+        for put in also_put or []:
+            self.data[self._key(*put[:3])] = put[3]
+        for delete in also_delete or []:
+            self.data.pop(self._key(*delete), None)
+            self.revisions.pop(self._key(*delete), None)
+        return True
+
+
 class DBTestCase(test_shakenfist.ShakenFistTestCase):
     maxDiff = None
 
@@ -13,14 +88,11 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
 
     @mock.patch('shakenfist.etcd.put')
     def test_create_instance(self, mock_put):
-        db.create_instance('uuid42', 'barry', 1, 2048, 'disks',
-                           'sshkey', 'userdata', 'namespace',
-                           {'memory': 16384, 'model': 'cirrus'}, None)
+        i = db.create_instance('uuid42', 'barry', 1, 2048, 'disks',
+                               'sshkey', 'userdata', 'namespace',
+                               {'memory': 16384, 'model': 'cirrus'}, None)
 
         etcd_write = mock_put.mock_calls[0][1]
-        del etcd_write[3]['node']
-        del etcd_write[3]['state_updated']
-
         self.assertEqual(
             ('instance', None, 'uuid42',
              {
@@ -34,17 +106,55 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
                  'vdi_port': 0,
                  'user_data': 'userdata',
                  'block_devices': None,
-                 'state': 'initial',
                  'namespace': 'namespace',
-                 'power_state': 'initial',
                  'video': {'memory': 16384, 'model': 'cirrus'},
                  'node_history': [],
-                 'error_message': None,
                  'requested_placement': None,
+                 'cpu_policy': 'shared',
+                 'hugepages': None,
+             }),
+            etcd_write)
+
+        etcd_write = mock_put.mock_calls[1][1]
+        del etcd_write[3]['node']
+        del etcd_write[3]['state_updated']
+        self.assertEqual(
+            ('instancestate', None, 'uuid42',
+             {
+                 'state': 'initial',
+                 'power_state': 'initial',
+                 'error_message': None,
                  'placement_attempts': 0,
              }),
             etcd_write)
 
+        # The returned instance has both halves
+        self.assertEqual('userdata', i['user_data'])
+        self.assertEqual('initial', i['power_state'])
+
+    @mock.patch('shakenfist.etcd.get',
+                side_effect=[
+                    {'uuid': 'uuid42', 'user_data': 'big', 'state': 'old'},
+                    {'state': 'created', 'power_state': 'on'}])
+    def test_get_instance(self, mock_get):
+        i = db.get_instance('uuid42')
+        self.assertEqual(
+            {
+                'uuid': 'uuid42',
+                'user_data': 'big',
+                'state': 'created',
+                'power_state': 'on',
+                'video': {'memory': 16384, 'model': 'cirrus'},
+                'error_message': None,
+            }, i)
+
+    @mock.patch('shakenfist.etcd.get',
+                side_effect=[
+                    None,
+                    {'uuid': 'uuid42', 'user_data': 'big', 'state': 'old'}])
+    def test_get_instance_state_legacy(self, mock_get):
+        self.assertEqual({'state': 'old'}, db.get_instance_state('uuid42'))
+
     @mock.patch('shakenfist.etcd.get',
                 return_value={'uuid': 'uuid42', 'state': 'initial'})
     @mock.patch('shakenfist.etcd.put')
@@ -53,15 +163,13 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
         mock_get.assert_called()
 
         etcd_write = mock_put.mock_calls[0][1]
-        self.assertEqual(('instance', None, 'uuid42'), etcd_write[0:3])
+        self.assertEqual(('instancestate', None, 'uuid42'), etcd_write[0:3])
         self.assertTrue(time.time() - etcd_write[3]['state_updated'] < 3)
         del etcd_write[3]['state_updated']
         self.assertEqual(
             {
                 'state': 'created',
                 'uuid': 'uuid42',
-                'video': {'memory': 16384, 'model': 'cirrus'},
-                'error_message': None,
             },
             etcd_write[3])
 
@@ -81,7 +189,7 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
         mock_get.assert_called()
 
         etcd_write = mock_put.mock_calls[0][1]
-        self.assertEqual(('instance', None, 'uuid42'), etcd_write[0:3])
+        self.assertEqual(('instancestate', None, 'uuid42'), etcd_write[0:3])
         self.assertTrue(time.time() - etcd_write[3]['power_state_updated'] < 3)
         del etcd_write[3]['power_state_updated']
         self.assertEqual(
@@ -89,8 +197,6 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
                 'power_state': 'off',
                 'power_state_previous': 'on',
                 'uuid': 'uuid42',
-                'video': {'memory': 16384, 'model': 'cirrus'},
-                'error_message': None,
             },
             etcd_write[3])
 
@@ -128,7 +234,7 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
         mock_get.assert_called()
 
         etcd_write = mock_put.mock_calls[0][1]
-        self.assertEqual(('instance', None, 'uuid42'), etcd_write[0:3])
+        self.assertEqual(('instancestate', None, 'uuid42'), etcd_write[0:3])
         self.assertTrue(time.time() - etcd_write[3]['power_state_updated'] < 3)
         del etcd_write[3]['power_state_updated']
         self.assertEqual(
@@ -136,8 +242,6 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
                 'power_state': 'on',
                 'power_state_previous': 'transition-to-off',
                 'uuid': 'uuid42',
-                'video': {'memory': 16384, 'model': 'cirrus'},
-                'error_message': None,
             },
             etcd_write[3])
 
@@ -190,3 +294,337 @@ class DBTestCase(test_shakenfist.ShakenFistTestCase):
                 },
             },
             val)
+
+    @mock.patch('shakenfist.etcd.compare_and_swap', return_value=True)
+    @mock.patch('shakenfist.etcd.get_all', return_value=[{'port': 30000}])
+    @mock.patch('shakenfist.etcd.get_with_revision', return_value=(None, 0))
+    @mock.patch('socket.socket')
+    def test_allocate_console_ports(self, mock_socket, mock_get,
+                                    mock_get_all, mock_cas):
+        ports = db.allocate_console_ports('uuid42')
+        self.assertEqual([30001, 30002], ports)
+
+        # Both ports are recorded in a single write of the bitmap
+        self.assertEqual(1, mock_cas.call_count)
+        self.assertEqual(('consoleports', None, db.config.NODE_NAME, 0),
+                         mock_cas.mock_calls[0][1][0:4])
+        pb = portmanager.from_db(mock_cas.mock_calls[0][1][4])
+        self.assertEqual(3, pb.in_use_counter)
+
+    @mock.patch('shakenfist.etcd.compare_and_swap',
+                side_effect=[False, True])
+    @mock.patch('shakenfist.etcd.get_with_revision')
+    @mock.patch('socket.socket')
+    def test_allocate_console_ports_race(self, mock_socket, mock_get,
+                                         mock_cas):
+        first = portmanager.PortBlock(30000, 50000)
+        second = portmanager.PortBlock(30000, 50000)
+        second.reserve(30000)
+        second.reserve(30001)
+        mock_get.side_effect = [(first.save(), 10), (second.save(), 11)]
+
+        ports = db.allocate_console_ports('uuid42')
+        self.assertEqual([30002, 30003], ports)
+        self.assertEqual(11, mock_cas.mock_calls[1][1][3])
+
+    @mock.patch('shakenfist.etcd.compare_and_swap', return_value=True)
+    @mock.patch('shakenfist.etcd.get_with_revision')
+    def test_free_console_ports(self, mock_get, mock_cas):
+        pb = portmanager.PortBlock(30000, 50000)
+        pb.reserve(30000)
+        pb.reserve(30001)
+        mock_get.return_value = (pb.save(), 10)
+
+        db.free_console_ports([30000, 30001])
+        pb = portmanager.from_db(mock_cas.mock_calls[0][1][4])
+        self.assertEqual(0, pb.in_use_counter)
+
+    def test_allocate_network_vxids(self):
+        fake = FakeEtcd()
+        with mock.patch('shakenfist.db.etcd', fake):
+            n1 = db.allocate_network('10.0.0.0/24')
+            n2 = db.allocate_network('10.0.1.0/24')
+            self.assertEqual(1, n1['vxid'])
+            self.assertEqual(2, n2['vxid'])
+            self.assertEqual({'network_uuid': n2['uuid']},
+                             fake.data['vxlan/None/2'])
+
+            db.update_network_state(n1['uuid'], 'deleted')
+            self.assertNotIn('vxlan/None/1', fake.data)
+
+            n3 = db.allocate_network('10.0.2.0/24')
+            self.assertEqual(1, n3['vxid'])
+
+    def test_allocate_network_vxid_seeded_from_old_keys(self):
+        fake = FakeEtcd()
+        fake.data['vxlan/None/1'] = {'network_uuid': 'a'}
+        fake.data['vxlan/None/3'] = {'network_uuid': 'b'}
+        with mock.patch('shakenfist.db.etcd', fake):
+            self.assertEqual(2, db.allocate_network('10.0.0.0/24')['vxid'])
+            self.assertEqual(4, db.allocate_network('10.0.1.0/24')['vxid'])
+
+    def test_allocate_network_cost_is_flat(self):
+        # A benchmark of sorts: the etcd round trips needed to create a
+        # network should not grow with the number of networks which exist.
+        fake = FakeEtcd()
+        pool = idmanager.IdPool(db.VXLAN_ID_FIRST, db.VXLAN_ID_LAST)
+        pool.reserve_existing(range(1, 5000))
+        fake.data['allocator/None/vxlan'] = pool.save()
+
+        with mock.patch('shakenfist.db.etcd', fake):
+            db.allocate_network('10.0.0.0/24')
+            first_cost = fake.round_trips
+
+            for i in range(100):
+                db.allocate_network('10.0.0.0/24')
+
+            fake.round_trips = 0
+            n = db.allocate_network('10.0.0.0/24')
+            self.assertEqual(5101, n['vxid'])
+            self.assertEqual(first_cost, fake.round_trips)
+
+    def test_namespace_index(self):
+        fake = FakeEtcd()
+        fake.data['namespaceindex/None/version'] = {'version': 1}
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.NAMESPACE_INDEX_BUILT', False):
+            for i in range(20):
+                db.create_instance('uuid%d' % i, 'inst', 1, 1024, [], None,
+                                   None, 'ns%d' % (i % 10), None, None)
+                db.allocate_network('10.0.0.0/24', namespace='ns%d' % i)
+
+            fake.round_trips = 0
+            insts = list(db.get_instances(namespace='ns3'))
+            self.assertEqual(['uuid13', 'uuid3'],
+                             sorted(i['uuid'] for i in insts))
+            self.assertEqual('initial', insts[0]['state'])
+
+            # One index read, then two reads for each instance, regardless
+            # of how many other instances exist
+            self.assertEqual(6, fake.round_trips)
+
+            nets = list(db.get_networks(namespace='ns3'))
+            self.assertEqual(1, len(nets))
+            self.assertEqual(
+                20, len(list(db.get_instances(namespace='system'))))
+
+            db.hard_delete_instance('uuid3')
+            self.assertEqual(['uuid13'],
+                             [i['uuid'] for i in
+                              db.get_instances(namespace='ns3')])
+
+            db.hard_delete_network(nets[0]['uuid'])
+            self.assertEqual([], list(db.get_networks(namespace='ns3')))
+
+    def test_namespace_index_built_from_old_objects(self):
+        fake = FakeEtcd()
+        fake.data['instance/None/uuid1'] = {
+            'uuid': 'uuid1', 'namespace': 'foo', 'node': 'sf-1',
+            'state': 'created'}
+        fake.data['instance/None/uuid2'] = {
+            'uuid': 'uuid2', 'namespace': 'bar', 'node': 'sf-1',
+            'state': 'created'}
+        fake.data['network/None/floating'] = {
+            'uuid': 'floating', 'namespace': None}
+
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.NAMESPACE_INDEX_BUILT', False):
+            self.assertEqual(['uuid1'],
+                             [i['uuid'] for i in
+                              db.get_instances(namespace='foo')])
+            self.assertIn('namespaceindex/None/version', fake.data)
+
+            # The index is only built once
+            fake.round_trips = 0
+            list(db.get_instances(namespace='bar'))
+            self.assertEqual(3, fake.round_trips)
+
+    def test_persist_concurrent_instance_updates(self):
+        fake = FakeEtcd()
+        fake.data['instance/None/uuid1'] = {'uuid': 'uuid1'}
+        get_with_revision = fake.get_with_revision
+        interleaved = []
+
+        def racing_get_with_revision(objecttype, subtype, name):
+            d, revision = get_with_revision(objecttype, subtype, name)
+            if not interleaved:
+                # Another step writes after we have read the instance
+                interleaved.append(True)
+                db.persist_console_ports('uuid1', 30001, 30002)
+            return copy.deepcopy(d), revision
+
+        fake.get_with_revision = racing_get_with_revision
+        with mock.patch('shakenfist.db.etcd', fake):
+            db.persist_block_devices('uuid1', {'devices': []})
+
+        self.assertEqual(
+            {'uuid': 'uuid1', 'console_port': 30001, 'vdi_port': 30002,
+             'block_devices': {'devices': []}},
+            fake.data['instance/None/uuid1'])
+
+    def test_persist_instance_deleted_during_update(self):
+        fake = FakeEtcd()
+        fake.put('instance', None, 'uuid1', {'uuid': 'uuid1'})
+        get_with_revision = fake.get_with_revision
+        interleaved = []
+
+        def racing_get_with_revision(objecttype, subtype, name):
+            d, revision = get_with_revision(objecttype, subtype, name)
+            if not interleaved:
+                # The instance is deleted after we have read it
+                interleaved.append(True)
+                fake.delete('instance', None, 'uuid1')
+            return copy.deepcopy(d), revision
+
+        fake.get_with_revision = racing_get_with_revision
+        with mock.patch('shakenfist.db.etcd', fake):
+            db.persist_block_devices('uuid1', {'devices': []})
+
+        self.assertNotIn('instance/None/uuid1', fake.data)
+
+    def test_network_users(self):
+        fake = FakeEtcd()
+        fake.data['networkusers/%s/version' % config.NODE_NAME] = {
+            'version': 1}
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.NETWORK_USERS_INDEX_BUILT', False):
+            db.add_network_users('uuid1', ['net1', 'net2', 'net1'])
+            db.add_network_users('uuid2', ['net1'])
+            for i in range(100):
+                fake.data['networkinterface/None/iface%d' % i] = {
+                    'uuid': 'iface%d' % i, 'network_uuid': 'net1',
+                    'instance_uuid': 'other%d' % i, 'state': 'created'}
+
+            db.remove_network_users('uuid1', ['net1', 'net2'])
+
+            # One read, regardless of how many interfaces exist
+            fake.round_trips = 0
+            self.assertTrue(db.is_network_used('net1'))
+            self.assertFalse(db.is_network_used('net2'))
+            self.assertEqual(2, fake.round_trips)
+
+            db.remove_network_users('uuid2', ['net1'])
+            self.assertFalse(db.is_network_used('net1'))
+
+    def test_network_users_removed_on_hard_delete(self):
+        fake = FakeEtcd()
+        fake.data['networkusers/%s/version' % config.NODE_NAME] = {
+            'version': 1}
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.NETWORK_USERS_INDEX_BUILT', False):
+            db.create_instance('uuid1', 'inst', 1, 1024, [], None, None,
+                               'namespace', None, None)
+            db.place_instance('uuid1', config.NODE_NAME)
+
+            # A start which failed after recording its networks
+            db.add_network_users('uuid1', ['net1', 'net2'])
+            db.add_network_users('uuid2', ['net2'])
+
+            db.hard_delete_instance('uuid1')
+            self.assertFalse(db.is_network_used('net1'))
+            self.assertTrue(db.is_network_used('net2'))
+
+    def test_network_users_built_from_old_objects(self):
+        fake = FakeEtcd()
+        fake.data['instance/None/uuid1'] = {
+            'uuid': 'uuid1', 'node': config.NODE_NAME, 'state': 'created'}
+        fake.data['instance/None/uuid2'] = {
+            'uuid': 'uuid2', 'node': 'elsewhere', 'state': 'created'}
+        fake.data['networkinterface/None/iface1'] = {
+            'uuid': 'iface1', 'network_uuid': 'net1',
+            'instance_uuid': 'uuid1', 'state': 'created'}
+        fake.data['networkinterface/None/iface2'] = {
+            'uuid': 'iface2', 'network_uuid': 'net2',
+            'instance_uuid': 'uuid2', 'state': 'created'}
+
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.NETWORK_USERS_INDEX_BUILT', False):
+            self.assertTrue(db.is_network_used('net1'))
+            self.assertFalse(db.is_network_used('net2'))
+            self.assertIn('networkusers/%s/version' % config.NODE_NAME,
+                          fake.data)
+
+    def test_reservations(self):
+        fake = FakeEtcd()
+        with mock.patch('shakenfist.db.etcd', fake):
+            db.add_reservation('node1', 'uuid1', 1, 1024, 8)
+            db.add_reservation('node1', 'uuid2', 2, 2048, 8)
+            db.add_reservation('node2', 'uuid3', 4, 4096, 8)
+            fake.data['reservation/node2/uuid4'] = {
+                'instance_uuid': 'uuid4', 'cpus': 1, 'memory': 1024,
+                'disk': 8, 'expires': time.time() - 1}
+
+            r = db.get_reservations()
+            self.assertEqual(['uuid1', 'uuid2'], sorted(r['node1']))
+            self.assertEqual(['uuid3'], sorted(r['node2']))
+            self.assertEqual(2048, r['node1']['uuid2']['memory'])
+
+            # uuid1 is now running, and uuid4 has expired
+            db.release_reservations('node1', ['uuid1'])
+            db.release_reservations('node2', [])
+            self.assertEqual(['reservation/node1/uuid2',
+                              'reservation/node2/uuid3'],
+                             sorted(k for k in fake.data
+                                    if k.startswith('reservation/')))
+
+    def test_allocate_macaddresses(self):
+        fake = FakeEtcd()
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.MAC_BLOCK', 0x123):
+            macs = db.allocate_macaddresses(['if1', 'if2', 'if3'])
+            self.assertEqual(['02:00:00:12:30:00', '02:00:00:12:30:01',
+                              '02:00:00:12:30:02'], macs)
+
+            # Read the pool, seed it from older addresses, and then record
+            # all three addresses in a single transaction
+            self.assertEqual(3, fake.round_trips)
+            self.assertEqual({'interface_uuid': 'if2'},
+                             fake.data['macaddress/None/02:00:00:12:30:01'])
+
+            db._release_macaddress('02:00:00:12:30:01', 'if2')
+            self.assertNotIn('macaddress/None/02:00:00:12:30:01', fake.data)
+            self.assertEqual(['02:00:00:12:30:01'],
+                             db.allocate_macaddresses(['if4']))
+
+    def test_user_supplied_macaddress_not_released(self):
+        fake = FakeEtcd()
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.MAC_BLOCK', 0x123):
+            self.assertEqual(['02:00:00:12:30:00'],
+                             db.allocate_macaddresses(['if1']))
+
+            # A second interface which the user gave the same address
+            db.create_network_interface(
+                'if2', {'network_uuid': 'net1', 'address': '10.0.0.2',
+                        'model': 'virtio', 'macaddress': '02:00:00:12:30:00'},
+                'uuid1', 0)
+            db.update_network_interface_state('if2', 'deleted')
+
+            self.assertEqual({'interface_uuid': 'if1'},
+                             fake.data['macaddress/None/02:00:00:12:30:00'])
+            self.assertEqual(['02:00:00:12:30:01'],
+                             db.allocate_macaddresses(['if3']))
+
+    def test_allocate_macaddresses_seeded_from_random(self):
+        fake = FakeEtcd()
+        fake.data['macaddress/None/02:00:00:12:30:00'] = {}
+        fake.data['macaddress/None/02:00:00:12:40:00'] = {}
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.MAC_BLOCK', 0x123):
+            self.assertEqual(['02:00:00:12:30:01'],
+                             db.allocate_macaddresses(['if1']))
+
+    def test_allocate_macaddresses_block_full(self):
+        fake = FakeEtcd()
+        pool = idmanager.IdPool(0xfff * db.MAC_BLOCK_SIZE,
+                                0xfff * db.MAC_BLOCK_SIZE + 4095)
+        pool.get_free_ids(4095)
+        fake.data['allocator/macaddress/4095'] = pool.save()
+
+        with mock.patch('shakenfist.db.etcd', fake), \
+                mock.patch('shakenfist.db.MAC_BLOCK', 0xfff):
+            # Both addresses must come from the same block, so we wrap
+            # around to the first block
+            self.assertEqual(['02:00:00:00:00:00', '02:00:00:00:00:01'],
+                             db.allocate_macaddresses(['if1', 'if2']))
+            self.assertEqual(0, db.MAC_BLOCK)
@@ -129,6 +129,8 @@ class TaskEncodingETCDtestCase(test_shakenfist.ShakenFistTestCase):
         encoded = '''{
     "instance_uuid": "fake_uuid",
     "network": [],
+    "placement": null,
+    "reservation": null,
     "task": "instance_preflight",
     "version": 1
 }'''
@@ -494,3 +496,25 @@ class GeneralETCDtestCase(test_shakenfist.ShakenFistTestCase):
             }
         },
             data)
+
+
+class CompareAndSwapTestCase(test_shakenfist.ShakenFistTestCase):
+    @mock.patch('etcd3gw.Etcd3Client.transaction',
+                return_value={'succeeded': True})
+    def test_compare_and_swap(self, mock_txn):
+        self.assertTrue(etcd.compare_and_swap(
+            'consoleports', None, 'node1', 42, {'a': 1},
+            also_delete=[('console', 'node1', 30000)]))
+
+        txn = mock_txn.mock_calls[0][1][0]
+        self.assertEqual(42, txn['compare'][0]['mod_revision'])
+        self.assertEqual('MOD', txn['compare'][0]['target'])
+        self.assertEqual(2, len(txn['success']))
+        self.assertIn('request_put', txn['success'][0])
+        self.assertIn('request_delete_range', txn['success'][1])
+
+    @mock.patch('etcd3gw.Etcd3Client.transaction',
+                return_value={'succeeded': False})
+    def test_compare_and_swap_fails(self, mock_txn):
+        self.assertFalse(etcd.compare_and_swap(
+            'consoleports', None, 'node1', 42, {'a': 1}))
@@ -23,6 +23,9 @@ class FakeScheduler(object):
     def place_instance(self, *args, **kwargs):
         return config.NODE_NAME
 
+    def reserve(self, *args, **kwargs):
+        pass
+
 
 class FakeInstance(object):
     def __init__(self, namespace=None):
@@ -707,7 +710,7 @@ class ExternalApiInstanceTestCase(ExternalApiTestCase):
                     'state': 'created',
                     'uuid': '847b0327-9b17-4148-b4ed-be72b6722c17',
                 }])
-    @mock.patch('shakenfist.db.get_instance',
+    @mock.patch('shakenfist.db.get_instance_state',
                 return_value={
                     'state': 'deleted',
                 },)
@@ -748,7 +751,7 @@ class ExternalApiInstanceTestCase(ExternalApiTestCase):
                     'state': 'created',
                     'uuid': '847b0327-9b17-4148-b4ed-be72b6722c17',
                 }])
-    @mock.patch('shakenfist.db.get_instance',
+    @mock.patch('shakenfist.db.get_instance_state',
                 return_value={
                     'state': 'deleted',
                 },)
@@ -811,6 +814,101 @@ class ExternalApiInstanceTestCase(ExternalApiTestCase):
             resp.get_json())
         self.assertEqual(400, resp.status_code)
 
+    def test_post_instance_invalid_cpu_policy(self):
+        resp = self.client.post('/instances',
+                                headers={'Authorization': self.auth_header},
+                                data=json.dumps({
+                                    'name': 'test_instance',
+                                    'cpus': 1,
+                                    'memory': 1024,
+                                    'network': [],
+                                    'disk': [{'size': 8}],
+                                    'cpu_policy': 'exclusive'
+                                }))
+        self.assertEqual(
+            {'error': 'cpu_policy must be either shared or dedicated',
+             'status': 400},
+            resp.get_json())
+        self.assertEqual(400, resp.status_code)
+
+    def test_post_instance_invalid_hugepages(self):
+        resp = self.client.post('/instances',
+                                headers={'Authorization': self.auth_header},
+                                data=json.dumps({
+                                    'name': 'test_instance',
+                                    'cpus': 1,
+                                    'memory': 1024,
+                                    'network': [],
+                                    'disk': [{'size': 8}],
+                                    'hugepages': '4K'
+                                }))
+        self.assertEqual(
+            {'error': 'hugepages must be one of 1G, 2M', 'status': 400},
+            resp.get_json())
+        self.assertEqual(400, resp.status_code)
+
+    def test_post_instance_unaligned_hugepages(self):
+        resp = self.client.post('/instances',
+                                headers={'Authorization': self.auth_header},
+                                data=json.dumps({
+                                    'name': 'test_instance',
+                                    'cpus': 1,
+                                    'memory': 1536,
+                                    'network': [],
+                                    'disk': [{'size': 8}],
+                                    'hugepages': '1G'
+                                }))
+        self.assertEqual(
+            {'error': 'memory must be a multiple of the 1G hugepage size',
+             'status': 400},
+            resp.get_json())
+        self.assertEqual(400, resp.status_code)
+
+    def test_post_instances_batch_not_list(self):
+        resp = self.client.post('/instances/batch',
+                                headers={'Authorization': self.auth_header},
+                                data=json.dumps({
+                                    'instances': {'name': 'test_instance'}
+                                }))
+        self.assertEqual(
+            {'error': 'instances must be a list of instance specifications',
+             'status': 400},
+            resp.get_json())
+        self.assertEqual(400, resp.status_code)
+
+    def test_post_instances_batch_unknown_field(self):
+        resp = self.client.post('/instances/batch',
+                                headers={'Authorization': self.auth_header},
+                                data=json.dumps({
+                                    'instances': [{
+                                        'name': 'test_instance',
+                                        'cpus': 1,
+                                        'memory': 1024,
+                                        'colour': 'blue',
+                                    }]
+                                }))
+        self.assertEqual(
+            {'error': 'unknown instance specification fields: colour',
+             'status': 400},
+            resp.get_json())
+        self.assertEqual(400, resp.status_code)
+
+    def test_post_instances_batch_no_disk(self):
+        resp = self.client.post('/instances/batch',
+                                headers={'Authorization': self.auth_header},
+                                data=json.dumps({
+                                    'instances': [{
+                                        'name': 'test_instance',
+                                        'cpus': 1,
+                                        'memory': 1024,
+                                        'disk': None,
+                                    }]
+                                }))
+        self.assertEqual(
+            {'error': 'instance must specify at least one disk', 'status': 400},
+            resp.get_json())
+        self.assertEqual(400, resp.status_code)
+
     def test_post_instance_invalid_network(self):
         resp = self.client.post('/instances',
                                 headers={'Authorization': self.auth_header},
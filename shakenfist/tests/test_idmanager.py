@@ -0,0 +1,68 @@
+from shakenfist import idmanager
+from shakenfist.tests import test_shakenfist
+
+
+class IdManagerTestCase(test_shakenfist.ShakenFistTestCase):
+    def test_get_free_id(self):
+        ip = idmanager.IdPool(1, 3)
+        self.assertEqual(1, ip.get_free_id())
+        self.assertEqual(2, ip.get_free_id())
+        self.assertEqual(3, ip.get_free_id())
+        self.assertEqual(None, ip.get_free_id())
+
+    def test_release_is_fifo(self):
+        ip = idmanager.IdPool(1, 100)
+        for _ in range(5):
+            ip.get_free_id()
+
+        ip.release(3)
+        ip.release(1)
+        self.assertEqual(False, ip.is_free(2))
+        self.assertEqual(True, ip.is_free(3))
+        self.assertEqual(3, ip.get_free_id())
+        self.assertEqual(1, ip.get_free_id())
+        self.assertEqual(6, ip.get_free_id())
+
+    def test_release_ignores_unallocated(self):
+        ip = idmanager.IdPool(1, 100)
+        ip.get_free_id()
+        ip.release(1)
+        ip.release(1)
+        ip.release(0)
+        ip.release(42)
+        self.assertEqual([1], ip.free)
+
+    def test_reserve_existing(self):
+        ip = idmanager.IdPool(1, 100)
+        ip.reserve_existing([5, 2, 1, 0, 101])
+        self.assertEqual([1, 2, 5], ip.reserved)
+        self.assertEqual(False, ip.is_free(5))
+
+        self.assertEqual([3, 4, 6], ip.get_free_ids(3))
+        self.assertEqual([], ip.reserved)
+
+        # Releasing a previously reserved ID makes it available again
+        ip.release(2)
+        self.assertEqual(2, ip.get_free_id())
+
+    def test_release_reserved_above_high_water_mark(self):
+        ip = idmanager.IdPool(1, 100)
+        ip.reserve_existing([50])
+        ip.release(50)
+        self.assertEqual([], ip.reserved)
+        self.assertEqual([], ip.free)
+        self.assertEqual(True, ip.is_free(50))
+
+    def test_get_free_ids_exhausted(self):
+        ip = idmanager.IdPool(1, 3)
+        self.assertEqual([1, 2, 3], ip.get_free_ids(5))
+
+    def test_save_and_load(self):
+        ip = idmanager.IdPool(1, 100)
+        ip.reserve_existing([1, 4])
+        ip.get_free_ids(2)
+        ip.release(2)
+        loaded = idmanager.from_db(ip.save())
+        self.assertEqual(4, loaded.next_id)
+        self.assertEqual([2], loaded.free)
+        self.assertEqual([4], loaded.reserved)
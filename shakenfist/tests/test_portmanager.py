@@ -0,0 +1,55 @@
+from shakenfist import portmanager
+from shakenfist.tests import test_shakenfist
+
+
+class PortManagerTestCase(test_shakenfist.ShakenFistTestCase):
+    def test_is_free_and_reserve(self):
+        pb = portmanager.PortBlock(30000, 30099)
+        self.assertEqual(True, pb.is_free(30024))
+        self.assertEqual(True, pb.reserve(30024))
+        self.assertEqual(False, pb.is_free(30024))
+        self.assertEqual(False, pb.reserve(30024))
+
+        pb.release(30024)
+        self.assertEqual(True, pb.is_free(30024))
+        self.assertEqual(0, pb.in_use_counter)
+
+    def test_out_of_range(self):
+        pb = portmanager.PortBlock(30000, 30099)
+        self.assertEqual(False, pb.is_free(29999))
+        self.assertEqual(False, pb.reserve(30100))
+
+        # Instances which never started have a port of zero
+        pb.release(0)
+        self.assertEqual(0, pb.in_use_counter)
+
+    def test_get_free_port(self):
+        pb = portmanager.PortBlock(30000, 30009)
+        pb.reserve(30001)
+
+        self.assertEqual(30000, pb.get_free_port())
+        self.assertEqual(30002, pb.get_free_port())
+
+        # The search continues from the hint, and wraps around
+        pb.release(30000)
+        for port in range(30003, 30010):
+            self.assertEqual(port, pb.get_free_port())
+        self.assertEqual(30000, pb.get_free_port())
+        self.assertEqual(None, pb.get_free_port())
+
+    def test_save_and_load(self):
+        pb = portmanager.PortBlock(30000, 50000)
+        pb.reserve(30000)
+        pb.reserve(42042)
+        pb.reserve(50000)
+        pb.get_free_port()
+
+        loaded = portmanager.from_db(pb.save())
+        self.assertEqual(4, loaded.in_use_counter)
+        self.assertEqual(pb.hint, loaded.hint)
+        self.assertEqual(False, loaded.is_free(42042))
+        self.assertEqual(False, loaded.is_free(50000))
+        self.assertEqual(True, loaded.is_free(42043))
+
+        # A full range of ports fits in a few kilobytes
+        self.assertTrue(len(pb.save()['portmanager.v1']['in_use']) < 4096)
@@ -1,4 +1,9 @@
+import copy
+import json
 import mock
+import testtools.content
+import threading
+import time
 
 from shakenfist import exceptions
 from shakenfist import scheduler
@@ -52,11 +57,25 @@ class FakeDB(object):
     def get_instance_interfaces(self, inst_uuid):
         return self.interfaces[inst_uuid]
 
+    def get_all_network_interfaces(self):
+        ret = []
+        for inst_uuid in (self.interfaces or {}):
+            for i in range(len(self.interfaces[inst_uuid])):
+                iface = copy.copy(self.interfaces[inst_uuid][i])
+                iface.update({'uuid': '%s-iface%d' % (inst_uuid, i),
+                              'instance_uuid': inst_uuid,
+                              'state': 'created'})
+                ret.append(iface)
+        return ret
+
     def get_metrics(self, node_name):
         if node_name not in self.metrics:
             raise exceptions.ReadException
         return self.metrics[node_name]
 
+    def get_all_metrics(self):
+        return dict(self.metrics)
+
 
 fake_config = SFConfig(
     NODE_NAME='node01',
@@ -87,9 +106,37 @@ class SchedulerTestCase(test_shakenfist.ShakenFistTestCase):
         self.addCleanup(self.mock_see_this_node.stop)
 
         self.mock_add_event = mock.patch('shakenfist.db.add_event')
-        self.mock_add_event.start()
+        self.mock_event = self.mock_add_event.start()
         self.addCleanup(self.mock_add_event.stop)
 
+        self.reservations = {}
+        self.mock_get_reservations = mock.patch(
+            'shakenfist.db.get_reservations', return_value=self.reservations)
+        self.mock_get_reservations.start()
+        self.addCleanup(self.mock_get_reservations.stop)
+
+        # Each test builds its own locality index, without etcd watches
+        self.mock_locality_index = mock.patch(
+            'shakenfist.scheduler.LOCALITY_INDEX', None)
+        self.mock_locality_index.start()
+        self.addCleanup(self.mock_locality_index.stop)
+
+        self.mock_locality_start = mock.patch(
+            'shakenfist.scheduler.LocalityIndex.start')
+        self.mock_locality_start.start()
+        self.addCleanup(self.mock_locality_start.stop)
+
+        # Likewise for the cluster state
+        self.mock_cluster_state = mock.patch(
+            'shakenfist.scheduler.CLUSTER_STATE', None)
+        self.mock_cluster_state.start()
+        self.addCleanup(self.mock_cluster_state.stop)
+
+        self.mock_cluster_state_start = mock.patch(
+            'shakenfist.scheduler.ClusterState.start')
+        self.mock_cluster_state_start.start()
+        self.addCleanup(self.mock_cluster_state_start.stop)
+
 
 class LowResourceTestCase(SchedulerTestCase):
     """Test low resource exceptions."""
@@ -104,11 +151,18 @@ class LowResourceTestCase(SchedulerTestCase):
         mock_db_get_nodes.start()
         self.addCleanup(mock_db_get_nodes.stop)
 
-        mock_db_get_metrics = mock.patch('shakenfist.db.get_metrics',
-                                         side_effect=self.fake_db.get_metrics)
+        mock_db_get_metrics = mock.patch(
+            'shakenfist.db.get_all_metrics',
+            side_effect=self.fake_db.get_all_metrics)
         mock_db_get_metrics.start()
         self.addCleanup(mock_db_get_metrics.stop)
 
+        mock_db_get_interfaces = mock.patch(
+            'shakenfist.db.get_all_network_interfaces',
+            side_effect=self.fake_db.get_all_network_interfaces)
+        mock_db_get_interfaces.start()
+        self.addCleanup(mock_db_get_interfaces.stop)
+
         self.mock_get_instances = mock.patch('shakenfist.db.get_instances')
         self.mock_get_instances.start()
         self.addCleanup(self.mock_get_instances.stop)
@@ -220,6 +274,138 @@ class LowResourceTestCase(SchedulerTestCase):
                                 [])
         self.assertEqual('No nodes with enough disk space', str(exc))
 
+        # The whole decision is recorded as a single event
+        self.assertEqual(1, self.mock_event.call_count)
+        args = self.mock_event.call_args[0]
+        self.assertEqual(('instance', 'fake_uuid', 'schedule', 'decision'),
+                         args[:4])
+        decision = json.loads(args[5])
+        self.assertEqual('failed: No nodes with enough disk space',
+                         decision['outcome'])
+        self.assertEqual(
+            ['initial candidates', 'enough actual CPU', 'enough idle CPU',
+             'enough idle RAM', 'enough idle disk'],
+            [s['stage'] for s in decision['stages']])
+        self.assertEqual(0, decision['stages'][-1]['surviving'])
+        self.assertEqual(
+            {'node1_net': 'not enough disk', 'node2': 'not enough disk',
+             'node3': 'not enough disk', 'node4': 'not enough disk'},
+            decision['stages'][-1]['eliminated'])
+        self.assertNotIn('candidates', decision['stages'][0])
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    def test_dedicated_cpus(self, mock_get_image_meta):
+        metrics = {
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'disk_free': 2000*1024*1024*1024,
+            'numa_cells': 1,
+            'numa_cell0_cpu_max': 4,
+            'numa_cell0_cpu_available': 4,
+            'numa_cell0_memory_available': 22000,
+        }
+        self.fake_db.set_node_metrics_same(metrics)
+        self.fake_db.metrics['node3'] = dict(metrics)
+        self.fake_db.metrics['node3'].update({
+            'numa_cell0_cpu_available': 1,
+            'cpu_pinned': 3,
+            'cpu_total_instance_vcpus': 3,
+        })
+
+        fake_inst = FakeInstance()
+        fake_inst.db_setup(cpus=2, memory=1024, cpu_policy='dedicated',
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        nodes = scheduler.Scheduler().place_instance(fake_inst, [])
+        self.assertSetEqual({'node2', 'node4'}, set(nodes))
+
+        # Shared instances can still use the CPUs which aren't pinned
+        fake_inst.db_entry['cpu_policy'] = 'shared'
+        nodes = scheduler.Scheduler().place_instance(fake_inst, [])
+        self.assertSetEqual({'node2', 'node3', 'node4'}, set(nodes))
+
+        fake_inst.db_entry.update({'cpu_policy': 'dedicated', 'cpus': 5})
+        exc = self.assertRaises(exceptions.LowResourceException,
+                                scheduler.Scheduler().place_instance,
+                                fake_inst,
+                                [])
+        self.assertEqual('No nodes with enough dedicated CPUs', str(exc))
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    def test_shared_cpus_exclude_pinned(self, mock_get_image_meta):
+        metrics = {
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'disk_free': 2000*1024*1024*1024,
+        }
+        self.fake_db.set_node_metrics_same(metrics)
+
+        # Three CPUs are pinned, so only the last is overcommitted and it
+        # already runs 15 shared vCPUs
+        self.fake_db.metrics['node3'] = dict(metrics)
+        self.fake_db.metrics['node3'].update({
+            'cpu_pinned': 3,
+            'cpu_total_instance_vcpus': 3 + 15,
+        })
+
+        fake_inst = FakeInstance()
+        fake_inst.db_setup(cpus=2, memory=1024,
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        nodes = scheduler.Scheduler().place_instance(fake_inst, [])
+        self.assertSetEqual({'node2', 'node4'}, set(nodes))
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    @mock.patch('shakenfist.db.add_reservation')
+    def test_hugepages(self, mock_add_reservation, mock_get_image_meta):
+        metrics = {
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'memory_hugepages_2m_free': 4096,
+            'disk_free': 2000*1024*1024*1024,
+        }
+        self.fake_db.set_node_metrics_same(metrics)
+        self.fake_db.metrics['node3'] = dict(metrics)
+        self.fake_db.metrics['node3']['memory_hugepages_2m_free'] = 1024
+
+        fake_inst = FakeInstance('uuid42')
+        fake_inst.db_setup(cpus=1, memory=2048, hugepages='2M',
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        s = scheduler.Scheduler()
+        nodes = s.place_instance(fake_inst, [])
+        self.assertSetEqual({'node2', 'node4'}, set(nodes))
+        decision = json.loads(self.mock_event.mock_calls[-1][1][5])
+        self.assertIn('enough free hugepages',
+                      [st['stage'] for st in decision['stages']])
+        self.assertNotIn('enough idle RAM',
+                         [st['stage'] for st in decision['stages']])
+
+        # Hugepage reservations don't consume general RAM
+        s.reserve(fake_inst, 'node2')
+        mock_add_reservation.assert_called_with(
+            'node2', 'uuid42', 1, 0, 8, hugepages={'hugepages_2m': 2048},
+            token=mock.ANY)
+
+        fake_inst.db_entry['hugepages'] = '1G'
+        exc = self.assertRaises(exceptions.LowResourceException,
+                                scheduler.Scheduler().place_instance,
+                                fake_inst,
+                                [])
+        self.assertEqual('No nodes with enough free hugepages', str(exc))
+
     @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
     def test_ok(self, mock_get_image_meta):
         self.fake_db.set_node_metrics_same({
@@ -240,6 +426,256 @@ class LowResourceTestCase(SchedulerTestCase):
         self.assertSetEqual(set(self.fake_db.nodes)-{'node1_net', },
                             set(nodes))
 
+        self.assertEqual(1, self.mock_event.call_count)
+        decision = json.loads(self.mock_event.call_args[0][5])
+        self.assertEqual('placed on %s' % nodes[0], decision['outcome'])
+        self.assertEqual({'node1_net': 'is the network node'},
+                         decision['stages'][-2]['eliminated'])
+        self.assertEqual(3, decision['stages'][-1]['surviving'])
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    def test_debug_decision(self, mock_get_image_meta):
+        self.fake_db.set_node_metrics_same({
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'disk_free': 2000*1024*1024*1024
+        })
+
+        fake_inst = FakeInstance()
+        fake_inst.db_setup(cpus=1, memory=1024,
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        fake_config = SFConfig(SCHEDULER_DEBUG=True)
+        with mock.patch('shakenfist.scheduler.config', fake_config):
+            nodes = scheduler.Scheduler().place_instance(fake_inst, [])
+
+        decision = json.loads(self.mock_event.call_args[0][5])
+        self.assertEqual(self.fake_db.nodes,
+                         decision['stages'][0]['candidates'])
+        self.assertEqual(nodes, decision['stages'][-1]['candidates'])
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    def test_place_instances_debits_resources(self, mock_get_image_meta):
+        self.fake_db.set_node_metrics_same({
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'disk_free': 2000*1024*1024*1024
+        })
+
+        # Each node has room for four of these instances once the system
+        # reservation is taken into account
+        batch = []
+        for i in range(12):
+            fake_inst = FakeInstance('uuid%d' % i)
+            fake_inst.db_setup(cpus=1, memory=4096,
+                               block_devices={'devices': [
+                                   {'size': 8, 'base': 'some-os'}
+                               ]})
+            batch.append((fake_inst, [], None))
+
+        s = scheduler.Scheduler()
+        placements = s.place_instances(batch)
+        for node in ['node2', 'node3', 'node4']:
+            self.assertEqual(4, placements.count(node))
+        self.assertEqual(4 * 4096,
+                         s._reserved('memory')[s.node_index['node2']])
+
+        # Only the network node has room left, and only for four more. A
+        # batch which doesn't fit leaves the accounting alone.
+        batch = []
+        for i in range(5):
+            fake_inst = FakeInstance('uuid-more%d' % i)
+            fake_inst.db_setup(cpus=1, memory=4096,
+                               block_devices={'devices': []})
+            batch.append((fake_inst, [], None))
+        exc = self.assertRaises(exceptions.LowResourceException,
+                                s.place_instances, batch)
+        self.assertEqual('No nodes with enough idle RAM', str(exc))
+        self.assertEqual(0,
+                         s._reserved('memory')[s.node_index['node1_net']])
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    @mock.patch('shakenfist.db.add_reservation')
+    def test_reservations(self, mock_add_reservation, mock_get_image_meta):
+        self.fake_db.set_node_metrics_same({
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'disk_free': 2000*1024*1024*1024
+        })
+
+        # Another API server has placed a large instance on node2 which
+        # hasn't started yet
+        self.reservations['node2'] = {
+            'other': {'instance_uuid': 'other', 'cpus': 1,
+                      'memory': 16000, 'disk': 8,
+                      'expires': time.time() + 900}
+        }
+
+        fake_inst = FakeInstance('uuid42')
+        fake_inst.db_setup(cpus=1, memory=4096,
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        s = scheduler.Scheduler()
+        nodes = s.place_instance(fake_inst, [])
+        self.assertSetEqual({'node3', 'node4'}, set(nodes))
+
+        s.reserve(fake_inst, 'node3')
+        mock_add_reservation.assert_called_with('node3', 'uuid42', 1, 4096, 8,
+                                                hugepages=None,
+                                                token=mock.ANY)
+
+        # An instance doesn't compete with its own reservation, for example
+        # during preflight on the node it was placed on
+        self.assertEqual(['node3'], s.place_instance(
+            fake_inst, [], candidates=['node3']))
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    @mock.patch('shakenfist.db.add_reservation')
+    def test_confirm_reservation(self, mock_add_reservation,
+                                 mock_get_image_meta):
+        self.fake_db.set_node_metrics_same({
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'disk_free': 2000*1024*1024*1024
+        })
+
+        fake_inst = FakeInstance('uuid42')
+        fake_inst.db_setup(cpus=1, memory=4096,
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        s = scheduler.Scheduler()
+        token = s.reserve(fake_inst, 'node3')
+        self.assertEqual(token, mock_add_reservation.call_args[1]['token'])
+        self.assertTrue(s.confirm_reservation(fake_inst, 'node3', token))
+
+        # A stale token, or a reservation on another node, is a miss
+        self.assertFalse(s.confirm_reservation(fake_inst, 'node3', 'stale'))
+        self.assertFalse(s.confirm_reservation(fake_inst, 'node2', token))
+
+        # As is a node which has since filled up
+        s.reservations['node3']['other'] = {
+            'instance_uuid': 'other', 'cpus': 1, 'memory': 16000, 'disk': 8,
+            'expires': time.time() + 900}
+        self.assertFalse(s.confirm_reservation(fake_inst, 'node3', token))
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    @mock.patch('shakenfist.db.add_reservation')
+    def test_confirm_reservation_numa(self, mock_add_reservation,
+                                      mock_get_image_meta):
+        metrics = {
+            'cpu_max_per_instance': 16,
+            'cpu_max': 4,
+            'memory_available': 22000,
+            'memory_max': 24000,
+            'memory_hugepages_2m_free': 2048,
+            'disk_free': 2000*1024*1024*1024,
+            'numa_cells': 2,
+            'numa_cell0_cpu_max': 2,
+            'numa_cell0_cpu_available': 2,
+            'numa_cell0_memory_available': 11000,
+            'numa_cell0_hugepages_2m_free': 1024,
+            'numa_cell1_cpu_max': 2,
+            'numa_cell1_cpu_available': 2,
+            'numa_cell1_memory_available': 11000,
+            'numa_cell1_hugepages_2m_free': 1024,
+        }
+        self.fake_db.set_node_metrics_same(metrics)
+
+        # node3 has enough hugepages in total, but not in the cell which the
+        # instance's CPUs would be pinned to
+        self.fake_db.metrics['node3'] = dict(metrics)
+        self.fake_db.metrics['node3'].update({
+            'numa_cell0_cpu_max': 4,
+            'numa_cell0_cpu_available': 4,
+            'numa_cell0_hugepages_2m_free': 0,
+            'numa_cell1_hugepages_2m_free': 2048,
+        })
+
+        # The instance is larger than any one cell of the other nodes, so it
+        # spans both of them there
+        fake_inst = FakeInstance('uuid42')
+        fake_inst.db_setup(cpus=4, memory=2048, cpu_policy='dedicated',
+                           hugepages='2M',
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        s = scheduler.Scheduler()
+        nodes = s.place_instance(fake_inst, [])
+        self.assertNotIn('node3', nodes)
+        token = s.reserve(fake_inst, nodes[0])
+        self.assertTrue(s.confirm_reservation(fake_inst, nodes[0], token))
+        token = s.reserve(fake_inst, 'node3')
+        self.assertFalse(s.confirm_reservation(fake_inst, 'node3', token))
+
+        # Without hugepages nothing ties the memory to those cells
+        fake_inst.db_entry['hugepages'] = None
+        self.assertTrue(s.confirm_reservation(fake_inst, 'node3', token))
+
+
+class BenchmarkTestCase(SchedulerTestCase):
+    """Placement latency as the cluster grows."""
+
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    @mock.patch('shakenfist.db.get_instances', return_value=[])
+    @mock.patch('shakenfist.db.get_all_network_interfaces', return_value=[])
+    def test_placement_latency(self, mock_ifaces, mock_instances,
+                               mock_get_image_meta):
+        fake_inst = FakeInstance()
+        fake_inst.db_setup(cpus=1, memory=1024,
+                           block_devices={'devices': [
+                               {'size': 8, 'base': 'some-os'}
+                           ]})
+
+        latencies = {}
+        for node_count in [100, 1000, 10000]:
+            fake_db = FakeDB(['node%d' % i for i in range(node_count)])
+            for i in range(node_count):
+                # Every third node is too full to pass the filters
+                fake_db.metrics['node%d' % i] = {
+                    'cpu_max_per_instance': 16,
+                    'cpu_max': 4,
+                    'cpu_total_instance_vcpus': 64 if i % 3 == 0 else 8,
+                    'memory_available': 22000,
+                    'memory_max': 24000,
+                    'disk_free': 2000*1024*1024*1024
+                }
+
+            with mock.patch('shakenfist.scheduler.CLUSTER_STATE', None), \
+                    mock.patch('shakenfist.db.get_nodes',
+                               side_effect=fake_db.get_nodes), \
+                    mock.patch('shakenfist.db.get_all_metrics',
+                               side_effect=fake_db.get_all_metrics):
+                s = scheduler.Scheduler()
+                start = time.time()
+                for i in range(10):
+                    nodes = s.place_instance(fake_inst, [])
+                latencies[node_count] = (time.time() - start) / 10
+
+            self.assertEqual(node_count - len(range(0, node_count, 3)),
+                             len(nodes))
+
+        self.addDetail('latencies', testtools.content.text_content(
+            ', '.join('%d nodes: %.1fms' % (n, latencies[n] * 1000)
+                      for n in sorted(latencies))))
+
+        # A generous bound, this is about catching quadratic behaviour
+        self.assertLess(latencies[10000], 1.0)
+
 
 class CorrectAllocationTestCase(SchedulerTestCase):
     """Test correct node allocation."""
@@ -263,11 +699,18 @@ class CorrectAllocationTestCase(SchedulerTestCase):
         mock_db_get_nodes.start()
         self.addCleanup(mock_db_get_nodes.stop)
 
-        mock_db_get_metrics = mock.patch('shakenfist.db.get_metrics',
-                                         side_effect=self.fake_db.get_metrics)
+        mock_db_get_metrics = mock.patch(
+            'shakenfist.db.get_all_metrics',
+            side_effect=self.fake_db.get_all_metrics)
         mock_db_get_metrics.start()
         self.addCleanup(mock_db_get_metrics.stop)
 
+        mock_db_get_interfaces = mock.patch(
+            'shakenfist.db.get_all_network_interfaces',
+            side_effect=self.fake_db.get_all_network_interfaces)
+        mock_db_get_interfaces.start()
+        self.addCleanup(mock_db_get_interfaces.stop)
+
         self.mock_get_instances = mock.patch(
             'shakenfist.db.get_instances',
             side_effect=self.fake_db.get_instances)
@@ -321,14 +764,16 @@ class CorrectAllocationTestCase(SchedulerTestCase):
         nets = [{'network_uuid': 'uuid-net1'}]
 
         nodes = scheduler.Scheduler().place_instance(fake_inst, nets)
-        self.assertSetEqual(set(['node3']), set(nodes))
+        self.assertEqual('node3', nodes[0])
+        self.assertSetEqual(set(self.fake_db.nodes)-{'node1_net', },
+                            set(nodes))
 
 
-class FindMostTestCase(SchedulerTestCase):
-    """Test basic information source to scheduler."""
+class WeigherTestCase(SchedulerTestCase):
+    """Test the ordering of candidates which pass the filters."""
 
     def setUp(self):
-        super(FindMostTestCase, self).setUp()
+        super(WeigherTestCase, self).setUp()
 
         self.fake_db = FakeDB(['node1_net', 'node2', 'node3', 'node4'],
                               {'node3': [{'uuid': 'inst-1',
@@ -346,11 +791,32 @@ class FindMostTestCase(SchedulerTestCase):
         mock_db_get_nodes.start()
         self.addCleanup(mock_db_get_nodes.stop)
 
-        mock_db_get_metrics = mock.patch('shakenfist.db.get_metrics',
-                                         side_effect=self.fake_db.get_metrics)
+        mock_db_get_metrics = mock.patch(
+            'shakenfist.db.get_all_metrics',
+            side_effect=self.fake_db.get_all_metrics)
         mock_db_get_metrics.start()
         self.addCleanup(mock_db_get_metrics.stop)
 
+        mock_db_get_interfaces = mock.patch(
+            'shakenfist.db.get_all_network_interfaces',
+            side_effect=self.fake_db.get_all_network_interfaces)
+        mock_db_get_interfaces.start()
+        self.addCleanup(mock_db_get_interfaces.stop)
+
+        mock_db_get_instances = mock.patch(
+            'shakenfist.db.get_instances',
+            side_effect=self.fake_db.get_instances)
+        mock_db_get_instances.start()
+        self.addCleanup(mock_db_get_instances.stop)
+
+    def _instance(self, images=None):
+        fake_inst = FakeInstance()
+        fake_inst.db_setup(cpus=1, memory=1024,
+                           block_devices={'devices': [
+                               {'size': 8, 'base': image}
+                               for image in images or []]})
+        return fake_inst
+
     @mock.patch('shakenfist.db.get_image_metadata_all',
                 return_value={
                     '/sf/image/095fdd2b66625412aa/node2': {
@@ -373,12 +839,13 @@ class FindMostTestCase(SchedulerTestCase):
                         }
                     })
     def test_most_matching_images(self, mock_get_meta_all):
-        req_images = ['req_image1']
+        self.fake_db.set_node_metrics_same({})
         candidates = ['node1_net', 'node2', 'node3', 'node4']
 
-        finalists = scheduler.Scheduler()._find_most_matching_images(
-            req_images, candidates)
-        self.assertSetEqual(set(['node2']), set(finalists))
+        ordered = scheduler.Scheduler()._weigh(
+            self._instance(), [], ['req_image1'], candidates)
+        self.assertEqual('node2', ordered[0])
+        self.assertSetEqual(set(candidates), set(ordered))
 
     @mock.patch('shakenfist.db.get_image_metadata_all',
                 return_value={
@@ -402,16 +869,251 @@ class FindMostTestCase(SchedulerTestCase):
                         }
                     })
     def test_most_matching_images_big(self, mock_get_meta_all):
+        self.fake_db.set_node_metrics_same({})
         candidates = ['node1_net', 'node2', 'node3', 'node4']
+        s = scheduler.Scheduler()
+
+        ordered = s._weigh(self._instance(), [],
+                           ['req_image1', 'req_image2'], list(candidates))
+        self.assertEqual('node1_net', ordered[0])
+        self.assertEqual('node4', ordered[-1])
 
-        finalists = scheduler.Scheduler()._find_most_matching_images(
-                    ['req_image1'], candidates)
-        self.assertSetEqual(set(['node1_net']), set(finalists))
+        ordered = s._weigh(self._instance(), [], ['req_image2'],
+                           list(candidates))
+        self.assertSetEqual({'node1_net', 'node2', 'node3'},
+                            set(ordered[:3]))
 
-        finalists = scheduler.Scheduler()._find_most_matching_images(
-                    ['req_image1', 'req_image2'], candidates)
-        self.assertSetEqual(set(['node1_net']), set(finalists))
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    def test_spread_and_pack(self, mock_get_meta_all):
+        for node, (memory, vcpus, load) in {
+                'node2': (20000, 4, 0.5),
+                'node3': (10000, 32, 2.0),
+                'node4': (4000, 48, 3.5)}.items():
+            self.fake_db.metrics[node] = {
+                'cpu_max': 4,
+                'cpu_total_instance_vcpus': vcpus,
+                'cpu_load_5': load,
+                'memory_available': memory,
+            }
+        candidates = ['node2', 'node3', 'node4']
+        s = scheduler.Scheduler()
+
+        self.assertEqual(['node2', 'node3', 'node4'],
+                         s._weigh(self._instance(), [], [], list(candidates)))
+
+        fake_config = SFConfig(SCHEDULER_STRATEGY='pack')
+        with mock.patch('shakenfist.scheduler.config', fake_config):
+            self.assertEqual(
+                ['node4', 'node3', 'node2'],
+                s._weigh(self._instance(), [], [], list(candidates)))
+
+        # Network locality can outweigh free resources
+        self.fake_db.instances = {'node4': [{'uuid': 'inst-2', 'node': 'node4',
+                                             'state': 'created'}]}
+        self.fake_db.interfaces = {'inst-2': [{'network_uuid': 'uuid-net2'}]}
+        fake_config = SFConfig(SCHEDULER_WEIGHT_NETWORK_LOCALITY=10)
+        with mock.patch('shakenfist.scheduler.LOCALITY_INDEX', None), \
+                mock.patch('shakenfist.scheduler.config', fake_config):
+            self.assertEqual(
+                'node4',
+                s._weigh(self._instance(), ['uuid-net2'], [],
+                         list(candidates))[0])
+
+        # A multiplier of zero disables a weigher
+        fake_config = SFConfig(SCHEDULER_WEIGHT_FREE_RAM=0,
+                               SCHEDULER_WEIGHT_LOAD=0)
+        with mock.patch('shakenfist.scheduler.config', fake_config):
+            self.assertEqual(
+                ['node2', 'node3', 'node4'],
+                s._weigh(self._instance(), [], [], list(candidates)))
 
-        finalists = scheduler.Scheduler()._find_most_matching_images(
-                    ['req_image2'], candidates)
-        self.assertSetEqual(set(['node1_net', 'node2', 'node3']), set(finalists))
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value=None)
+    def test_numa_fit(self, mock_get_meta_all):
+        self.fake_db.metrics['node2'] = {
+            'cpu_max': 8,
+            'memory_available': 16384,
+            'numa_cells': 2,
+            'numa_cell0_cpu_max': 4,
+            'numa_cell0_cpu_available': 4,
+            'numa_cell0_memory_available': 8192,
+            'numa_cell1_cpu_max': 4,
+            'numa_cell1_cpu_available': 4,
+            'numa_cell1_memory_available': 8192,
+        }
+        self.fake_db.metrics['node3'] = {
+            'cpu_max': 8,
+            'memory_available': 12000,
+        }
+        candidates = ['node2', 'node3']
+        s = scheduler.Scheduler()
+
+        fake_inst = self._instance()
+        fake_inst.db_entry['memory'] = 10000
+        self.assertEqual(['node3', 'node2'],
+                         s._weigh(fake_inst, [], [], list(candidates)))
+
+        # Smaller instances fit in a cell on either node
+        self.assertEqual(['node2', 'node3'],
+                         s._weigh(self._instance(), [], [], list(candidates)))
+
+    def test_default_weigher(self):
+        # A weigher which doesn't override weigh() leaves the order alone
+        self.assertEqual([0.0, 0.0],
+                         list(scheduler.Weigher().weigh(None, [0, 2], {})))
+
+
+class LocalityIndexTestCase(test_shakenfist.ShakenFistTestCase):
+    def test_networks(self):
+        li = scheduler.LocalityIndex()
+        li.instance_changed('inst1', {'node': 'node1', 'state': 'created'})
+        li.instance_changed('inst2', {'node': 'node1', 'state': 'created'})
+        li.interface_changed('if1', {'instance_uuid': 'inst1',
+                                     'network_uuid': 'net1'})
+        li.interface_changed('if2', {'instance_uuid': 'inst2',
+                                     'network_uuid': 'net1'})
+        li.interface_changed('if3', {'instance_uuid': 'inst2',
+                                     'network_uuid': 'net2'})
+        self.assertEqual({'net1', 'net2'}, li.networks_on_node('node1'))
+
+        # Interfaces can be seen before the instance is placed
+        li.interface_changed('if4', {'instance_uuid': 'inst3',
+                                     'network_uuid': 'net3'})
+        self.assertEqual(set(), li.networks_on_node('node2'))
+        li.instance_changed('inst3', {'node': 'node2', 'state': 'initial'})
+        self.assertEqual({'net3'}, li.networks_on_node('node2'))
+
+        # Deleting one user of a network leaves the other
+        li.instance_changed('inst1', {'node': 'node1', 'state': 'deleted'})
+        self.assertEqual({'net1', 'net2'}, li.networks_on_node('node1'))
+        li.interface_changed('if3', None)
+        self.assertEqual({'net1'}, li.networks_on_node('node1'))
+
+        # Moving an instance moves its networks
+        li.instance_changed('inst2', {'node': 'node2', 'state': 'created'})
+        self.assertEqual(set(), li.networks_on_node('node1'))
+        self.assertEqual({'net1', 'net3'}, li.networks_on_node('node2'))
+
+    def test_images(self):
+        li = scheduler.LocalityIndex()
+        self.assertFalse(li.has_images())
+        li.image_changed('/sf/image/abc/node1', {'url': 'http://a'})
+        li.image_changed('/sf/image/def/node1', {'url': 'http://b'})
+        li.image_changed('/sf/image/abc/node2', {'url': 'http://a'})
+        self.assertTrue(li.has_images())
+        self.assertEqual({'http://a', 'http://b'}, li.images_on_node('node1'))
+
+        li.image_changed('/sf/image/abc/node1', None)
+        self.assertEqual({'http://b'}, li.images_on_node('node1'))
+        self.assertEqual({'http://a'}, li.images_on_node('node2'))
+
+    @mock.patch('shakenfist.db.get_instances',
+                return_value=[{'uuid': 'inst1', 'node': 'node1',
+                               'state': 'created'}])
+    @mock.patch('shakenfist.db.get_all_network_interfaces',
+                return_value=[])
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value={})
+    @mock.patch('shakenfist.etcd.watch_prefix')
+    def test_follows_watch(self, mock_watch, mock_images, mock_ifaces,
+                           mock_instances):
+        changes = {
+            'instancestate': [],
+            'networkinterface': [
+                ('/sf/networkinterface/if1',
+                 {'instance_uuid': 'inst1', 'network_uuid': 'net1'})],
+            'image': [],
+        }
+        mock_watch.side_effect = lambda t: (iter(changes[t]), mock.MagicMock())
+
+        with mock.patch('shakenfist.scheduler.LOCALITY_INDEX', None):
+            li = scheduler.get_locality_index()
+            for i in range(50):
+                if li.stale and li.networks_on_node('node1'):
+                    break
+                time.sleep(0.1)
+
+            self.assertEqual({'net1'}, li.networks_on_node('node1'))
+
+            # The watches have ended, so the next caller gets a new index
+            self.assertTrue(li.stale)
+            self.assertIsNot(li, scheduler.get_locality_index())
+
+    @mock.patch('shakenfist.db.get_instances', return_value=[])
+    @mock.patch('shakenfist.db.get_all_network_interfaces',
+                return_value=[])
+    @mock.patch('shakenfist.db.get_image_metadata_all', return_value={})
+    @mock.patch('shakenfist.etcd.watch_prefix')
+    def test_reloaded_when_watch_stalls(self, mock_watch, mock_images,
+                                        mock_ifaces, mock_instances):
+        stalled = threading.Event()
+        self.addCleanup(stalled.set)
+
+        def watch(objecttype):
+            def changes():
+                stalled.wait()
+                yield from []
+            return changes(), mock.MagicMock()
+        mock_watch.side_effect = watch
+
+        with mock.patch('shakenfist.scheduler.LOCALITY_INDEX', None):
+            li = scheduler.get_locality_index()
+            self.assertIs(li, scheduler.get_locality_index())
+
+            # The watches never end, but the index is still rebuilt
+            li.created -= 24 * 3600
+            self.assertFalse(li.stale)
+            self.assertIsNot(li, scheduler.get_locality_index())
+
+
+class ClusterStateTestCase(test_shakenfist.ShakenFistTestCase):
+    def test_changes(self):
+        cs = scheduler.ClusterState()
+        cs.metrics_changed('/sf/metrics/node1/',
+                           {'fqdn': 'node1', 'metrics': {'cpu_max': 4}})
+        cs.metrics_changed('/sf/metrics/node2/',
+                           {'fqdn': 'node2', 'metrics': {'cpu_max': 8}})
+        cs.reservation_changed('/sf/reservation/node1/inst1',
+                               {'instance_uuid': 'inst1', 'cpus': 1,
+                                'expires': time.time() + 900})
+        cs.reservation_changed('/sf/reservation/node1/inst2',
+                               {'instance_uuid': 'inst2', 'cpus': 1,
+                                'expires': time.time() - 1})
+
+        generation, nodes, node_index, columns, reservations = cs.snapshot()
+        self.assertEqual(['node1', 'node2'], nodes)
+        self.assertEqual({'node1': 0, 'node2': 1}, node_index)
+        self.assertEqual([4, 8], list(columns['cpu_max']))
+        self.assertEqual(['inst1'], list(reservations['node1']))
+
+        # Arrays are only rebuilt when something changes
+        self.assertIs(columns, cs.snapshot()[3])
+        cs.metrics_changed('/sf/metrics/node2/', None)
+        self.assertEqual(['node1'], cs.snapshot()[1])
+        self.assertNotEqual(generation, cs.generation)
+
+        cs.reservation_changed('/sf/reservation/node1/inst1', None)
+        cs.reservation_changed('/sf/reservation/node1/inst2', None)
+        self.assertEqual({}, cs.reservations)
+
+    @mock.patch('shakenfist.util.RecordedOperation')
+    @mock.patch('shakenfist.db.add_event')
+    @mock.patch('shakenfist.db.get_all_metrics',
+                return_value={'node1': {'cpu_max': 4}})
+    @mock.patch('shakenfist.db.get_reservations', return_value={})
+    @mock.patch('shakenfist.scheduler.ClusterState.start')
+    def test_schedulers_share_state(self, mock_start, mock_reservations,
+                                    mock_metrics, mock_event, mock_op):
+        with mock.patch('shakenfist.scheduler.CLUSTER_STATE', None):
+            s1 = scheduler.Scheduler()
+            s2 = scheduler.Scheduler()
+            self.assertEqual(['node1'], s2.nodes)
+            self.assertIs(s1.columns, s2.columns)
+            self.assertEqual(1, mock_metrics.call_count)
+
+            # A change from the watch is seen at the next placement, without
+            # fetching metrics again
+            scheduler.get_cluster_state().metrics_changed(
+                '/sf/metrics/node2/',
+                {'fqdn': 'node2', 'metrics': {'cpu_max': 8}})
+            s1._refresh_metrics_if_stale()
+            self.assertEqual(['node1', 'node2'], s1.nodes)
+            self.assertEqual(1, mock_metrics.call_count)
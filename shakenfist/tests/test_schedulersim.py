@@ -0,0 +1,68 @@
+import os
+import tempfile
+
+from shakenfist.client import schedulersim
+from shakenfist.config import config
+from shakenfist import db
+from shakenfist import scheduler
+from shakenfist.tests import test_shakenfist
+
+
+class SchedulerSimTestCase(test_shakenfist.ShakenFistTestCase):
+    def test_generate_trace(self):
+        trace = schedulersim.generate_trace(100, seed=42)
+        self.assertEqual(100, len(trace))
+        self.assertEqual(trace, schedulersim.generate_trace(100, seed=42))
+
+        created = set()
+        for entry in trace:
+            if entry['op'] == 'create':
+                created.add(entry['uuid'])
+            else:
+                self.assertIn(entry['uuid'], created)
+
+    def test_trace_round_trip(self):
+        trace = schedulersim.generate_trace(10, seed=42)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'trace')
+            schedulersim.save_trace(trace, path)
+            self.assertEqual(trace, schedulersim.load_trace(path))
+
+    def test_installed_restores_db(self):
+        get_nodes = db.get_nodes
+        cluster = schedulersim.SimulatedCluster(3)
+        with cluster.installed():
+            self.assertEqual(3, len(db.get_nodes()))
+            self.assertEqual(cluster.locality, scheduler.LOCALITY_INDEX)
+            self.assertEqual(cluster.state, scheduler.get_cluster_state())
+        self.assertEqual(get_nodes, db.get_nodes)
+
+    def test_simulate(self):
+        # Each node fits four instances
+        cluster = schedulersim.SimulatedCluster(
+            4, memory=config.get('RAM_SYSTEM_RESERVATION') * 1024 + 4096)
+        trace = [{'op': 'create', 'uuid': 'inst%d' % i, 'cpus': 1,
+                  'memory': 1024, 'disk': 8, 'networks': [],
+                  'images': ['http://image']}
+                 for i in range(20)]
+        trace.append({'op': 'delete', 'uuid': 'inst0'})
+
+        report = schedulersim.simulate(cluster, trace, metrics_interval=3,
+                                       start_delay=2)
+        self.assertEqual(21, report['requests'])
+        self.assertEqual(16, report['placed'])
+        self.assertEqual(4, report['rejected'])
+        self.assertEqual(1, report['deleted'])
+        self.assertEqual(0, report['overcommitted_nodes'])
+        self.assertEqual(4, report['nodes_in_use'])
+        self.assertIn('p99_ms', report['latency'])
+        self.assertEqual({}, cluster.state.reservations)
+
+    def test_default_weights_spread(self):
+        # A node gets the whole locality bonus for already having a network
+        # or image, so locality must not outweigh spreading instances out
+        cluster = schedulersim.SimulatedCluster(50)
+        trace = schedulersim.generate_trace(300, seed=42, delete_ratio=0)
+        report = schedulersim.simulate(cluster, trace)
+        self.assertEqual(300, report['placed'])
+        self.assertGreaterEqual(report['nodes_in_use'], 45)
@@ -59,6 +59,14 @@ class TasksEqTestCase(test_shakenfist.ShakenFistTestCase):
         self.assertNotEqual(tasks.FetchImageTask('http://someurl', 'fake_uuid'),
                             tasks.FetchImageTask('http://someurm', 'fake_uuid'))
 
+        # Tasks queued from different traces are still the same task
+        self.assertEqual(
+            tasks.DeleteInstanceTask('abcd', trace='00-aaaa-01-01'),
+            tasks.DeleteInstanceTask('abcd', trace='00-bbbb-02-01'))
+        self.assertEqual(
+            hash(tasks.DeleteInstanceTask('abcd', trace='00-aaaa-01-01')),
+            hash(tasks.DeleteInstanceTask('abcd')))
+
 
 class InstanceTasksTestCase(test_shakenfist.ShakenFistTestCase):
     def test_InstanceTask(self):
@@ -0,0 +1,120 @@
+import json
+import mock
+import os
+import tempfile
+
+from shakenfist.config import SFConfigBase
+from shakenfist import tasks
+from shakenfist import tracing
+from shakenfist import util
+from shakenfist.tests import test_shakenfist
+
+
+class TracingTestCase(test_shakenfist.ShakenFistTestCase):
+    def setUp(self):
+        super(TracingTestCase, self).setUp()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.trace_path = os.path.join(self.tmpdir, 'traces.json')
+        self.addCleanup(self._remove_tmpdir)
+
+        trace_path = self.trace_path
+
+        class FakeConfig(SFConfigBase):
+            NODE_NAME: str = 'node1'
+            TRACE_PATH: str = trace_path
+
+        self.config = mock.patch('shakenfist.tracing.config', FakeConfig())
+        self.mock_config = self.config.start()
+        self.addCleanup(self.config.stop)
+
+    def _remove_tmpdir(self):
+        if os.path.exists(self.trace_path):
+            os.unlink(self.trace_path)
+        os.rmdir(self.tmpdir)
+
+    def _spans(self):
+        spans = []
+        with open(self.trace_path) as f:
+            for line in f.readlines():
+                request = json.loads(line)
+                for resource in request['resourceSpans']:
+                    for scope in resource['scopeSpans']:
+                        spans.extend(scope['spans'])
+        return {s['name']: s for s in spans}
+
+    def test_nested(self):
+        with tracing.Span('outer', {'instance': 'abcd'}) as outer:
+            with tracing.Span('inner') as inner:
+                self.assertEqual(
+                    '00-%s-%s-01' % (outer.trace_id, inner.span_id),
+                    tracing.traceparent())
+            self.assertFalse(os.path.exists(self.trace_path))
+        self.assertEqual(None, tracing.traceparent())
+
+        spans = self._spans()
+        self.assertEqual(outer.trace_id, spans['inner']['traceId'])
+        self.assertEqual(outer.span_id, spans['inner']['parentSpanId'])
+        self.assertNotIn('parentSpanId', spans['outer'])
+        self.assertEqual(
+            [{'key': 'instance', 'value': {'stringValue': 'abcd'}}],
+            spans['outer']['attributes'])
+        self.assertEqual({'code': tracing.STATUS_OK}, spans['outer']['status'])
+
+    def test_remote_parent(self):
+        with tracing.Span('api'):
+            task = tasks.StartInstanceTask('abcd')
+        self.assertIsNotNone(task.trace())
+
+        decoded = tasks.StartInstanceTask(**{
+            k: v for k, v in task.json_dump().items()
+            if k not in ['task', 'version']})
+        with tracing.Span('workitem', parent=decoded.trace()) as workitem:
+            pass
+
+        spans = self._spans()
+        self.assertEqual(spans['api']['traceId'], workitem.trace_id)
+        self.assertEqual(spans['api']['spanId'],
+                         spans['workitem']['parentSpanId'])
+
+    def test_error(self):
+        def fail():
+            with tracing.Span('failing'):
+                raise ValueError('oops')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(
+            {'code': tracing.STATUS_ERROR, 'message': 'ValueError: oops'},
+            self._spans()['failing']['status'])
+
+    def test_traced(self):
+        @tracing.traced('decorated')
+        def func(value):
+            tracing.set_attribute('value', value)
+            return value * 2
+
+        self.assertEqual(4, func(2))
+        self.assertEqual(
+            [{'key': 'value', 'value': {'intValue': '2'}}],
+            self._spans()['decorated']['attributes'])
+
+    def test_dependency_graph(self):
+        def step():
+            with tracing.Span('step'):
+                pass
+
+        graph = util.DependencyGraph()
+        graph.add('step', step)
+
+        with tracing.Span('outer') as outer:
+            graph.run()
+
+        spans = self._spans()
+        self.assertEqual(outer.span_id, spans['step']['parentSpanId'])
+
+    def test_disabled(self):
+        self.mock_config.TRACE_PATH = ''
+        with tracing.Span('outer'):
+            self.assertEqual(None, tracing.traceparent())
+            self.assertEqual(None, tasks.StartInstanceTask('abcd').trace())
+        self.assertFalse(os.path.exists(self.trace_path))
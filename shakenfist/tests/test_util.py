@@ -1,4 +1,7 @@
 import mock
+import os
+import tempfile
+import threading
 
 from shakenfist.config import SFConfig
 from shakenfist import util
@@ -135,3 +138,176 @@ class UtilTestCase(test_shakenfist.ShakenFistTestCase):
 
     def test_random_macaddr(self):
         self.assertTrue(util.random_macaddr().startswith('02:00:00'))
+
+    def test_parse_cpuset(self):
+        self.assertEqual({4}, util.parse_cpuset('4'))
+        self.assertEqual({0, 1, 3, 8}, util.parse_cpuset('0-3,8,^2'))
+
+    def test_get_hugepages(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for size, total, free in [(2048, 512, 256), (1048576, 2, 0)]:
+                d = os.path.join(tmpdir, 'hugepages-%dkB' % size)
+                os.mkdir(d)
+                with open(os.path.join(d, 'nr_hugepages'), 'w') as f:
+                    f.write('%d\n' % total)
+                with open(os.path.join(d, 'free_hugepages'), 'w') as f:
+                    f.write('%d\n' % free)
+
+            self.assertEqual(
+                {
+                    2048: {'total': 1024, 'free': 512},
+                    1048576: {'total': 2048, 'free': 0},
+                },
+                util.get_hugepages(tmpdir))
+
+        self.assertEqual({}, util.get_hugepages('/does/not/exist'))
+
+    @mock.patch('shakenfist.util.get_hugepages', return_value={})
+    def test_get_numa_topology(self, mock_hugepages):
+        conn = mock.MagicMock()
+        conn.getCapabilities.return_value = (
+            '<capabilities><host><topology><cells num="2">'
+            '<cell id="0"><memory unit="KiB">2097152</memory>'
+            '<cpus num="2"><cpu id="0"/><cpu id="2"/></cpus></cell>'
+            '<cell id="1"><memory unit="KiB">4194304</memory>'
+            '<cpus num="2"><cpu id="1"/><cpu id="3"/></cpus></cell>'
+            '</cells></topology></host></capabilities>')
+        conn.getCellsFreeMemory.return_value = [1024 * 1024 * 1024,
+                                                3 * 1024 * 1024 * 1024]
+
+        self.assertEqual(
+            {
+                0: {'cpus': [0, 2], 'memory_max': 2048,
+                    'memory_available': 1024, 'hugepages': {}},
+                1: {'cpus': [1, 3], 'memory_max': 4096,
+                    'memory_available': 3072, 'hugepages': {}},
+            },
+            util.get_numa_topology(conn))
+        conn.getCellsFreeMemory.assert_called_with(0, 2)
+        mock_hugepages.assert_called_with(
+            '/sys/devices/system/node/node1/hugepages')
+
+    @mock.patch('shakenfist.util.get_libvirt')
+    def test_get_pinned_cpus(self, mock_libvirt):
+        def domain(name, xml):
+            d = mock.MagicMock()
+            d.name.return_value = name
+            d.XMLDesc.return_value = xml
+            return d
+
+        conn = mock.MagicMock()
+        conn.listAllDomains.return_value = [
+            domain('sf:a', '<domain><cputune><vcpupin vcpu="0" cpuset="2"/>'
+                           '<vcpupin vcpu="1" cpuset="3"/></cputune></domain>'),
+            domain('sf:b', '<domain><cputune><vcpupin vcpu="0" cpuset="5-6"/>'
+                           '</cputune></domain>'),
+            domain('other', '<domain></domain>'),
+        ]
+        self.assertEqual({2, 3, 5, 6}, util.get_pinned_cpus(conn))
+        self.assertEqual({5, 6}, util.get_pinned_cpus(conn, exclude='sf:a'))
+
+    def test_format_cpuset(self):
+        self.assertEqual('', util.format_cpuset(set()))
+        self.assertEqual('0-3,8,10-11',
+                         util.format_cpuset({0, 1, 2, 3, 8, 10, 11}))
+
+    @mock.patch('shakenfist.util.get_libvirt')
+    def test_restrict_shared_domains(self, mock_libvirt):
+        def domain(name, xml):
+            d = mock.MagicMock()
+            d.name.return_value = name
+            d.XMLDesc.return_value = xml
+            return d
+
+        dedicated = domain('sf:a', '<domain><vcpu>1</vcpu><cputune>'
+                                   '<vcpupin vcpu="0" cpuset="1"/>'
+                                   '</cputune></domain>')
+        shared = domain('sf:b', '<domain><vcpu>2</vcpu></domain>')
+        other = domain('other', '<domain><vcpu>1</vcpu></domain>')
+        conn = mock.MagicMock()
+        conn.getCPUMap.return_value = (4, None, 4)
+        conn.listAllDomains.return_value = [dedicated, shared, other]
+
+        util.restrict_shared_domains(conn)
+        live = mock_libvirt.return_value.VIR_DOMAIN_AFFECT_LIVE
+        cpumap = (True, False, True, True)
+        shared.pinVcpuFlags.assert_has_calls(
+            [mock.call(0, cpumap, live), mock.call(1, cpumap, live)])
+        shared.pinEmulator.assert_called_with(cpumap, live)
+        dedicated.pinVcpuFlags.assert_not_called()
+        dedicated.pinEmulator.assert_not_called()
+        other.pinVcpuFlags.assert_not_called()
+
+        shared.reset_mock()
+        util.restrict_shared_domains(conn, name='sf:c')
+        shared.pinVcpuFlags.assert_not_called()
+
+    @mock.patch('shakenfist.util.LIBVIRT_CONNECTION', None)
+    @mock.patch('shakenfist.util.get_libvirt')
+    def test_get_libvirt_connection(self, mock_libvirt):
+        first = mock.MagicMock()
+        second = mock.MagicMock()
+        mock_libvirt.return_value.open.side_effect = [first, second]
+
+        self.assertEqual(first, util.get_libvirt_connection())
+        self.assertEqual(first, util.get_libvirt_connection())
+        self.assertEqual(1, mock_libvirt.return_value.open.call_count)
+
+        # A lost connection is replaced
+        first.isAlive.return_value = 0
+        self.assertEqual(second, util.get_libvirt_connection())
+
+        # As is a connection opened before we forked
+        second.isAlive.return_value = 1
+        with mock.patch('os.getpid', return_value=-1):
+            mock_libvirt.return_value.open.side_effect = [first]
+            self.assertEqual(first, util.get_libvirt_connection())
+
+
+class DependencyGraphTestCase(test_shakenfist.ShakenFistTestCase):
+    def test_order(self):
+        order = []
+        graph = util.DependencyGraph()
+        graph.add('last', order.append, 'last', after=['first', 'second'])
+        graph.add('second', order.append, 'second', after=['first'])
+        graph.add('first', order.append, 'first')
+        graph.run()
+        self.assertEqual(['first', 'second', 'last'], order)
+
+    def test_overlap(self):
+        # Each step waits for the other to start, so this only finishes if
+        # they run at the same time
+        a = threading.Event()
+        b = threading.Event()
+
+        def step(mine, other):
+            mine.set()
+            self.assertTrue(other.wait(5))
+
+        graph = util.DependencyGraph()
+        graph.add('a', step, a, b)
+        graph.add('b', step, b, a)
+        graph.run()
+
+    def test_failure_stops_dependents(self):
+        later = mock.MagicMock()
+
+        def fail():
+            raise ValueError('broken')
+
+        graph = util.DependencyGraph()
+        graph.add('fail', fail)
+        graph.add('later', later, after=['fail'])
+        exc = self.assertRaises(ValueError, graph.run)
+        self.assertEqual('broken', str(exc))
+        later.assert_not_called()
+
+    def test_bad_dependencies(self):
+        graph = util.DependencyGraph()
+        graph.add('a', mock.MagicMock(), after=['missing'])
+        self.assertRaises(ValueError, graph.run)
+
+        graph = util.DependencyGraph()
+        graph.add('a', mock.MagicMock(), after=['b'])
+        graph.add('b', mock.MagicMock(), after=['a'])
+        self.assertRaises(ValueError, graph.run)
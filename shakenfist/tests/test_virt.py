@@ -5,6 +5,7 @@ import os
 import pycdlib
 import tempfile
 
+from shakenfist import exceptions
 from shakenfist import ipmanager
 from shakenfist import virt
 from shakenfist.config import SFConfig
@@ -292,3 +293,45 @@ class VirtTestCase(test_shakenfist.ShakenFistTestCase):
         finally:
             if os.path.exists(cd_file):
                 os.unlink(cd_file)
+
+
+class CPUPinningTestCase(test_shakenfist.ShakenFistTestCase):
+    cells = {
+        0: {'cpus': [0, 1, 2, 3], 'memory_available': 8192},
+        1: {'cpus': [4, 5, 6, 7], 'memory_available': 8192},
+    }
+
+    def test_single_cell(self):
+        # The fuller cell is used, leaving cell 1 free for a larger instance
+        self.assertEqual(([2, 3], [0]),
+                         virt._choose_cpu_pinning(self.cells, {0, 1}, 2, 1024))
+
+    def test_cell_without_memory(self):
+        self.assertEqual(([4, 5], [1]),
+                         virt._choose_cpu_pinning(
+                             {0: {'cpus': [0, 1], 'memory_available': 512},
+                              1: self.cells[1]},
+                             set(), 2, 1024))
+
+    def test_spans_cells(self):
+        self.assertEqual(([4, 5, 6, 7, 1, 2], [0, 1]),
+                         virt._choose_cpu_pinning(self.cells, {0, 3}, 6, 1024))
+
+    def test_hugepages(self):
+        cells = {
+            0: {'cpus': [0, 1], 'memory_available': 8192,
+                'hugepages': {2048: {'total': 1024, 'free': 512}}},
+            1: {'cpus': [2, 3], 'memory_available': 8192,
+                'hugepages': {2048: {'total': 2048, 'free': 2048}}},
+        }
+        self.assertEqual(([2, 3], [1]),
+                         virt._choose_cpu_pinning(cells, set(), 2, 1024,
+                                                  hugepage_size=2048))
+        self.assertRaises(exceptions.CPUPinningException,
+                          virt._choose_cpu_pinning, cells, set(), 4, 4096,
+                          hugepage_size=2048)
+
+    def test_not_enough_cpus(self):
+        self.assertRaises(exceptions.CPUPinningException,
+                          virt._choose_cpu_pinning, self.cells, {0, 1, 2}, 6,
+                          1024)
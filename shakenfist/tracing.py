@@ -0,0 +1,200 @@
+# Trace spans for following an operation across processes and nodes.
+#
+# A span records a named step with its start and end time. Spans belong to a
+# trace, and each span other than the first in a trace has a parent. The
+# current span is tracked per thread of execution, and is carried between
+# processes as a W3C traceparent string, for example inside queued tasks.
+#
+# When TRACE_PATH is set, the spans of each process are appended to that file
+# once the outermost span of a trace in that process ends. Each line is an
+# OpenTelemetry (OTLP) JSON ExportTraceServiceRequest, which the OpenTelemetry
+# collector's otlpjsonfile receiver can read.
+
+import contextvars
+import functools
+import json
+import os
+import re
+import secrets
+import threading
+import time
+
+from shakenfist.config import config
+from shakenfist import logutil
+
+
+LOG, _ = logutil.setup(__name__)
+
+
+CURRENT = contextvars.ContextVar('span', default=None)
+
+# Spans which have ended, by trace id, waiting for the outermost span of
+# their trace in this process to end
+BUFFERED = {}
+BUFFERED_LOCK = threading.Lock()
+
+TRACEPARENT_RE = re.compile('^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+SPAN_KIND_INTERNAL = 1
+
+
+def enabled():
+    return bool(config.get('TRACE_PATH'))
+
+
+def traceparent():
+    """Return the current span as a traceparent string, or None."""
+    span = CURRENT.get()
+    if not span:
+        return None
+    return '00-%s-%s-01' % (span.trace_id, span.span_id)
+
+
+def set_attribute(key, value):
+    """Set an attribute on the current span, if there is one."""
+    span = CURRENT.get()
+    if span:
+        span.set_attribute(key, value)
+
+
+def traced(name):
+    """Decorate a function so that each call to it is a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _parse_traceparent(value):
+    m = TRACEPARENT_RE.match(value or '')
+    if not m:
+        return None, None
+    return m.group(1), m.group(2)
+
+
+class Span(object):
+    """A traced step, used as a context manager.
+
+    The parent is the current span, unless a traceparent from another process
+    is given. Without either, the span starts a new trace.
+    """
+
+    def __init__(self, name, attributes=None, parent=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.status = STATUS_OK
+        self.message = None
+        self.active = enabled()
+        self._token = None
+
+        local_parent = CURRENT.get()
+        remote_trace_id, remote_span_id = _parse_traceparent(parent)
+        if remote_trace_id:
+            self.trace_id = remote_trace_id
+            self.parent_id = remote_span_id
+            self.local_root = True
+        elif local_parent:
+            self.trace_id = local_parent.trace_id
+            self.parent_id = local_parent.span_id
+            self.local_root = False
+        else:
+            self.trace_id = secrets.token_hex(16)
+            self.parent_id = None
+            self.local_root = True
+        self.span_id = secrets.token_hex(8)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start_time = time.time_ns()
+        if self.active:
+            self._token = CURRENT.set(self)
+            if self.local_root:
+                with BUFFERED_LOCK:
+                    BUFFERED.setdefault(self.trace_id, [])
+        return self
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        self.end_time = time.time_ns()
+        if not self.active:
+            return
+
+        CURRENT.reset(self._token)
+        if exc_type:
+            self.status = STATUS_ERROR
+            self.message = '%s: %s' % (exc_type.__name__, exc_value)
+
+        with BUFFERED_LOCK:
+            if self.local_root:
+                spans = BUFFERED.pop(self.trace_id, []) + [self]
+            elif self.trace_id in BUFFERED:
+                BUFFERED[self.trace_id].append(self)
+                return
+            else:
+                # Our local root has already ended, for example because we
+                # ran in a thread which outlived it
+                spans = [self]
+        _write(spans)
+
+    def export(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': SPAN_KIND_INTERNAL,
+            'startTimeUnixNano': str(self.start_time),
+            'endTimeUnixNano': str(self.end_time),
+            'attributes': _attributes(self.attributes),
+            'status': {'code': self.status},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.message:
+            span['status']['message'] = self.message
+        return span
+
+
+def _attributes(attributes):
+    exported = []
+    for key, value in sorted(attributes.items()):
+        if isinstance(value, bool):
+            exported.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            exported.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            exported.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            exported.append({'key': key, 'value': {'stringValue': str(value)}})
+    return exported
+
+
+def _write(spans):
+    request = {
+        'resourceSpans': [{
+            'resource': {
+                'attributes': _attributes({
+                    'service.name': 'shakenfist',
+                    'host.name': config.NODE_NAME,
+                    'process.pid': os.getpid(),
+                })
+            },
+            'scopeSpans': [{
+                'scope': {'name': 'shakenfist'},
+                'spans': [span.export() for span in spans],
+            }],
+        }]
+    }
+
+    # Several processes append to the same file, so each batch is written
+    # as a single line in a single write
+    try:
+        with open(config.get('TRACE_PATH'), 'a') as f:
+            f.write(json.dumps(request) + '\n')
+    except OSError as e:
+        LOG.withField('error', e).warning('Failed to write trace spans')
@@ -1,8 +1,12 @@
 # Copyright 2020 Michael Still
 
+import concurrent.futures
+import contextvars
+import functools
 import importlib
 import json
 import multiprocessing
+import os
 from pbr.version import VersionInfo
 import random
 import re
@@ -12,17 +16,75 @@ import string
 import sys
 import time
 import traceback
+from xml.etree import ElementTree
 
 from oslo_concurrency import processutils
 
 from shakenfist import db
 from shakenfist.config import config
 from shakenfist import logutil
+from shakenfist import tracing
 
 
 LOG, _ = logutil.setup(__name__)
 
 
+class DependencyGraph(object):
+    """Run steps as soon as the steps they depend on have finished.
+
+    Steps which don't depend on each other run at the same time, in threads.
+    Once a step fails no more are started, and the first failure is raised
+    when the steps already running have finished.
+    """
+
+    def __init__(self):
+        self.steps = {}
+
+    def add(self, name, func, *args, after=None, **kwargs):
+        self.steps[name] = (functools.partial(func, *args, **kwargs),
+                            set(after or []))
+
+    def run(self):
+        for name, (_, after) in self.steps.items():
+            if after - set(self.steps):
+                raise ValueError('Step %s depends on unknown steps %s'
+                                 % (name, ', '.join(sorted(after - set(self.steps)))))
+
+        pending = dict(self.steps)
+        running = {}
+        done = set()
+        failure = None
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(len(self.steps), 1)) as executor:
+            while True:
+                if not failure:
+                    for name in [n for n, (_, after) in pending.items()
+                                 if after <= done]:
+                        # Steps run in the caller's context, so that their
+                        # trace spans are children of the caller's
+                        context = contextvars.copy_context()
+                        running[executor.submit(
+                            context.run, pending.pop(name)[0])] = name
+                if not running:
+                    break
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception():
+                        failure = failure or future.exception()
+                    else:
+                        done.add(name)
+
+        if failure:
+            raise failure
+        if pending:
+            raise ValueError('Steps %s have circular dependencies'
+                             % ', '.join(sorted(pending)))
+
+
 class RecordedOperation():
     def __init__(self, operation, relatedobject):
         self.operation = operation
@@ -34,9 +96,15 @@ class RecordedOperation():
         if object_type and object_uuid:
             db.add_event(object_type, object_uuid,
                          self.operation, 'start', None, None)
+
+        self.span = tracing.Span(self.operation)
+        if object_uuid:
+            self.span.set_attribute(object_type or 'label', object_uuid)
+        self.span.__enter__()
         return self
 
     def __exit__(self, *args):
+        self.span.__exit__(*args)
         duration = time.time() - self.start_time
         log = LOG
         object_type, object_uuid = self.unique_label()
@@ -170,6 +238,32 @@ def get_libvirt():
     return LIBVIRT
 
 
+LIBVIRT_CONNECTION = None
+LIBVIRT_CONNECTION_PID = None
+
+
+def get_libvirt_connection():
+    """Return a libvirt connection shared by this process.
+
+    The connection is replaced if it has been lost, for example because
+    libvirtd restarted, and is not shared with forked children.
+    """
+    global LIBVIRT_CONNECTION
+    global LIBVIRT_CONNECTION_PID
+
+    libvirt = get_libvirt()
+    if LIBVIRT_CONNECTION and LIBVIRT_CONNECTION_PID == os.getpid():
+        try:
+            if LIBVIRT_CONNECTION.isAlive():
+                return LIBVIRT_CONNECTION
+        except libvirt.libvirtError:
+            pass
+
+    LIBVIRT_CONNECTION = libvirt.open(None)
+    LIBVIRT_CONNECTION_PID = os.getpid()
+    return LIBVIRT_CONNECTION
+
+
 def extract_power_state(libvirt, domain):
     state, _ = domain.state()
     if state == libvirt.VIR_DOMAIN_SHUTOFF:
@@ -187,6 +281,156 @@ def extract_power_state(libvirt, domain):
     return 'on'
 
 
+# Hugepage sizes which instances may request, in KB
+HUGEPAGE_SIZES = {'2M': 2048, '1G': 1048576}
+
+
+def get_hugepages(path):
+    """Return the free hugepage memory in a sysfs hugepages directory.
+
+    Results are keyed by page size in KB, with the total and free memory in
+    those pages in MB.
+    """
+    hugepages_re = re.compile('^hugepages-([0-9]+)kB$')
+    hugepages = {}
+    if not os.path.isdir(path):
+        return hugepages
+
+    for ent in os.listdir(path):
+        m = hugepages_re.match(ent)
+        if not m:
+            continue
+        size_kb = int(m.group(1))
+        counts = {}
+        for count in ['nr_hugepages', 'free_hugepages']:
+            with open(os.path.join(path, ent, count)) as f:
+                counts[count] = int(f.read().rstrip())
+        hugepages[size_kb] = {
+            'total': counts['nr_hugepages'] * size_kb // 1024,
+            'free': counts['free_hugepages'] * size_kb // 1024,
+        }
+    return hugepages
+
+
+def parse_cpuset(cpuset):
+    """Parse a libvirt cpuset such as "0-3,8,^2" into a set of CPU ids."""
+    cpus = set()
+    excluded = set()
+    for part in cpuset.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        target = cpus
+        if part.startswith('^'):
+            target = excluded
+            part = part[1:]
+        if '-' in part:
+            first, last = part.split('-')
+            target.update(range(int(first), int(last) + 1))
+        else:
+            target.add(int(part))
+    return cpus - excluded
+
+
+def get_numa_topology(conn):
+    """Return the NUMA cells of this node from libvirt capabilities.
+
+    Each cell is keyed by id and lists its CPU ids, its total and free
+    memory in MB, and its hugepages as returned by get_hugepages(). A node
+    which doesn't report a topology is one cell.
+    """
+    caps = ElementTree.fromstring(conn.getCapabilities())
+    cells = {}
+    for cell in caps.findall('./host/topology/cells/cell'):
+        memory = cell.find('memory')
+        cells[int(cell.get('id'))] = {
+            'cpus': sorted(int(cpu.get('id'))
+                           for cpu in cell.findall('./cpus/cpu')),
+            'memory_max': int(memory.text) // 1024 if memory is not None else 0,
+        }
+
+    if not cells:
+        present_cpus, _, _ = conn.getCPUMap()
+        cells[0] = {
+            'cpus': list(range(present_cpus)),
+            'memory_max': conn.getInfo()[1],
+        }
+
+    # Free memory is reported in bytes
+    ids = sorted(cells)
+    for cell_id, free in zip(ids, conn.getCellsFreeMemory(ids[0], len(ids))):
+        cells[cell_id]['memory_available'] = free // 1024 // 1024
+        cells[cell_id]['hugepages'] = get_hugepages(
+            '/sys/devices/system/node/node%d/hugepages' % cell_id)
+    return cells
+
+
+def get_pinned_cpus(conn, exclude=None):
+    """Return the host CPUs which domains on this node are pinned to.
+
+    Domains which are defined but not running are included, as they will
+    want their CPUs back when they start. exclude names a domain to skip.
+    Only the persistent configuration is read, as shared domains are pinned
+    away from these CPUs while running, see restrict_shared_domains().
+    """
+    libvirt = get_libvirt()
+    pinned = set()
+    for domain in conn.listAllDomains():
+        if domain.name() == exclude:
+            continue
+        xml = ElementTree.fromstring(
+            domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        for pin in xml.findall('./cputune/vcpupin'):
+            pinned.update(parse_cpuset(pin.get('cpuset')))
+    return pinned
+
+
+def format_cpuset(cpus):
+    """Format a set of CPU ids as a libvirt cpuset such as "0-3,8"."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join([str(first) if first == last else '%d-%d' % (first, last)
+                     for first, last in ranges])
+
+
+def restrict_shared_domains(conn, name=None):
+    """Keep the running shared domains on this node off pinned CPUs.
+
+    Shared domains may already be running on the CPUs which a dedicated
+    instance has just been pinned to. Their vCPUs and emulator threads are
+    moved to the unpinned CPUs. This only changes the running domains, so
+    that their persistent configuration never looks pinned. name restricts
+    the change to one domain.
+    """
+    libvirt = get_libvirt()
+    present_cpus, _, _ = conn.getCPUMap()
+    pinned = get_pinned_cpus(conn)
+    cpumap = tuple([cpu not in pinned for cpu in range(present_cpus)])
+
+    for domain in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+        if not domain.name().startswith('sf:'):
+            continue
+        if name and domain.name() != name:
+            continue
+
+        xml = ElementTree.fromstring(
+            domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        if xml.findall('./cputune/vcpupin'):
+            continue
+
+        try:
+            for vcpu in range(int(xml.find('vcpu').text)):
+                domain.pinVcpuFlags(vcpu, cpumap, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+            domain.pinEmulator(cpumap, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+        except libvirt.libvirtError as e:
+            LOG.warning('Failed to move %s off pinned CPUs: %s'
+                        % (domain.name(), e))
+
+
 def get_api_token(base_url, namespace='system'):
     with db.get_lock('namespace', None, namespace,
                      op='Get API token'):
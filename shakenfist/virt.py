@@ -24,9 +24,11 @@ LOG, _ = logutil.setup(__name__)
 
 def from_definition(uuid=None, name=None, disks=None, memory_mb=None,
                     vcpus=None, ssh_key=None, user_data=None, owner=None,
-                    video=None, requested_placement=None):
+                    video=None, requested_placement=None, cpu_policy=None,
+                    hugepages=None):
     db_entry = db.create_instance(uuid, name, vcpus, memory_mb, disks,
-                                  ssh_key, user_data, owner, video, requested_placement)
+                                  ssh_key, user_data, owner, video, requested_placement,
+                                  cpu_policy=cpu_policy, hugepages=hugepages)
     return Instance(db_entry)
 
 
@@ -61,6 +63,55 @@ def _get_defaulted_disk_type(disk):
     return 'disk'
 
 
+def _choose_cpu_pinning(cells, pinned, vcpus, memory, hugepage_size=None):
+    """Choose a host CPU for each vCPU of a dedicated instance.
+
+    The smallest NUMA cell with enough free CPUs and memory is preferred, so
+    that larger cells stay free for larger instances. For hugepage backed
+    instances the memory must be free hugepages of hugepage_size KB.
+    Otherwise the instance spans cells, taking CPUs from the emptiest cells
+    first. Returns the host CPUs in vCPU order, and the cells they are in.
+    """
+    free = {}
+    for cell_id, cell in cells.items():
+        free[cell_id] = [cpu for cpu in cell['cpus'] if cpu not in pinned]
+
+    def free_memory(cell):
+        if hugepage_size:
+            return cell.get('hugepages', {}).get(hugepage_size, {}).get('free', 0)
+        return cell['memory_available']
+
+    for cell_id in sorted(free, key=lambda c: len(free[c])):
+        if (len(free[cell_id]) >= vcpus and
+                free_memory(cells[cell_id]) >= memory):
+            return free[cell_id][:vcpus], [cell_id]
+
+    host_cpus = []
+    used_cells = []
+    for cell_id in sorted(free, key=lambda c: len(free[c]), reverse=True):
+        if len(host_cpus) == vcpus:
+            break
+        take = free[cell_id][:vcpus - len(host_cpus)]
+        if take:
+            host_cpus.extend(take)
+            used_cells.append(cell_id)
+
+    if len(host_cpus) < vcpus:
+        raise exceptions.CPUPinningException(
+            '%d dedicated vCPUs requested, but only %d host CPUs are free'
+            % (vcpus, len(host_cpus)))
+
+    # Memory is bound strictly to the cells used, and hugepages cannot be
+    # swapped or overcommitted, so those cells must hold all of it
+    if hugepage_size and sum(free_memory(cells[c]) for c in used_cells) < memory:
+        raise exceptions.CPUPinningException(
+            '%dMB of hugepages requested, but only %dMB are free on NUMA '
+            'cells %s' % (memory,
+                          sum(free_memory(cells[c]) for c in used_cells),
+                          ','.join(str(c) for c in sorted(used_cells))))
+    return host_cpus, sorted(used_cells)
+
+
 class Instance(object):
     def __init__(self, db_entry):
         self.db_entry = db_entry
@@ -146,19 +197,26 @@ class Instance(object):
     # moving to a queue and task based creation mechanism.
     def create(self, lock=None):
         db.update_instance_state(self.db_entry['uuid'], 'creating')
+        self.create_config_drive()
+        self.create_disks(lock=lock)
+        self.create_domain()
 
+    def create_config_drive(self):
         # Ensure we have state on disk
         if not os.path.exists(self.instance_path):
             LOG.withObj(self).debug(
                 'Creating instance storage at %s' % self.instance_path)
-            os.makedirs(self.instance_path)
+            os.makedirs(self.instance_path, exist_ok=True)
 
-        # Generate a config drive
         with util.RecordedOperation('make config drive', self):
             self._make_config_drive(os.path.join(
                 self.instance_path, self.db_entry['block_devices']['devices'][1]['path']))
 
-        # Prepare disks
+    def create_disks(self, lock=None):
+        """Create disks from the instance's images, which must be fetched.
+
+        The config drive must already exist.
+        """
         if not self.db_entry['block_devices']['finalized']:
             modified_disks = []
             for disk in self.db_entry['block_devices']['devices']:
@@ -237,9 +295,18 @@ class Instance(object):
         db.persist_block_devices(
             self.db_entry['uuid'], self.db_entry['block_devices'])
 
-        # Create the actual instance
+    def create_domain(self):
+        """Define and power on the domain, once disks and networks exist."""
         with util.RecordedOperation('create domain XML', self):
-            self._create_domain_xml()
+            if self.db_entry.get('cpu_policy') == 'dedicated':
+                # Define the domain while holding the lock, so that the next
+                # dedicated instance to start here sees our pinned CPUs
+                with db.get_lock('cpupinning', None, config.NODE_NAME,
+                                 ttl=120, op='Instance CPU pinning'):
+                    self._create_domain_xml()
+                    self._define_domain()
+            else:
+                self._create_domain_xml()
 
         # Sometimes on Ubuntu 20.04 we need to wait for port binding to work.
         # Revisiting this is tracked by issue 320 on github.
@@ -285,13 +352,13 @@ class Instance(object):
                     ipm.release(ni['ipv4'])
                     db.persist_ipmanager(ni['network_uuid'], ipm.save())
 
-        db.free_console_port(self.db_entry['console_port'])
-        db.free_console_port(self.db_entry['vdi_port'])
+        db.free_console_ports(
+            [self.db_entry['console_port'], self.db_entry['vdi_port']])
 
     def allocate_instance_ports(self):
         uuid = self.db_entry['uuid']
-        self.db_entry['console_port'] = db.allocate_console_port(uuid)
-        self.db_entry['vdi_port'] = db.allocate_console_port(uuid)
+        (self.db_entry['console_port'],
+         self.db_entry['vdi_port']) = db.allocate_console_ports(uuid)
 
         # TODO(andy): When class is modified to model Image class this
         # repetitive write will be moved to a single persist() function.
@@ -450,6 +517,33 @@ class Instance(object):
                 }
             )
 
+        # Dedicated instances are pinned to host CPUs, and their memory to the
+        # NUMA cells those CPUs are in
+        hugepage_size = None
+        if self.db_entry.get('hugepages'):
+            hugepage_size = util.HUGEPAGE_SIZES[self.db_entry['hugepages']]
+
+        cpu_pins = []
+        numa_nodeset = None
+        shared_cpuset = None
+        conn = util.get_libvirt_connection()
+        if self.db_entry.get('cpu_policy') == 'dedicated':
+            host_cpus, cells = _choose_cpu_pinning(
+                util.get_numa_topology(conn),
+                util.get_pinned_cpus(conn, exclude='sf:' + self.db_entry['uuid']),
+                self.db_entry['cpus'], self.db_entry['memory'],
+                hugepage_size=hugepage_size)
+            cpu_pins = list(enumerate(host_cpus))
+            numa_nodeset = ','.join([str(c) for c in cells])
+        else:
+            # Shared instances run on whichever CPUs aren't pinned
+            host_cpus = set()
+            for cell in util.get_numa_topology(conn).values():
+                host_cpus.update(cell['cpus'])
+            unpinned = host_cpus - util.get_pinned_cpus(conn)
+            if unpinned and unpinned != host_cpus:
+                shared_cpuset = util.format_cpuset(unpinned)
+
         # NOTE(mikal): the database stores memory allocations in MB, but the
         # domain XML takes them in KB. That wouldn't be worth a comment here if
         # I hadn't spent _ages_ finding a bug related to it.
@@ -463,7 +557,11 @@ class Instance(object):
             console_port=self.db_entry['console_port'],
             vdi_port=self.db_entry['vdi_port'],
             video_model=self.db_entry['video']['model'],
-            video_memory=self.db_entry['video']['memory']
+            video_memory=self.db_entry['video']['memory'],
+            cpu_pins=cpu_pins,
+            numa_nodeset=numa_nodeset,
+            shared_cpuset=shared_cpuset,
+            hugepage_size=hugepage_size
         )
 
         with open(self.xml_file, 'w') as f:
@@ -471,7 +569,7 @@ class Instance(object):
 
     def _get_domain(self):
         libvirt = util.get_libvirt()
-        conn = libvirt.open(None)
+        conn = util.get_libvirt_connection()
         try:
             return conn.lookupByName('sf:' + self.db_entry['uuid'])
 
@@ -486,23 +584,29 @@ class Instance(object):
         libvirt = util.get_libvirt()
         return util.extract_power_state(libvirt, instance)
 
+    def _define_domain(self):
+        instance = self._get_domain()
+        if instance:
+            return instance
+
+        with open(self.xml_file) as f:
+            xml = f.read()
+
+        conn = util.get_libvirt_connection()
+        instance = conn.defineXML(xml)
+        if not instance:
+            db.enqueue_instance_error(self.db_entry['uuid'],
+                                      'power on failed to create domain')
+            raise exceptions.NoDomainException()
+        return instance
+
     def power_on(self):
         if not os.path.exists(self.xml_file):
             db.enqueue_instance_error(self.db_entry['uuid'],
                                       'missing domain file in power on')
 
         libvirt = util.get_libvirt()
-        with open(self.xml_file) as f:
-            xml = f.read()
-
-        instance = self._get_domain()
-        if not instance:
-            conn = libvirt.open(None)
-            instance = conn.defineXML(xml)
-            if not instance:
-                db.enqueue_instance_error(self.db_entry['uuid'],
-                                          'power on failed to create domain')
-                raise exceptions.NoDomainException()
+        instance = self._define_domain()
 
         try:
             instance.create()
@@ -512,6 +616,15 @@ class Instance(object):
                 LOG.withObj(self).warning('Instance start error: %s' % e)
                 return False
 
+        # Shared instances are kept off the CPUs which dedicated ones are
+        # pinned to, including those pinned since they were defined
+        conn = util.get_libvirt_connection()
+        if self.db_entry.get('cpu_policy') == 'dedicated':
+            util.restrict_shared_domains(conn)
+        else:
+            util.restrict_shared_domains(
+                conn, name='sf:' + self.db_entry['uuid'])
+
         instance.setAutostart(1)
         db.update_instance_power_state(
             self.db_entry['uuid'],